@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+#
+#  generators.py
+#  proj
+#
+
+"""
+Build synthetic project trees and archives for the benchmarks. Every
+generator is deterministic for a given seed, and backdates what it makes so
+that archiving always files projects into the same quarter.
+"""
+
+import os
+import random
+from os import path
+from typing import Iterator
+
+# everything generated is dated to here, safely out of the index's grace period
+EPOCH = 1262304000  # 2010-01-01
+
+CHUNK = 1024 * 1024
+
+
+def deep_tree(root: str, depth: int, width: int, files_per_dir: int) -> int:
+    """
+    A tree with `width` subfolders per folder, `depth` levels deep, and a few
+    small files in every folder, like a source checkout. Returns the number of
+    files made.
+    """
+    os.makedirs(root)
+    n_files = 0
+    for i in range(files_per_dir):
+        _write_file(path.join(root, f"file{i}.txt"), 256 + 64 * i)
+        n_files += 1
+
+    if depth > 1:
+        for i in range(width):
+            n_files += deep_tree(
+                path.join(root, f"dir{i}"), depth - 1, width, files_per_dir
+            )
+
+    _backdate(root)
+    return n_files
+
+
+def small_files(root: str, n_files: int, per_dir: int = 1000) -> int:
+    """
+    Lots of tiny files spread over flat folders, like a dataset or a
+    node_modules. Returns the number of files made.
+    """
+    os.makedirs(root)
+    for i in range(n_files):
+        folder = path.join(root, f"batch{i // per_dir:04d}")
+        if i % per_dir == 0:
+            os.mkdir(folder)
+
+        _write_file(path.join(folder, f"{i}.dat"), 32)
+
+    for folder in _walk_dirs(root):
+        _backdate(folder)
+
+    return n_files
+
+
+def huge_files(root: str, n_files: int, size: int, seed: int = 0) -> int:
+    """
+    A few big files, half random and half zeros, so that they compress but
+    not trivially. Returns the number of bytes written.
+    """
+    rng = random.Random(seed)
+    noise = bytes(rng.getrandbits(8) for _ in range(CHUNK))
+    zeros = bytes(CHUNK)
+
+    os.makedirs(root)
+    for i in range(n_files):
+        filename = path.join(root, f"blob{i}.bin")
+        with open(filename, "wb") as ostream:
+            written = 0
+            while written < size:
+                chunk = noise if (written // CHUNK) % 2 == 0 else zeros
+                chunk = chunk[: size - written]
+                ostream.write(chunk)
+                written += len(chunk)
+
+        _backdate(filename)
+
+    _backdate(root)
+    return n_files * size
+
+
+def archive(
+    archive_dir: str, n_projects: int, first_year: int = 2000, seed: int = 0
+) -> int:
+    """
+    An archive of empty projects spread over year/quarter folders, a fifth
+    of them compressed. Returns the number of projects made.
+    """
+    rng = random.Random(seed)
+    years = range(first_year, first_year + 20)
+    for i in range(n_projects):
+        quarter_dir = path.join(
+            archive_dir, str(rng.choice(years)), f"q{rng.randint(1, 4)}"
+        )
+        if not path.isdir(quarter_dir):
+            os.makedirs(quarter_dir)
+
+        name = project_name(i)
+        if i % 5 == 0:
+            _write_file(path.join(quarter_dir, f"{name}.tar.gz"), 0)
+        else:
+            os.mkdir(path.join(quarter_dir, name))
+
+    for folder in _walk_dirs(archive_dir):
+        _backdate(folder)
+
+    return n_projects
+
+
+def project_name(i: int) -> str:
+    "The name given to the i-th project in a generated archive."
+    return f"project-{i:06d}"
+
+
+def _write_file(filename: str, size: int) -> None:
+    with open(filename, "wb") as ostream:
+        ostream.write(b"x" * size)
+
+    _backdate(filename)
+
+
+def _backdate(p: str) -> None:
+    os.utime(p, (EPOCH, EPOCH))
+
+
+def _walk_dirs(root: str) -> Iterator[str]:
+    "Every folder under root, deepest first so parents keep their new mtime."
+    for dirpath, _, _ in os.walk(root, topdown=False):
+        yield dirpath
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  startup.py
+#  proj
+#
+
+"""
+Measure how long the proj CLI takes to start, using `python -X importtime`
+to time the imports each command needs. Fails if the median is over budget.
+
+    python benchmarks/startup.py --runs 20 --budget-ms 60
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+from typing import Dict, List, Optional
+
+
+# what each command imports before it can do any work
+COMMANDS = {
+    "help": "import proj",
+    "list": "import proj, proj.logic, proj.configfile",
+    "archive": "import proj, proj.logic, proj.configfile, proj.compress",
+}
+
+
+def import_time_us(statement: str) -> int:
+    "The cumulative import time of everything the statement imports."
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        stderr=subprocess.PIPE,
+        text=True,
+        check=True,
+    )
+    total = 0
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+
+        _, cumulative, name = line.split("|")
+        # only count top-level imports, nested ones are already included
+        if not name[1:].startswith(" "):
+            total += int(cumulative)
+
+    return total
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--budget-ms", type=float, default=None)
+    args = parser.parse_args(argv)
+
+    # what the interpreter imports by itself before running anything
+    baseline = statistics.median(import_time_us("pass") for _ in range(args.runs))
+
+    results: Dict[str, float] = {}
+    for command, statement in COMMANDS.items():
+        samples = [import_time_us(statement) for _ in range(args.runs)]
+        results[command] = round((statistics.median(samples) - baseline) / 1000, 1)
+
+    print(json.dumps({"import_ms": results}, indent=2))
+
+    if args.budget_ms is not None:
+        over = {c: ms for c, ms in results.items() if ms > args.budget_ms}
+        if over:
+            print(f"over budget of {args.budget_ms} ms: {over}", file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  suite.py
+#  proj
+#
+
+"""
+Time proj's main operations against synthetic projects and archives, and
+flag any that got slower than a stored baseline.
+
+    python benchmarks/suite.py --size small --output baseline.json
+    python benchmarks/suite.py --size small --compare baseline.json
+
+Results are JSON: the median, min and max seconds of each operation, along
+with the commit, Python and machine they were measured on.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from os import path
+from typing import Any, Callable, Dict, List, Optional
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+import generators  # noqa: E402
+from proj import fs, index, logic  # noqa: E402
+from proj.configfile import Config  # noqa: E402
+
+
+# how big to make each generated tree
+SIZES: Dict[str, Dict[str, Any]] = {
+    "tiny": {
+        "deep_tree": {"depth": 3, "width": 3, "files_per_dir": 5},
+        "small_files": {"n_files": 1000},
+        "huge_files": {"n_files": 2, "size": 4 * 1024 * 1024},
+        "archive": {"n_projects": 1000},
+    },
+    "small": {
+        "deep_tree": {"depth": 5, "width": 4, "files_per_dir": 10},
+        "small_files": {"n_files": 50_000},
+        "huge_files": {"n_files": 2, "size": 64 * 1024 * 1024},
+        "archive": {"n_projects": 10_000},
+    },
+    "large": {
+        "deep_tree": {"depth": 7, "width": 5, "files_per_dir": 20},
+        "small_files": {"n_files": 1_000_000},
+        "huge_files": {"n_files": 4, "size": 512 * 1024 * 1024},
+        "archive": {"n_projects": 100_000},
+    },
+}
+
+# differences smaller than this are noise, however big the ratio
+NOISE_FLOOR_S = 0.005
+
+
+class Suite:
+    def __init__(self, workdir: str, size: str, repeat: int) -> None:
+        self.workdir = workdir
+        self.params = SIZES[size]
+        self.repeat = repeat
+        self.results: Dict[str, Dict[str, Any]] = {}
+
+    def run(self, only: Optional[str] = None) -> Dict[str, Dict[str, Any]]:
+        for name, bench in self.benchmarks():
+            if only and only not in name:
+                continue
+
+            print(f"{name}...", end=" ", file=sys.stderr, flush=True)
+            self.results[name] = bench()
+            print(f"{self.results[name]['median_s']:.4f}s", file=sys.stderr)
+
+        return self.results
+
+    def benchmarks(self) -> List[Any]:
+        return [
+            ("last_modified/deep_tree", lambda: self.last_modified("deep_tree")),
+            ("last_modified/small_files", lambda: self.last_modified("small_files")),
+            ("last_modified/huge_files", lambda: self.last_modified("huge_files")),
+            ("list_projects/cold_index", lambda: self.list_projects(cold=True)),
+            ("list_projects/warm_index", lambda: self.list_projects(cold=False)),
+            ("list_projects/pattern", lambda: self.list_projects(pattern="-0042")),
+            ("find_restore_match", self.find_restore_match),
+            ("archive_compressed/deep_tree", lambda: self.archive("deep_tree")),
+            ("archive_compressed/huge_files", lambda: self.archive("huge_files")),
+            ("archive_dedup/deep_tree", lambda: self.archive("deep_tree", "dedup")),
+        ]
+
+    def last_modified(self, kind: str) -> Dict[str, Any]:
+        project = self.generate(kind)
+        return self.time(lambda: fs.last_modified(project), params=self.params[kind])
+
+    def list_projects(self, cold: bool = False, pattern: str = "") -> Dict[str, Any]:
+        archive_dir = self.generate("archive")
+        config = Config(archive_dir=archive_dir)
+        index_file = path.join(archive_dir, index.INDEX_FILENAME)
+
+        def drop_index() -> None:
+            if path.exists(index_file):
+                os.unlink(index_file)
+
+        return self.time(
+            lambda: logic.list_projects([pattern] if pattern else [], config),
+            setup=drop_index if cold else None,
+            params=self.params["archive"],
+        )
+
+    def find_restore_match(self) -> Dict[str, Any]:
+        archive_dir = self.generate("archive")
+        name = generators.project_name(self.params["archive"]["n_projects"] // 2)
+        return self.time(
+            lambda: logic._find_restore_match(name, [archive_dir]),
+            params=self.params["archive"],
+        )
+
+    def archive(self, kind: str, compression_format: str = "gztar") -> Dict[str, Any]:
+        """
+        Archive a fresh copy of a tree each time. The dedup store is kept
+        between runs, as it would be for projects sharing most of their files.
+        """
+        original = self.generate(kind)
+        src_path = path.join(self.workdir, f"{kind}-copy")
+        dest_path = path.join(self.workdir, f"{kind}-archived")
+        ext = fs.SUPPORTED_FORMATS[compression_format]
+        chunk_store = path.join(self.workdir, "chunks")
+
+        def fresh_copy() -> None:
+            for p in (src_path, dest_path + ext):
+                if path.isdir(p):
+                    shutil.rmtree(p)
+                elif path.exists(p):
+                    os.unlink(p)
+
+            shutil.copytree(original, src_path, symlinks=True)
+
+        return self.time(
+            lambda: logic._archive_compressed(
+                src_path,
+                dest_path,
+                compression_format,
+                ext,
+                threads=0,
+                chunk_store=chunk_store,
+            ),
+            setup=fresh_copy,
+            params={**self.params[kind], "format": compression_format, "threads": 0},
+        )
+
+    def generate(self, kind: str) -> str:
+        "Make a tree of the given kind, once per run of the suite."
+        root = path.join(self.workdir, kind)
+        if not path.exists(root):
+            getattr(generators, kind)(root, **self.params[kind])
+
+        return root
+
+    def time(
+        self,
+        f: Callable[[], Any],
+        setup: Optional[Callable[[], None]] = None,
+        params: Optional[Dict[str, Any]] = None,
+    ) -> Dict[str, Any]:
+        samples = []
+        for _ in range(self.repeat):
+            if setup:
+                setup()
+
+            start = time.perf_counter()
+            f()
+            samples.append(time.perf_counter() - start)
+
+        return {
+            "median_s": statistics.median(samples),
+            "min_s": min(samples),
+            "max_s": max(samples),
+            "runs": len(samples),
+            "params": params or {},
+        }
+
+
+def compare(
+    results: Dict[str, Dict[str, Any]],
+    baseline: Dict[str, Dict[str, Any]],
+    tolerance: float,
+) -> List[str]:
+    "Print how each result compares to the baseline, returning any regressions."
+    regressions = []
+    width = max(len(name) for name in results)
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            print(f"{name:{width}}  {result['median_s']:9.4f}s  (new)")
+            continue
+
+        before = baseline[name]["median_s"]
+        after = result["median_s"]
+        ratio = after / before if before else float("inf")
+        slower = ratio > 1 + tolerance and after - before > NOISE_FLOOR_S
+        if result["params"] != baseline[name]["params"]:
+            flag = "(not comparable)"
+        elif slower:
+            flag = "REGRESSION"
+            regressions.append(name)
+        else:
+            flag = ""
+
+        print(f"{name:{width}}  {before:9.4f}s -> {after:9.4f}s  {ratio:5.2f}x  {flag}")
+
+    return regressions
+
+
+def describe_machine(size: str) -> Dict[str, Any]:
+    return {
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "size": size,
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    }
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        result = subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=path.dirname(path.abspath(__file__)),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    return result.stdout.strip()
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--size", choices=sorted(SIZES), default="small")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--only", help="Only run benchmarks whose name has this in it")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="A baseline JSON file to compare against")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="How much slower than the baseline counts as a regression",
+    )
+    parser.add_argument("--workdir", help="Where to generate trees (default: temp)")
+    args = parser.parse_args(argv)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="proj-bench-")
+    try:
+        results = Suite(workdir, args.size, args.repeat).run(only=args.only)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir)
+
+    record = {"machine": describe_machine(args.size), "results": results}
+    if args.output:
+        with open(args.output, "w") as ostream:
+            json.dump(record, ostream, indent=2)
+    else:
+        print(json.dumps(record, indent=2))
+
+    if args.compare:
+        with open(args.compare) as istream:
+            baseline = json.load(istream)
+
+        regressions = compare(results, baseline["results"], args.tolerance)
+        if regressions:
+            print(f"slower than baseline: {', '.join(regressions)}", file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -11,17 +11,29 @@ __email__ = "lars@yencken.org"
 __version__ = "0.2.0"
 
 import os
-from typing import List
+import sys
+from typing import TYPE_CHECKING, Any, List, Optional
 
 import click
 
-from proj.configfile import Config, NoConfigError
-from proj import logic
-from proj.ui import bail
+from proj.completion import complete_projects, completer
+from proj.exceptions import CommandError
+from proj.ui import bail, format_size
+
+# the CLI is run from shell prompts and completion scripts, so startup time
+# matters: config and logic pull in yaml, sqlite and friends, and are only
+# imported once a subcommand actually needs them
+if TYPE_CHECKING:  # pragma: no cover
+    from proj.configfile import Config
 
 
 @click.group()
-def main():
+@click.option("--timings", is_flag=True, help="Print where the time went")
+@click.option(
+    "--profile", metavar="FILE", help="Save a cProfile of the command to FILE"
+)
+@click.pass_context
+def main(ctx: click.Context, timings: bool = False, profile: Optional[str] = None):
     """
     proj is a tool for managing many different projects, and archiving
     projects that you're no longer actively working on.
@@ -30,57 +42,469 @@ def main():
     and an archive folder with inactive projects. proj helps organise
     inactive projects by year and by quarter (e.g. 2013/q3/my-project).
 
-    proj needs an archive directory specified by the PROJ_ARCHIVE
-    environment variable.
+    proj reads its settings from ~/.proj.yml, or takes just the archive
+    directory from the PROJ_ARCHIVE environment variable if it's set.
+
+    Set PROJ_METRICS_FILE to append timings and counters for every run to
+    that file, as JSON lines.
     """
-    pass
+    metrics_file = os.environ.get("PROJ_METRICS_FILE")
+    if timings or profile or metrics_file:
+        from proj import metrics
+
+        finish = metrics.instrument(
+            ctx.invoked_subcommand,
+            timings=timings,
+            profile=profile,
+            metrics_file=metrics_file,
+        )
+        ctx.call_on_close(finish)
 
 
 @click.command()
 @click.argument("folder", nargs=-1)
 @click.option("-n", "--dry-run", is_flag=True, help="Don't make any changes")
-def archive(folder: List[str], dry_run: bool = False):
+@click.option("--low-disk", is_flag=True, help="Remove files as they're compressed")
+@click.option("--throttle", is_flag=True, help="Go easy on the disk for others")
+@click.option(
+    "-j",
+    "--jobs",
+    default=1,
+    type=click.IntRange(min=1),
+    help="Projects to archive at once",
+)
+def archive(
+    folder: List[str],
+    dry_run: bool = False,
+    low_disk: bool = False,
+    throttle: bool = False,
+    jobs: int = 1,
+):
     "Move an active project to the archive."
+    import dataclasses
+    from proj import logic
+
     config = _get_config()
+    if low_disk:
+        config = dataclasses.replace(config, low_disk=True)
+    if throttle:
+        config = dataclasses.replace(config, throttle=True)
 
     for f in folder:
         if not os.path.exists(f):
             bail("folder does not exist: " + f)
 
-        logic.archive(f, config, dry_run=dry_run)
+    results = logic.archive_many(folder, config, jobs=jobs, dry_run=dry_run)
+    _summarise_archived(folder, results)
+
+
+@click.command()
+@click.argument("folder", default=".")
+@click.option(
+    "--older-than",
+    default="6m",
+    show_default=True,
+    help="How long since a project was worked on, e.g. 30d, 2w, 6m or 1y",
+)
+@click.option("--archive", "and_archive", is_flag=True, help="Archive them too")
+@click.option("-n", "--dry-run", is_flag=True, help="Don't make any changes")
+@click.option(
+    "-j",
+    "--jobs",
+    default=4,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Projects to check or archive at once",
+)
+def stale(
+    folder: str = ".",
+    older_than: str = "6m",
+    and_archive: bool = False,
+    dry_run: bool = False,
+    jobs: int = 4,
+) -> None:
+    """
+    List the projects in a folder that haven't been worked on for a while,
+    and the quarter each would be archived to.
+    """
+    from proj import logic
+
+    config = _get_config()
+
+    try:
+        cutoff = logic.cutoff_for(older_than)
+        src_paths = []
+        for src_path, quarter in logic.iter_stale(folder, cutoff, config, jobs=jobs):
+            print(f"{src_path}\t{quarter}")
+            src_paths.append(src_path)
+
+    except CommandError as e:
+        bail(str(e))
+
+    if and_archive and src_paths:
+        print()
+        results = logic.archive_many(src_paths, config, jobs=jobs, dry_run=dry_run)
+        _summarise_archived(src_paths, results)
+
+
+def _summarise_archived(folder: List[str], results: List[Any]) -> None:
+    "Sum up archiving several projects, and exit with an error if any failed."
+    if len(results) > 1:
+        print("\nsummary:")
+        width = max(len(f) for f in folder)
+        for f, result in zip(folder, results):
+            if result:
+                size = format_size(result.size)
+                print(f"  {f:{width}}  {size:>10}  {result.seconds:8.1f}s")
+            else:
+                print(f"  {f:{width}}  {'failed':>10}")
+
+    if not all(results):
+        sys.exit(1)
+
+
+def _summarise_restored(folder: List[str], results: List[Any]) -> None:
+    "Sum up restoring several projects, and exit with an error if any failed."
+    if len(results) > 1:
+        print("\nsummary:")
+        width = max(len(f) for f in folder)
+        for f, result in zip(folder, results):
+            outcome = f"{result.seconds:.1f}s" if result else "failed"
+            print(f"  {f:{width}}  {outcome:>10}")
+
+    if not all(results):
+        sys.exit(1)
 
 
 @click.command()
-@click.argument("pattern", nargs=-1)
-def list(pattern: List[str]) -> None:
+@click.argument("pattern", nargs=-1, **completer(complete_projects))
+@click.option(
+    "-e", "--regex", is_flag=True, help="Treat patterns as regular expressions"
+)
+@click.option(
+    "-i", "--ignore-case", is_flag=True, help="Match patterns case-insensitively"
+)
+def list(pattern: List[str], regex: bool = False, ignore_case: bool = False) -> None:
     "List the contents of the archive directory."
+    from proj import logic
+
     config = _get_config()
 
-    projects = logic.list_projects(pattern, config)
+    try:
+        projects = logic.iter_projects(
+            pattern, config, regex=regex, ignore_case=ignore_case
+        )
+        for m in projects:
+            print(m)
 
-    for m in projects:
-        print(m)
+    except CommandError as e:
+        bail(str(e))
 
 
 @click.command()
-@click.argument("folder")
-def restore(folder: str) -> None:
-    "Restore a project from the archive into the current directory."
+@click.argument("folder", nargs=-1, required=True, **completer(complete_projects))
+@click.option(
+    "-j",
+    "--jobs",
+    default=1,
+    type=click.IntRange(min=1),
+    help="Projects to restore at once",
+)
+def restore(folder: List[str], jobs: int = 1) -> None:
+    "Restore projects from the archive into the current directory."
+    from proj import logic
+
     config = _get_config()
 
-    if os.path.exists(folder):
-        bail("a folder of the same name already exists!")
+    for f in folder:
+        if os.path.exists(f):
+            bail(f"a folder of the same name already exists: {f}")
+
+    results = logic.restore_many(folder, config, jobs=jobs)
+    _summarise_restored(folder, results)
+
 
-    logic.restore(folder, config)
+@click.command()
+@click.argument("project", **completer(complete_projects))
+@click.option("-l", "--long", is_flag=True, help="Show sizes and times too")
+def ls(project: str, long: bool = False) -> None:
+    "List the files in an archived project."
+    import time
+    from proj import logic
 
+    config = _get_config()
+
+    try:
+        _, members = logic.list_archived(project, config)
+
+    except CommandError as e:
+        bail(str(e))
+
+    for m in members:
+        # paths within the project, leaving out the project's own folder
+        rel_path = m.name.partition("/")[2]
+        if not rel_path:
+            continue
+
+        if m.type == "d":
+            rel_path += "/"
+
+        if long:
+            when = time.strftime("%Y-%m-%d %H:%M", time.localtime(m.mtime))
+            size = "" if m.type == "d" else format_size(m.size)
+            print(f"{size:>10}  {when}  {rel_path}")
+        else:
+            print(rel_path)
+
+
+@click.command()
+@click.argument("project", **completer(complete_projects))
+@click.argument("path", nargs=-1, required=True)
+@click.option(
+    "-C",
+    "--directory",
+    default=".",
+    type=click.Path(file_okay=False),
+    help="Extract into this folder",
+)
+def extract(project: str, path: List[str], directory: str = ".") -> None:
+    """
+    Get files or folders back from an archived project, without restoring
+    the rest of it. Paths are relative to the top of the project.
+    """
+    from proj import logic
+
+    config = _get_config()
+
+    try:
+        source, members = logic.extract(project, path, config, dest_dir=directory)
+
+    except CommandError as e:
+        bail(str(e))
+
+    for m in members:
+        if m.type != "d":
+            print(os.path.normpath(os.path.join(directory, m.name)))
+
+
+@click.command()
+@click.option(
+    "--full", is_flag=True, help="Rescan every quarter, not just changed ones"
+)
+def reindex(full: bool = False) -> None:
+    "Rebuild the index of archived projects."
+    from proj import logic
+
+    config = _get_config()
+
+    try:
+        rescanned, n_projects = logic.reindex(config, full=full)
+
+    except CommandError as e:
+        bail(str(e))
+
+    print(f"rescanned {rescanned} quarters, {n_projects} projects indexed")
+
+
+@click.command()
+@click.argument("folder", type=click.Path(exists=True, file_okay=False))
+@click.option(
+    "--sample",
+    default=32,
+    show_default=True,
+    help="How many MB of the project to try each format on",
+)
+def tune(folder: str, sample: int = 32) -> None:
+    """
+    Compare the compression formats on a sample of a project, to help pick
+    one for the config.
+    """
+    from proj import logic
+
+    config = _get_config()
+
+    try:
+        report = logic.tune(folder, config, sample * 1024 * 1024)
+
+    except CommandError as e:
+        bail(str(e))
+
+    print(
+        f"sampled {format_size(report.sample_size)} from {report.n_files} files "
+        f"of {format_size(report.total_size)}"
+    )
+    print(f"{'format':<8}{'level':>6}{'ratio':>8}{'MB/s':>8}{'archive':>12}")
+    for r in report.results:
+        size = format_size(report.total_size * r.ratio)
+        print(
+            f"{r.compression_format:<8}{r.level:>6}{r.ratio:>8.3f}"
+            f"{r.mb_per_s:>8.1f}{size:>12}"
+        )
+
+    print(
+        f"adaptive_compression would store {report.stored:.0%} of it uncompressed"
+    )
+
+
+@click.command()
+@click.argument("folder", default=".")
+@click.option(
+    "-j",
+    "--jobs",
+    default=8,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Delete on this many threads",
+)
+def gc(folder: str = ".", jobs: int = 8) -> None:
+    """
+    Finish deleting archived projects that are waiting in the trash, for
+    when they were archived with background_delete and the deleting was
+    interrupted.
+    """
+    from proj import logic
+
+    try:
+        emptied = logic.gc(folder, jobs)
+
+    except CommandError as e:
+        bail(str(e))
+
+    n_errors = 0
+    for project in emptied:
+        if project.error:
+            click.echo(f"error: {project.error}", err=True)
+            n_errors += 1
+            continue
+
+        print(f"removed {project.source} ({project.files} files)")
+        if project.kept:
+            click.echo(
+                f"Warning: {project.source} changed while archiving, "
+                f"its new files are in {project.kept}",
+                err=True,
+            )
+
+    if n_errors:
+        bail(f"{n_errors} trash entries couldn't be emptied")
+
+
+@click.command()
+@click.option("-n", "--dry-run", is_flag=True, help="Don't make any changes")
+@click.option(
+    "-j",
+    "--jobs",
+    default=4,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Projects to move at once",
+)
+def migrate(dry_run: bool = False, jobs: int = 4) -> None:
+    """
+    Move the quarters of the archive that have aged into a colder tier there,
+    or that a change to the tiers has put somewhere else.
+    """
+    from proj import logic
+
+    config = _get_config()
+
+    try:
+        migrations = logic.migrate(config, jobs=jobs, dry_run=dry_run)
+
+    except CommandError as e:
+        bail(str(e))
+
+    n_errors = 0
+    for m in migrations:
+        print(f"{m.quarter}: {m.src_dir} --> {m.dest_dir} ({m.projects} projects)")
+        for error in m.errors:
+            click.echo(f"error: {error}", err=True)
+        n_errors += len(m.errors)
+
+    if n_errors:
+        bail(f"{n_errors} projects couldn't be moved")
+
+
+@click.command()
+@click.option("--status", is_flag=True, help="Say whether a daemon is serving")
+def serve(status: bool = False) -> None:
+    """
+    Keep the archive catalog in memory, so that list, restore and shell
+    completion can answer straight away. Each tier of the archive gets a
+    daemon of its own. Runs until interrupted.
+    """
+    import signal
+    import threading
+    import time
+    from proj import daemon, tiers
+
+    config = _get_config()
+
+    try:
+        archive_dirs = tiers.archive_dirs(config)
+
+    except CommandError as e:
+        bail(str(e))
+
+    # colder tiers nothing has been migrated to yet have nothing to serve
+    archive_dirs = archive_dirs[:1] + [d for d in archive_dirs[1:] if os.path.isdir(d)]
+
+    if status:
+        for archive_dir in archive_dirs:
+            stat = daemon.query(archive_dir, {"op": "stat"})
+            if stat is None:
+                bail(f"not serving {archive_dir}")
+
+            loaded = time.strftime(
+                "%Y-%m-%d %H:%M:%S", time.localtime(stat["loaded_at"])
+            )
+            print(
+                f"serving {stat['projects']} projects in {stat['quarters']} quarters "
+                f"from {stat['archive_dir']}\n"
+                f"pid {stat['pid']}, watching by {stat['watching']}, loaded {loaded}"
+            )
+        return
+
+    from proj.server import Daemon
+
+    servers = []
+    try:
+        try:
+            for archive_dir in archive_dirs:
+                server = Daemon(archive_dir)
+                server.start()
+                servers.append(server)
+
+        except CommandError as e:
+            bail(str(e))
+
+        for server in servers:
+            print(f"serving {server.archive_dir} on {server.socket_path}", flush=True)
+
+        signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+        for server in servers[1:]:
+            threading.Thread(target=server.run, daemon=True).start()
+
+        servers[0].run()
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        for server in servers:
+            server.stop()
+
+
+def _get_config() -> "Config":
+    from proj.configfile import Config, NoConfigError
 
-def _get_config() -> Config:
     try:
         config = Config.autoload()
 
     except NoConfigError:
         bail(
-            "No config file found at ~/.proj.yml -- please set one up\n"
+            "No config file found at ~/.proj.yml -- please set one up, or set\n"
+            "PROJ_ARCHIVE to the archive directory\n"
             "See https://github.com/larsyencken/proj/ for an example"
         )
 
@@ -90,6 +514,29 @@ def _get_config() -> Config:
 main.add_command(archive)
 main.add_command(list)
 main.add_command(restore)
+main.add_command(ls)
+main.add_command(extract)
+main.add_command(reindex)
+main.add_command(stale)
+main.add_command(tune)
+main.add_command(gc)
+main.add_command(migrate)
+main.add_command(serve)
+
+
+def __getattr__(name: str) -> Any:
+    "Load the heavier parts of the package on first use."
+    if name in ("Config", "NoConfigError"):
+        from proj import configfile
+
+        return getattr(configfile, name)
+
+    if name == "logic":
+        import importlib
+
+        return importlib.import_module("proj.logic")
+
+    raise AttributeError(f"module 'proj' has no attribute '{name}'")
 
 
 if __name__ == "__main__":
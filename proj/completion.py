@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+#
+#  completion.py
+#  proj
+#
+
+"""
+Shell completion of archived project names.
+
+Completion runs on every keypress, so it answers straight from the archive
+index without checking the archive for changes, and imports as little as
+possible.
+"""
+
+import inspect
+import os
+from typing import Any, Callable, Dict, List, Set
+
+import click
+
+
+# more matches than this aren't useful to show in a shell
+MAX_COMPLETIONS = 200
+
+
+def complete_projects(prefix: str) -> List[str]:
+    "Archived project names starting with the prefix, from every tier."
+    from proj import tiers
+    from proj.configfile import Config
+
+    try:
+        archive_dirs = tiers.archive_dirs(Config.autoload())
+        names: Set[str] = set()
+        for archive_dir in archive_dirs:
+            names.update(_complete_in_tier(archive_dir, prefix))
+
+    except Exception:
+        # never spew errors into the user's shell
+        return []
+
+    return sorted(names)[:MAX_COMPLETIONS]
+
+
+def _complete_in_tier(archive_dir: str, prefix: str) -> List[str]:
+    from proj import daemon
+
+    served = daemon.query(
+        archive_dir, {"op": "names", "prefix": prefix, "limit": MAX_COMPLETIONS}
+    )
+    if served is not None:
+        return served
+
+    if not os.path.isdir(archive_dir):
+        return []
+
+    from proj.index import ArchiveIndex
+
+    with ArchiveIndex.open(archive_dir, refresh=False) as index:
+        return index.names_with_prefix(prefix, limit=MAX_COMPLETIONS)
+
+
+def completer(complete: Callable[[str], List[str]]) -> Dict[str, Any]:
+    """
+    Keyword arguments for a click parameter that completes with the given
+    function, in whichever way this version of click expects.
+    """
+    if "shell_complete" in inspect.signature(click.Parameter).parameters:
+        return {
+            "shell_complete": lambda ctx, param, incomplete: complete(incomplete)
+        }
+
+    return {"autocompletion": lambda ctx, args, incomplete: complete(incomplete)}
@@ -0,0 +1,1079 @@
+# -*- coding: utf-8 -*-
+#
+#  compress.py
+#  proj
+#
+
+"""
+Compression backends for archiving projects.
+
+Zip files are made by shutil. Tarballs are streamed from a single walk of
+the project, and for gzip, bzip2 and xz the tar stream is cut into
+fixed-size blocks in the style of pigz and pbzip2. These are compressed
+independently on a pool of threads (zlib, bz2 and lzma all release the GIL),
+and written out as a multi-member file that gzip, bzip2, xz and tar can read
+as normal.
+
+In adaptive mode, each block is first trial-compressed on a small sample,
+and blocks that barely compress (media, wheels, other archives) are stored
+rather than compressed. Given a speed to keep up, the level is also lowered
+or raised as we go to match it.
+
+Because every block starts a new member, restoring can find the member
+boundaries again and decompress them in parallel too. Gzipped tarballs also
+end with an index of their members and blocks (see seekable.py), so they can
+be listed and have single files extracted without decompressing the rest.
+"""
+
+import bz2
+import datetime as dt
+import gzip
+import io
+import lzma
+import os
+import random
+import re
+import threading
+import time
+import shutil
+import struct
+import tarfile
+import zipfile
+import zlib
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import (
+    BinaryIO,
+    Callable,
+    Deque,
+    Generator,
+    Iterator,
+    List,
+    Optional,
+    Pattern,
+    Set,
+    Tuple,
+    Type,
+)
+
+from proj import dedup, fs, metrics, throttle
+from proj.exceptions import CommandError, PartialArchiveError
+from proj.seekable import Member, SeekableIndex, read_index, write_index
+
+
+# how much compressed data to read at a time when hunting for members
+READ_SIZE = 1024 * 1024
+
+# buffer sizes for reading source files and writing the archive
+READ_BUFFER = 1024 * 1024
+WRITE_BUFFER = 16 * 1024 * 1024
+
+# in low disk mode, how much source data to archive between committing the
+# archive to disk and removing the files written so far
+LOW_DISK_COMMIT_SIZE = 64 * 1024 * 1024
+
+# give up looking for member boundaries if a member gets this big, since the
+# file probably wasn't written by us
+MAX_MEMBER_SIZE = 64 * 1024 * 1024
+
+
+# id, deflate, FEXTRA, mtime 0, no flags, unknown OS, XLEN 8, "PX", LEN 4
+GZIP_MAGIC = b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x08\x00PX\x04\x00"
+
+# "BZh" and the level, followed by the magic number that starts every bzip2
+# block; adaptive mode writes members at any level
+BZ2_MAGIC = re.compile(rb"BZh[1-9]\x31\x41\x59\x26\x53\x59")
+
+# the xz header for streams with a CRC32 check, which is what we write
+XZ_MAGIC = b"\xfd7zXZ\x00\x00\x01" + struct.pack("<I", zlib.crc32(b"\x00\x01"))
+
+# at least as long as any of the above, to find one split across reads
+MAGIC_SIZE = 32
+
+# in adaptive mode, trial-compress this much of each block, and store the
+# block if the sample doesn't shrink below this ratio
+SAMPLE_SIZE = 64 * 1024
+STORE_RATIO = 0.95
+
+# the levels of each format that `proj tune` tries, and how much of each file
+# it samples, at least
+TUNE_LEVELS = {"gztar": [1, 6, 9], "bztar": [1, 9], "xztar": [0, 6]}
+TUNE_SLICE = 64 * 1024
+
+
+def _gzip_member(data: bytes, level: int) -> bytes:
+    """
+    Compress a block as a complete gzip member. The header carries a "PX"
+    extra field with the size of the member, like BGZF does, which gives every
+    member the same recognisable prefix.
+    """
+    c = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    body = c.compress(data) + c.flush()
+    size = len(GZIP_MAGIC) + 4 + len(body) + 8
+    trailer = struct.pack("<II", zlib.crc32(data), len(data) & 0xFFFFFFFF)
+    return GZIP_MAGIC + struct.pack("<I", size) + body + trailer
+
+
+def _xz_member(data: bytes, level: int) -> bytes:
+    return lzma.compress(
+        data, format=lzma.FORMAT_XZ, check=lzma.CHECK_CRC32, preset=level
+    )
+
+
+def _xz_stored(data: bytes) -> bytes:
+    """
+    A complete xz stream holding the data as it is, in LZMA2's uncompressed
+    chunks, since even xz's fastest preset crawls through random data.
+    """
+    # header size, no flags, one LZMA2 filter with a 4 KiB dictionary
+    block_header = b"\x02\x00\x21\x01\x00\x00\x00\x00"
+    block_header += struct.pack("<I", zlib.crc32(block_header))
+
+    # LZMA2 chunks of up to 64 KiB, the first resetting the dictionary
+    body = bytearray()
+    for i in range(0, len(data), 65536):
+        piece = data[i : i + 65536]
+        body += b"\x01" if i == 0 else b"\x02"
+        body += struct.pack(">H", len(piece) - 1) + piece
+    body += b"\x00"
+
+    block = block_header + body + _xz_padding(len(block_header) + len(body))
+    block += struct.pack("<I", zlib.crc32(data))
+
+    unpadded_size = len(block_header) + len(body) + 4
+    index = b"\x00" + _xz_varint(1) + _xz_varint(unpadded_size)
+    index += _xz_varint(len(data))
+    index += _xz_padding(len(index))
+    index += struct.pack("<I", zlib.crc32(index))
+
+    footer = struct.pack("<I", len(index) // 4 - 1) + b"\x00\x01"
+    footer = struct.pack("<I", zlib.crc32(footer)) + footer + b"YZ"
+
+    return XZ_MAGIC + bytes(block) + index + footer
+
+
+def _xz_varint(n: int) -> bytes:
+    out = bytearray()
+    while n >= 0x80:
+        out.append(n & 0x7F | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def _xz_padding(n: int) -> bytes:
+    return b"\x00" * (-n % 4)
+
+
+@dataclass(frozen=True)
+class Codec:
+    # where each member starts
+    magic: Pattern[bytes]
+    block_size: int
+    # the default level, and the fastest one adaptive mode may drop to
+    level: int
+    fastest: int
+    compress: Callable[[bytes, int], bytes]
+    # encode a block that doesn't compress, as cheaply as possible
+    store: Callable[[bytes], bytes]
+    decompress: Callable[[bytes], bytes]
+    open: Callable[[BinaryIO], BinaryIO]
+    # what decompress() raises for a member cut in the wrong place
+    errors: Tuple[Type[Exception], ...]
+    # whether archives end with an index of their members
+    seekable: bool = False
+
+
+CODECS = {
+    "gztar": Codec(
+        magic=re.compile(re.escape(GZIP_MAGIC)),
+        block_size=1024 * 1024,
+        level=9,
+        fastest=1,
+        compress=_gzip_member,
+        store=lambda data: _gzip_member(data, 0),
+        decompress=gzip.decompress,
+        open=lambda f: gzip.GzipFile(fileobj=f, mode="rb"),  # type: ignore
+        errors=(OSError, EOFError, zlib.error),
+        seekable=True,
+    ),
+    "bztar": Codec(
+        magic=BZ2_MAGIC,
+        # one stream per bzip2 block at the highest level
+        block_size=900 * 1000,
+        level=9,
+        fastest=1,
+        compress=bz2.compress,
+        # bzip2 can't store data as it is, so this is the best we can do
+        store=lambda data: bz2.compress(data, 1),
+        decompress=bz2.decompress,
+        open=lambda f: bz2.BZ2File(f, mode="rb"),  # type: ignore
+        errors=(OSError, EOFError, ValueError),
+    ),
+    "xztar": Codec(
+        magic=re.compile(re.escape(XZ_MAGIC)),
+        # xz finds more to share in bigger blocks
+        block_size=4 * 1024 * 1024,
+        level=6,
+        fastest=0,
+        compress=_xz_member,
+        store=_xz_stored,
+        decompress=lzma.decompress,
+        open=lambda f: lzma.LZMAFile(f, mode="rb"),  # type: ignore
+        errors=(lzma.LZMAError, EOFError),
+    ),
+}
+
+EXTENSIONS = {
+    ".tar.gz": "gztar",
+    ".tar.bz2": "bztar",
+    ".tar.xz": "xztar",
+}
+
+TAR_FORMATS = {"tar", "gztar", "bztar", "xztar"}
+
+
+def resolve_threads(threads: int) -> int:
+    "A thread count of zero means to use every core."
+    return threads if threads > 0 else (os.cpu_count() or 1)
+
+
+def make_archive(
+    src_path: str,
+    dest_path: str,
+    compression_format: str,
+    threads: int = 1,
+    remove_source: bool = False,
+    low_disk: bool = False,
+    write_buffer: int = WRITE_BUFFER,
+    scan: Optional[Callable[[str, bool], fs.DirScan]] = None,
+    chunk_store: Optional[str] = None,
+    adaptive: bool = False,
+    speed: float = 0,
+    trash_dir: Optional[str] = None,
+) -> str:
+    """
+    Archive the folder at src_path to dest_path plus the extension for the
+    format, returning the archive's filename. Within the archive, everything
+    lives under a folder named after src_path.
+
+    Tarballs can be made with a different scan function for the walk (see
+    fs.scan_tree), and anything it leaves out of the archive is removed with
+    the rest of the source. Zip files always hold everything.
+
+    Tarballs are streamed: the source tree is walked once, and if asked to
+    remove the source, the files seen on that walk are removed once the
+    archive is safely on disk. In low disk mode, they are removed as soon as
+    their contents have been committed, which keeps peak disk usage close to
+    the size of the source.
+
+    In adaptive mode, blocks of the tarball that don't compress are stored,
+    and the level follows the speed in MB/s per thread, if given.
+
+    The dedup format writes a manifest, keeping the contents in chunk_store
+    (see dedup.py). Its chunks are written before the source is removed, so
+    there's no need for a low disk mode.
+
+    Given a trash_dir, the source is moved there to be deleted later instead
+    of being removed (see trash.py).
+    """
+    threads = resolve_threads(threads)
+
+    if compression_format == "dedup":
+        return dedup.make_archive(
+            src_path,
+            dest_path + fs.SUPPORTED_FORMATS["dedup"],
+            _open_store(chunk_store),
+            threads=threads,
+            remove_source=remove_source,
+            scan=scan,
+            trash_dir=trash_dir,
+        )
+
+    if compression_format not in TAR_FORMATS:
+        root_dir, base_dir = os.path.split(os.path.abspath(src_path))
+        dest_filename = shutil.make_archive(
+            dest_path, compression_format, root_dir, base_dir
+        )
+        if remove_source:
+            with metrics.phase("remove"):
+                if trash_dir:
+                    from proj import trash
+
+                    trash.discard(src_path, trash_dir)
+                else:
+                    shutil.rmtree(src_path)
+
+        metrics.count(bytes_written=os.path.getsize(dest_filename))
+        return dest_filename
+
+    dest_filename = dest_path + fs.SUPPORTED_FORMATS[compression_format]
+    with open(dest_filename, "wb", buffering=write_buffer) as ostream:
+        writer: BinaryIO = ostream  # type: ignore
+        codec = CODECS.get(compression_format)
+        if codec:
+            writer = BlockWriter(  # type: ignore
+                ostream, codec, threads, adaptive=adaptive, speed=speed
+            )
+
+        archive = StreamingArchive(writer, ostream, remove_source, low_disk)
+        try:
+            archive.add_tree(src_path, scan=scan)
+            archive.close()
+
+        except Exception as e:
+            if archive.removed:
+                raise PartialArchiveError(
+                    f"archiving failed after removing some files from {src_path}; "
+                    f"they are in the partial archive {dest_filename}"
+                ) from e
+            raise
+
+        finally:
+            writer.close()
+
+    with metrics.phase("remove"):
+        archive.remove_source(trash_dir)
+
+    return dest_filename
+
+
+def unpack_archive(
+    filename: str,
+    extract_dir: str,
+    threads: int = 1,
+    chunk_store: Optional[str] = None,
+) -> None:
+    "Unpack an archive made by any backend into extract_dir."
+    threads = resolve_threads(threads)
+    if filename.endswith(fs.SUPPORTED_FORMATS["dedup"]):
+        store = _open_store(chunk_store)
+        dedup.unpack_archive(filename, extract_dir, store, threads=threads)
+        return
+
+    compression_format = _format_for(filename)
+    metrics.count(bytes_read=os.path.getsize(filename))
+
+    if threads > 1 and compression_format in CODECS:
+        codec = CODECS[compression_format]
+        with open(filename, "rb") as istream:
+            chunks = _decompress_parallel(istream, codec, threads)
+            reader = io.BufferedReader(ChunkReader(chunks), READ_SIZE)
+            with tarfile.open(fileobj=reader, mode="r|") as tar:
+                tar.extractall(extract_dir)
+        return
+
+    shutil.unpack_archive(filename, extract_dir)
+
+
+def list_members(filename: str) -> List[Member]:
+    """
+    List what's in an archived project, which can be an archive in any format
+    or a plain folder. Gzipped tarballs with an index are listed straight from
+    it; anything else has to be read in full.
+    """
+    index = read_index(filename) if filename.endswith(".tar.gz") else None
+    if index:
+        return index.members
+
+    if os.path.isdir(filename):
+        return _list_folder(filename)
+
+    if filename.endswith(fs.SUPPORTED_FORMATS["dedup"]):
+        return dedup.list_members(filename)
+
+    if filename.endswith(".zip"):
+        with zipfile.ZipFile(filename) as zf:
+            return [_zip_member(info) for info in zf.infolist()]
+
+    with tarfile.open(filename) as tar:
+        return [Member.from_tarinfo(tarinfo) for tarinfo in tar]
+
+
+def extract_members(
+    filename: str,
+    paths: List[str],
+    dest_dir: str,
+    chunk_store: Optional[str] = None,
+) -> List[Member]:
+    """
+    Extract the files and folders at the given paths, relative to the top of
+    the project, into dest_dir, returning everything extracted. Folders come
+    with everything in them. Won't overwrite existing files.
+
+    Gzipped tarballs with an index only decompress the blocks holding what's
+    wanted; anything else is read until everything has been found.
+    """
+    index = read_index(filename) if filename.endswith(".tar.gz") else None
+    members = index.members if index else list_members(filename)
+    selected = select_members(members, paths)
+
+    for m in selected:
+        dest = os.path.join(dest_dir, m.name)
+        if m.type != "d" and os.path.lexists(dest):
+            raise CommandError(f"won't overwrite existing file: {dest}")
+
+    if index:
+        _extract_indexed(filename, index, selected, dest_dir)
+
+    elif os.path.isdir(filename):
+        _copy_from_folder(filename, selected, dest_dir)
+
+    elif filename.endswith(fs.SUPPORTED_FORMATS["dedup"]):
+        names = {m.name for m in selected}
+        dedup.extract_members(filename, names, dest_dir, _open_store(chunk_store))
+
+    elif filename.endswith(".zip"):
+        with zipfile.ZipFile(filename) as zf:
+            for m in selected:
+                zf.extract(m.name + "/" if m.type == "d" else m.name, dest_dir)
+
+    else:
+        with tarfile.open(filename) as tar:
+            _extract_from_tar(tar, {m.name for m in selected}, dest_dir)
+
+    return selected
+
+
+def select_members(members: List[Member], paths: List[str]) -> List[Member]:
+    """
+    Pick out the members at each path relative to the top of the project,
+    and everything under any folders among them.
+    """
+    wanted = [p.strip("/") for p in paths]
+    selected = []
+    found: Set[str] = set()
+    for m in members:
+        # drop the project's own folder from the front
+        rel_path = m.name.partition("/")[2]
+        for p in wanted:
+            if rel_path == p or rel_path.startswith(p + "/"):
+                selected.append(m)
+                found.add(p)
+                break
+
+    missing = [p for p in wanted if p not in found]
+    if missing:
+        raise CommandError(f"not in the archive: {', '.join(missing)}")
+
+    return selected
+
+
+def _extract_indexed(
+    filename: str, index: SeekableIndex, selected: List[Member], dest_dir: str
+) -> None:
+    """
+    Extract members by decompressing just the blocks that hold them. Members
+    close together are read in one run, to avoid decompressing the blocks
+    between them twice.
+    """
+    # each member runs until the next one starts
+    offsets = sorted(m.offset for m in index.members)
+    ends = dict(zip(offsets, offsets[1:]))
+
+    runs: List[List[Member]] = []
+    last_block = -2
+    for m in sorted(selected, key=lambda m: m.offset):
+        if index.block_at(m.offset) > last_block + 1:
+            runs.append([])
+        runs[-1].append(m)
+
+        end = ends.get(m.offset, m.offset + tarfile.BLOCKSIZE + m.size)
+        last_block = index.block_at(end - 1)
+
+    with open(filename, "rb") as istream:
+        for run in runs:
+            chunks = _read_blocks(istream, index, run[0].offset)
+            reader = io.BufferedReader(ChunkReader(chunks), READ_SIZE)
+            with tarfile.open(fileobj=reader, mode="r|") as tar:  # type: ignore
+                _extract_from_tar(tar, {m.name for m in run}, dest_dir)
+
+
+def _read_blocks(
+    istream: BinaryIO, index: SeekableIndex, offset: int
+) -> Iterator[bytes]:
+    "Decompress blocks in order, starting from an offset into the tar stream."
+    first = index.block_at(offset)
+    skip = offset - index.blocks[first][1]
+    for i in range(first, len(index.blocks)):
+        start, end = index.block_extent(i)
+        istream.seek(start)
+        data = gzip.decompress(istream.read(end - start))
+        metrics.count(bytes_read=end - start, syscalls=2)
+
+        yield data[skip:]
+        skip = 0
+
+
+def _extract_from_tar(tar: tarfile.TarFile, names: Set[str], dest_dir: str) -> None:
+    "Extract the named members from a tar stream, stopping once we have them."
+    names = set(names)
+    for tarinfo in tar:
+        if tarinfo.name in names:
+            tar.extract(tarinfo, dest_dir)
+            names.discard(tarinfo.name)
+            if not names:
+                break
+
+
+def _list_folder(folder: str) -> List[Member]:
+    "List a plain folder in the archive as if it were an archive."
+    root_dir = os.path.dirname(os.path.abspath(folder))
+    members = []
+    for scan in fs.scan_tree(folder):
+        st = os.stat(scan.path)
+        name = os.path.relpath(scan.path, root_dir).replace(os.sep, "/")
+        members.append(Member(name, "d", 0, int(st.st_mtime), 0))
+        for entry in scan.files + scan.dir_links:
+            st = entry.stat(follow_symlinks=False)
+            type_ = "l" if entry.is_symlink() else "f"
+            size = 0 if type_ == "l" else st.st_size
+            members.append(
+                Member(f"{name}/{entry.name}", type_, size, int(st.st_mtime), 0)
+            )
+
+    return members
+
+
+def _copy_from_folder(folder: str, selected: List[Member], dest_dir: str) -> None:
+    root_dir = os.path.dirname(os.path.abspath(folder))
+    for m in selected:
+        src = os.path.join(root_dir, m.name)
+        dest = os.path.join(dest_dir, m.name)
+        if m.type == "d":
+            fs.mkdir(dest)
+        else:
+            fs.mkdir(os.path.dirname(dest))
+            shutil.copy2(src, dest, follow_symlinks=False)
+
+
+def _zip_member(info: zipfile.ZipInfo) -> Member:
+    mtime = int(dt.datetime(*info.date_time).timestamp())
+    if info.is_dir():
+        return Member(info.filename.rstrip("/"), "d", 0, mtime, 0)
+
+    return Member(info.filename, "f", info.file_size, mtime, 0)
+
+
+def _open_store(chunk_store: Optional[str]) -> dedup.ChunkStore:
+    if not chunk_store:
+        raise ValueError("the dedup format needs a chunk store")
+
+    return dedup.ChunkStore(chunk_store)
+
+
+@dataclass
+class TuneResult:
+    compression_format: str
+    level: int
+    # compressed size over original size
+    ratio: float
+    # on a single thread
+    mb_per_s: float
+
+
+@dataclass
+class TuneReport:
+    # how much we sampled, from how many files, of how big a project
+    sample_size: int
+    n_files: int
+    total_size: int
+    results: List[TuneResult]
+    # the share of blocks adaptive mode would store rather than compress
+    stored: float
+
+
+def tune(
+    src_path: str,
+    sample_size: int,
+    scan: Optional[Callable[[str, bool], fs.DirScan]] = None,
+) -> TuneReport:
+    """
+    Compress a sample of a project block by block, the way archiving would,
+    with each format and a few levels of each.
+    """
+    sample, n_files, total_size = sample_files(src_path, sample_size, scan=scan)
+
+    results = []
+    for compression_format, levels in TUNE_LEVELS.items():
+        codec = CODECS[compression_format]
+        blocks = _blocks_of(sample, codec.block_size)
+        for level in levels:
+            start = time.perf_counter()
+            size = sum(len(codec.compress(block, level)) for block in blocks)
+            seconds = time.perf_counter() - start
+            results.append(
+                TuneResult(
+                    compression_format,
+                    level,
+                    ratio=size / len(sample) if sample else 1.0,
+                    mb_per_s=len(sample) / seconds / 2**20 if seconds else 0.0,
+                )
+            )
+
+    blocks = _blocks_of(sample, CODECS["gztar"].block_size)
+    stored = sum(not compresses(block) for block in blocks) / max(len(blocks), 1)
+
+    return TuneReport(len(sample), n_files, total_size, results, stored)
+
+
+def sample_files(
+    src_path: str,
+    sample_size: int,
+    scan: Optional[Callable[[str, bool], fs.DirScan]] = None,
+) -> Tuple[bytes, int, int]:
+    """
+    Sample the contents of a project, taking the same share of each file, in
+    a random order, until we have enough. Returns the sample, the number of
+    files it came from and the size of the whole project.
+    """
+    files = []
+    for folder in fs.scan_tree(src_path, scan=scan):
+        for entry in folder.files:
+            if entry.is_file(follow_symlinks=False):
+                files.append((entry.path, entry.stat(follow_symlinks=False).st_size))
+
+    total = sum(size for _, size in files)
+    share = sample_size / total if total else 1.0
+    random.Random(0).shuffle(files)
+
+    sample = bytearray()
+    n_files = 0
+    for path, size in files:
+        if len(sample) >= sample_size:
+            break
+
+        want = min(size, max(TUNE_SLICE, int(size * share)), sample_size - len(sample))
+        try:
+            with open(path, "rb") as istream:
+                sample += istream.read(want)
+
+        except OSError:
+            continue
+
+        n_files += 1
+
+    return bytes(sample), n_files, total
+
+
+def _blocks_of(data: bytes, block_size: int) -> List[bytes]:
+    return [data[i : i + block_size] for i in range(0, len(data), block_size)]
+
+
+def _format_for(filename: str) -> Optional[str]:
+    for ext, compression_format in EXTENSIONS.items():
+        if filename.endswith(ext):
+            return compression_format
+
+    return None
+
+
+class StreamingArchive:
+    """
+    Writes a tarball from a single walk of the source tree, keeping track of
+    what it has written so that the source can be removed without walking it
+    again.
+    """
+
+    def __init__(
+        self,
+        writer: BinaryIO,
+        ostream: BinaryIO,
+        remove_source: bool = False,
+        low_disk: bool = False,
+    ) -> None:
+        self.writer = writer
+        self.ostream = ostream
+        self.low_disk = low_disk
+        self.remove = remove_source or low_disk
+        self.tar = tarfile.open(fileobj=writer, mode="w:")  # type: ignore
+        self.tar.copybufsize = READ_BUFFER  # type: ignore
+        self.seekable = isinstance(writer, BlockWriter) and writer.codec.seekable
+        self.members: List[Member] = []
+        self.src_path: Optional[str] = None
+
+        # files and folders written to the archive but not yet removed, and
+        # those left out of it on purpose
+        self.written: List[str] = []
+        self.dirs: List[str] = []
+        self.ignored: List[os.DirEntry] = []
+        self.uncommitted = 0
+        self.committed = 0
+        self.removed = False
+
+    def add_tree(
+        self,
+        src_path: str,
+        scan: Optional[Callable[[str, bool], fs.DirScan]] = None,
+    ) -> None:
+        self.src_path = src_path
+        base_dir = os.path.basename(os.path.abspath(src_path))
+
+        if not os.path.isdir(src_path) or os.path.islink(src_path):
+            self.add(src_path, base_dir)
+            return
+
+        for folder in fs.scan_tree(src_path, scan=scan):
+            rel_path = os.path.relpath(folder.path, src_path)
+            arc_dir = os.path.normpath(os.path.join(base_dir, rel_path))
+
+            tarinfo = self.tar.gettarinfo(folder.path, arc_dir)
+            self.members.append(Member.from_tarinfo(tarinfo, self.tar.offset))
+            self.tar.addfile(tarinfo)
+            self.dirs.append(folder.path)
+            self.ignored.extend(folder.ignored)
+
+            for entry in folder.files + folder.dir_links:
+                self.add(entry.path, os.path.join(arc_dir, entry.name))
+
+    def add(self, path: str, arcname: str) -> None:
+        tarinfo = self.tar.gettarinfo(path, arcname)
+        if tarinfo is None:
+            # sockets and the like can't be archived, so leave them be
+            return
+
+        self.members.append(Member.from_tarinfo(tarinfo, self.tar.offset))
+        if tarinfo.isreg():
+            with throttle.open_file(path, buffering=READ_BUFFER) as istream:
+                self.tar.addfile(tarinfo, istream)
+            self.uncommitted += tarinfo.size
+            # the lstat, open and close
+            metrics.count(bytes_read=tarinfo.size, syscalls=3)
+        else:
+            self.tar.addfile(tarinfo)
+            metrics.count(syscalls=1)
+
+        self.written.append(path)
+
+        if self.low_disk and self.uncommitted >= LOW_DISK_COMMIT_SIZE:
+            self.commit()
+            self._remove_files()
+
+    def close(self) -> None:
+        self.tar.close()
+        if self.seekable:
+            self.writer.flush()
+            index = SeekableIndex(
+                self.members,
+                self.writer.blocks,  # type: ignore
+                data_end=self.ostream.tell(),
+            )
+            write_index(self.ostream, index)
+
+        self.commit()
+
+    def commit(self) -> None:
+        "Make sure everything written so far is durably on disk."
+        self.writer.flush()
+        self.ostream.flush()
+        metrics.count(bytes_written=self.ostream.tell() - self.committed, syscalls=1)
+        self.committed = self.ostream.tell()
+        os.fsync(self.ostream.fileno())
+        # throttled, nobody needs the archive in the page cache
+        throttle.forget(self.ostream.fileno())
+        self.uncommitted = 0
+
+    def remove_source(self, trash_dir: Optional[str] = None) -> None:
+        if not self.remove:
+            return
+
+        if trash_dir and self.src_path:
+            from proj import trash
+
+            trash.discard(
+                self.src_path, trash_dir, self.written, self.dirs, self.ignored
+            )
+            return
+
+        self._remove_files()
+        fs.remove_walked([], self.dirs, self.ignored)
+
+    def _remove_files(self) -> None:
+        fs.remove_walked(self.written, [])
+        self.removed = self.removed or bool(self.written)
+        self.written.clear()
+
+
+class BlockWriter(io.RawIOBase):
+    """
+    A file-like object which compresses everything written to it in blocks on
+    a pool of threads, writing the compressed blocks to ostream in order.
+
+    In adaptive mode, blocks that don't compress are stored instead, and the
+    level follows the given speed in MB/s per thread, if any.
+    """
+
+    def __init__(
+        self,
+        ostream: BinaryIO,
+        codec: Codec,
+        threads: int,
+        adaptive: bool = False,
+        speed: float = 0,
+    ) -> None:
+        self.ostream = ostream
+        self.codec = codec
+        self.threads = threads
+        self.chooser = LevelChooser(codec, speed) if adaptive else None
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+        self.pending: Deque[Tuple[int, Future]] = deque()
+        self.buf = bytearray()
+        self.written = 0
+
+        # where each block starts in ostream, and in the uncompressed stream
+        self.blocks: List[Tuple[int, int]] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        "The number of uncompressed bytes written so far."
+        return self.written
+
+    def flush(self) -> None:
+        "Compress any partial block and write out every pending block."
+        if self.closed:
+            return
+
+        if self.buf:
+            self._submit(bytes(self.buf))
+            self.buf.clear()
+
+        while self.pending:
+            self._write_next()
+
+    def write(self, b) -> int:  # type: ignore
+        self.buf += b
+        self.written += len(b)
+        block_size = self.codec.block_size
+        while len(self.buf) >= block_size:
+            self._submit(bytes(self.buf[:block_size]))
+            del self.buf[:block_size]
+
+        return len(b)
+
+    def close(self) -> None:
+        if self.closed:
+            return
+
+        try:
+            self.flush()
+
+        finally:
+            self.pool.shutdown()
+            super().close()
+
+    def _submit(self, block: bytes) -> None:
+        # the buffer holds everything written that isn't in a block yet
+        start = self.written - len(self.buf)
+        compress: Callable[[bytes, int], bytes] = self.codec.compress
+        level = self.codec.level
+        if self.chooser:
+            compress, level = self._compress_adaptive, self.chooser.level
+
+        self.pending.append((start, self.pool.submit(compress, block, level)))
+
+        # bound memory use by keeping only a couple of blocks per thread around
+        while len(self.pending) > 2 * self.threads:
+            self._write_next()
+
+    def _write_next(self) -> None:
+        start, future = self.pending.popleft()
+        self.blocks.append((self.ostream.tell(), start))
+        self.ostream.write(future.result())
+
+    def _compress_adaptive(self, block: bytes, level: int) -> bytes:
+        if not compresses(block):
+            return self.codec.store(block)
+
+        start = time.perf_counter()
+        data = self.codec.compress(block, level)
+        self.chooser.record(level, len(block), time.perf_counter() - start)  # type: ignore
+        return data
+
+
+class LevelChooser:
+    """
+    Picks the level to compress each block at: the highest that keeps up with
+    the speed asked for, stepping down when blocks compress too slowly and
+    back up when they compress with time to spare. Without a speed to keep
+    up, it sticks to the codec's usual level.
+    """
+
+    # how much faster than needed counts as time to spare
+    HEADROOM = 2.0
+
+    def __init__(self, codec: Codec, speed: float = 0) -> None:
+        self.codec = codec
+        self.bytes_per_s = speed * 2**20
+        self.level = codec.level
+        self.lock = threading.Lock()
+
+    def record(self, level: int, n_bytes: int, seconds: float) -> None:
+        "Learn from how long a block took at a given level."
+        if not self.bytes_per_s or seconds <= 0:
+            return
+
+        rate = n_bytes / seconds
+        with self.lock:
+            if level != self.level:
+                # other blocks have already moved us on
+                return
+
+            if rate < self.bytes_per_s and self.level > self.codec.fastest:
+                self.level -= 1
+            elif rate > self.bytes_per_s * self.HEADROOM:
+                self.level = min(self.level + 1, self.codec.level)
+
+
+def compresses(data: bytes) -> bool:
+    """
+    Whether data is worth compressing, judged by how well a few slices of it
+    compress at zlib's fastest level.
+    """
+    if len(data) <= SAMPLE_SIZE:
+        sample = data
+    else:
+        # a quarter of the sample from each of four places
+        step = (len(data) - SAMPLE_SIZE // 4) // 3
+        size = SAMPLE_SIZE // 4
+        sample = b"".join(data[i * step : i * step + size] for i in range(4))
+
+    if not sample:
+        return False
+
+    return len(zlib.compress(sample, 1)) < STORE_RATIO * len(sample)
+
+
+class ChunkReader(io.RawIOBase):
+    "A readable file-like object over an iterator of byte strings."
+
+    def __init__(self, chunks: Iterator[bytes]) -> None:
+        self.chunks = chunks
+        self.current = b""
+        self.pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:  # type: ignore
+        while self.pos >= len(self.current):
+            try:
+                self.current = next(self.chunks)
+            except StopIteration:
+                return 0
+
+            self.pos = 0
+
+        n = min(len(b), len(self.current) - self.pos)
+        b[:n] = self.current[self.pos : self.pos + n]
+        self.pos += n
+        return n
+
+
+def _decompress_parallel(
+    istream: BinaryIO, codec: Codec, threads: int
+) -> Iterator[bytes]:
+    """
+    Decompress a multi-member file, farming members out to a pool of threads
+    and yielding their contents in order.
+
+    Member boundaries are found by their magic prefix. If that goes wrong,
+    because a member is huge or the prefix showed up by chance inside the
+    compressed data, we fall back to decompressing sequentially from the
+    last good boundary.
+    """
+    restart_at: Optional[int] = None
+    failed: Optional[int] = None
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        pending: Deque[Tuple[int, Future]] = deque()
+        for offset, member in _split_members(istream, codec.magic):
+            if member is None:
+                restart_at = offset
+                break
+
+            pending.append((offset, pool.submit(codec.decompress, member)))
+            failed = yield from _results(pending, codec, keep=2 * threads)
+            if failed is not None:
+                break
+
+        if failed is None:
+            failed = yield from _results(pending, codec, keep=0)
+
+        for _, future in pending:
+            future.cancel()
+
+    if failed is not None:
+        restart_at = failed
+
+    if restart_at is not None:
+        istream.seek(restart_at)
+        reader = codec.open(istream)
+        while True:
+            chunk = reader.read(READ_SIZE)
+            if not chunk:
+                break
+
+            yield chunk
+
+
+def _results(
+    pending: Deque[Tuple[int, Future]], codec: Codec, keep: int
+) -> Generator[bytes, None, Optional[int]]:
+    """
+    Yield finished members in order until only `keep` are still pending.
+    Returns the offset of the first member that failed to decompress.
+    """
+    while len(pending) > keep:
+        offset, future = pending.popleft()
+        try:
+            data = future.result()
+
+        except codec.errors:
+            return offset
+
+        yield data
+
+    return None
+
+
+def _split_members(
+    istream: BinaryIO, magic: Pattern[bytes]
+) -> Iterator[Tuple[int, Optional[bytes]]]:
+    """
+    Cut a compressed file into (offset, member) pairs at each occurrence of
+    the magic prefix. If a member grows too large without finding the next
+    one, yield (offset, None) and stop.
+    """
+    buf = bytearray()
+    offset = 0
+    searched = 1
+    eof = False
+
+    while True:
+        match = magic.search(buf, searched)
+        i = match.start() if match else -1
+        if i > 0:
+            yield offset, bytes(buf[:i])
+            del buf[:i]
+            offset += i
+            searched = 1
+            continue
+
+        if eof:
+            if buf:
+                yield offset, bytes(buf)
+            return
+
+        if len(buf) > MAX_MEMBER_SIZE:
+            yield offset, None
+            return
+
+        searched = max(1, len(buf) - MAGIC_SIZE + 1)
+        data = istream.read(READ_SIZE)
+        if not data:
+            eof = True
+
+        buf += data
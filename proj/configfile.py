@@ -4,41 +4,146 @@
 #  proj
 #
 
-from typing import Optional
-from dataclasses import dataclass
+import json
+import os
+import time
+from typing import Any, Dict, List, Optional
+from dataclasses import asdict, dataclass, field
 from os import path
 
-import yaml
-
 from proj import fs
 
 
 DEFAULT_CONFIG_PATH = "~/.proj.yml"
 
+# setting this skips reading the config file entirely
+ARCHIVE_ENV_VAR = "PROJ_ARCHIVE"
+
+# parsed config files are cached here, keyed on their mtime and size
+CACHE_FILENAME = "config-cache.json"
+
+# deduplicated archives keep their chunks in this folder of the archive
+CHUNKS_DIR = ".chunks"
+
+# restored projects' archives are kept in this folder of the archive, if the
+# config asks (see restorecache.py)
+RESTORE_CACHE_DIR = ".restore-cache"
+
+# a config file changed twice within this long might keep the same mtime,
+# so don't cache it until it has settled
+CACHE_GRACE_NS = 2 * 10 ** 9
+
 
 @dataclass
 class Config:
     archive_dir: str = "_archive"
+
+    # colder places for older quarters, each with an archive_dir and the age
+    # in quarters from which a quarter belongs there (see tiers.py)
+    tiers: List[Dict[str, Any]] = field(default_factory=list)
+
     compression: bool = False
     compression_format: Optional[str] = None
 
+    # how many cores to compress and decompress with, or 0 to use them all
+    compression_threads: int = 1
+
+    # remove each file as soon as the archive holding it is safely on disk
+    low_disk: bool = False
+
+    # once a project is safely archived, move it to a trash folder beside it
+    # and delete it in the background, rather than waiting (see trash.py)
+    background_delete: bool = False
+
+    # store parts of tarballs that don't compress, like photos, videos and
+    # other archives, rather than compressing them
+    adaptive_compression: bool = False
+
+    # with adaptive compression, lower the level as needed to compress at
+    # least this many MB/s per thread, or 0 to always use the usual level
+    compression_speed: float = 0
+
+    # archive gently on a busy machine, at low priority, keeping our reads
+    # out of the page cache and backing off when they're slow (see throttle.py)
+    throttle: bool = False
+
+    # in throttled mode, read at most this many MB and make at most this many
+    # reads a second, or 0 for no limit
+    throttle_mb_per_s: float = 0
+    throttle_iops: float = 0
+
+    # keep the archives of restored projects, up to this many MB, so that
+    # archiving one again unchanged just moves its archive back
+    restore_cache_mb: int = 0
+
+    # bytes to buffer before writing to the archive
+    write_buffer: int = 16 * 1024 * 1024
+
+    # remember each project's folders between runs, so that walking it again
+    # only needs to stat folders; misses files edited in place (see treecache)
+    mtime_cache: bool = False
+
+    # shell-style patterns for files and folders that don't count as work on
+    # a project, like node_modules; projects can add more in a .projignore
+    ignore: List[str] = field(default_factory=list)
+
+    # also leave ignored files out of compressed archives, deleting them
+    exclude_ignored: bool = False
+
+    # how to tell when a project was last worked on: "mtime" for the newest
+    # file in it, or "git" to use git's records for repositories
+    activity: str = "mtime"
+
     @classmethod
     def autoload(cls) -> "Config":
+        archive_dir = os.environ.get(ARCHIVE_ENV_VAR)
+        if archive_dir:
+            return cls(archive_dir=archive_dir)
+
         filename = cls._get_config_file()
-        return cls.load(filename)
+        return cls.load_cached(filename, _cache_file())
 
     @classmethod
     def load(cls, filename: str) -> "Config":
+        import yaml
+
+        # the C loader is much faster, if PyYAML was built with it
+        loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
         with open(filename) as istream:
-            doc = yaml.safe_load(istream)
+            doc = yaml.load(istream, Loader=loader)
             return cls(**doc)
 
+    @classmethod
+    def load_cached(cls, filename: str, cache_file: str) -> "Config":
+        """
+        Load a config file, reusing the parsed copy in the cache file if the
+        config hasn't changed since, which saves importing and running yaml.
+        """
+        st = os.stat(filename)
+        key = [path.abspath(filename), st.st_mtime_ns, st.st_size]
+
+        try:
+            with open(cache_file) as istream:
+                cached = json.load(istream)
+
+            if cached["key"] == key:
+                return cls(**cached["config"])
+
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+        config = cls.load(filename)
+
+        if time.time_ns() - st.st_mtime_ns > CACHE_GRACE_NS:
+            _write_cache(cache_file, {"key": key, "config": asdict(config)})
+
+        return config
+
     def save(self, filename: str) -> None:
-        record = {
-            "archive_dir": self.archive_dir,
-            "compression": self.compression,
-            "compression_format": self.compression_format,
-        }
+        import yaml
+
+        record = asdict(self)
         with open(filename, "w") as ostream:
             yaml.dump(record, ostream)
 
@@ -57,6 +162,35 @@ class Config:
 
         return fs.SUPPORTED_FORMATS[self.compression_format]
 
+    @property
+    def chunk_store(self) -> str:
+        "Where the dedup format keeps the chunks of every project."
+        return path.join(self.archive_dir, CHUNKS_DIR)
+
+    @property
+    def restore_cache(self) -> str:
+        "Where the archives of restored projects are kept."
+        return path.join(self.archive_dir, RESTORE_CACHE_DIR)
+
 
 class NoConfigError(Exception):
     pass
+
+
+def cache_dir() -> str:
+    "Where proj keeps caches that are safe to delete."
+    base_dir = os.environ.get("XDG_CACHE_HOME") or path.expanduser("~/.cache")
+    return path.join(base_dir, "proj")
+
+
+def _cache_file() -> str:
+    return path.join(cache_dir(), CACHE_FILENAME)
+
+
+def _write_cache(cache_file: str, record: dict) -> None:
+    "Write the cache atomically, and don't worry if we can't."
+    try:
+        fs.write_atomic(cache_file, json.dumps(record).encode("utf8"))
+
+    except OSError:
+        pass
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+#
+#  daemon.py
+#  proj
+#
+
+"""
+Talking to a running `proj serve` daemon, which keeps the archive catalog in
+memory (see server.py) for editor plugins and dashboards that ask about the
+archive many times a minute.
+
+Requests and answers go over a Unix socket, one line of JSON each way:
+
+    {"op": "list", "patterns": ["crusty"], "regex": false, "ignore_case": false}
+    {"result": ["2012/q3/old-crusty-project"]}
+
+The ops are `list`, `find` (the archived copies of each of some names),
+`names` (for shell completion), `stat` and `refresh`. The CLI tries the
+daemon first and quietly falls back to the index if it isn't running, so
+this module is kept light enough to import on every run.
+"""
+
+import json
+import os
+import socket
+import zlib
+from typing import Any, Dict, Optional
+
+from proj.exceptions import CommandError
+
+
+# how long the CLI waits for an answer before doing the work itself
+CLIENT_TIMEOUT = 2.0
+
+
+def socket_path(archive_dir: str) -> str:
+    "Where the daemon for an archive listens, one socket per archive."
+    from proj.configfile import cache_dir
+
+    base_dir = os.environ.get("XDG_RUNTIME_DIR") or cache_dir()
+    key = zlib.crc32(os.path.abspath(archive_dir).encode("utf8"))
+    return os.path.join(base_dir, f"proj-serve-{key:08x}.sock")
+
+
+def query(archive_dir: str, request: Dict[str, Any]) -> Optional[Any]:
+    """
+    Ask the daemon for an archive, returning its answer, or None if no daemon
+    is running or it couldn't answer, in which case do the work yourself.
+    Errors in the request itself, like a bad pattern, raise CommandError.
+    """
+    filename = socket_path(archive_dir)
+    if not os.path.exists(filename):
+        return None
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(CLIENT_TIMEOUT)
+            sock.connect(filename)
+            sock.sendall(json.dumps(request).encode("utf8") + b"\n")
+            with sock.makefile("rb") as istream:
+                response = json.loads(istream.readline())
+
+    except (OSError, ValueError):
+        return None
+
+    if "error" in response:
+        raise CommandError(response["error"])
+
+    return response.get("result")
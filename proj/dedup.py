@@ -0,0 +1,419 @@
+# -*- coding: utf-8 -*-
+#
+#  dedup.py
+#  proj
+#
+
+"""
+A deduplicating backend for archiving projects, for archives full of
+projects that share the same libraries, dependencies and datasets.
+
+Each file is cut into chunks by its content, and each chunk is stored once,
+compressed, in a store shared by the whole archive and named by its
+SHA-256. A project is archived as a small manifest listing its files and
+the chunks they're made of, so archiving a project whose files are mostly
+in the store already means hashing them and little else.
+
+Chunk boundaries are content-defined, so inserting a few bytes into a big
+file only changes the chunks around the insertion. Rather than rolling a
+hash over every byte, which is painfully slow in Python, we look for a cut
+at each newline, and cut there if the CRC of the bytes just before it has
+its low bits clear. Files without newlines, such as runs of zeros, are cut
+at the maximum chunk size.
+
+New chunks are written under temporary names, then fsynced in one batch
+and renamed into place once every file has been read, and the manifest is
+written only after that. Chunks are trusted by name, so one never appears
+under its name before its contents are on disk, and a manifest never refers
+to a chunk that isn't.
+
+Restoring a project or removing its manifest leaves its chunks in the
+store, since other projects may share them.
+"""
+
+import contextlib
+import gzip
+import hashlib
+import json
+import os
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import astuple, dataclass, field
+from typing import BinaryIO, Callable, Dict, Iterator, List, Optional, Set
+
+from proj import fs, metrics, throttle
+from proj.seekable import Member
+
+
+MANIFEST_VERSION = 1
+
+MIN_CHUNK = 16 * 1024
+MAX_CHUNK = 1024 * 1024
+
+# cut at a newline when the CRC of the WINDOW bytes before it has CUT_BITS
+# low bits clear
+ANCHOR = b"\n"
+WINDOW = 48
+CUT_BITS = 10
+
+# chunks are stored with a one-byte tag saying how
+ZLIB_TAG = b"z"
+RAW_TAG = b"r"
+
+
+@dataclass
+class Entry:
+    # the path, starting with the project's own folder, like in a tarball
+    name: str
+    # d for folders, f for files, l for symlinks
+    type: str
+    mode: int
+    mtime: float
+    size: int
+    # the chunks of a file, in order
+    chunks: List[str] = field(default_factory=list)
+    # what a symlink points to
+    target: str = ""
+
+    def to_member(self) -> Member:
+        return Member(self.name, self.type, self.size, int(self.mtime), 0)
+
+
+class ChunkStore:
+    def __init__(self, root: str, level: int = 6) -> None:
+        self.root = root
+        self.level = level
+
+        # chunks we've seen on disk or written, so we check each only once
+        self.known: Set[str] = set()
+        self.lock = threading.Lock()
+
+        # the temporary files of chunks written but not yet committed
+        self.pending: Dict[str, str] = {}
+
+    def path_for(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest[2:])
+
+    def put(self, data: bytes) -> str:
+        """
+        Store a chunk if it isn't stored already, returning its name. A new
+        chunk is only readable through this store until it is committed.
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        with self.lock:
+            if digest in self.known:
+                return digest
+
+            # claim it, so that another thread with the same chunk doesn't
+            # write it too
+            self.known.add(digest)
+
+        filename = self.path_for(digest)
+        metrics.count(syscalls=1)
+        tmp_file = None
+        try:
+            if not os.path.exists(filename):
+                packed = zlib.compress(data, self.level)
+                if len(packed) < len(data):
+                    tmp_file = _write_tmp(filename, ZLIB_TAG + packed)
+                else:
+                    tmp_file = _write_tmp(filename, RAW_TAG + data)
+
+        except BaseException:
+            with self.lock:
+                self.known.discard(digest)
+            raise
+
+        if tmp_file:
+            with self.lock:
+                self.pending[digest] = tmp_file
+
+        return digest
+
+    def commit(self, threads: int = 1) -> None:
+        """
+        Make the chunks written since the last commit durable: fsync them all,
+        rename them into place, then fsync the folders holding them.
+        """
+        with self.lock:
+            pending = dict(self.pending)
+
+        if not pending:
+            return
+
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            list(pool.map(_fsync, pending.values()))
+
+        for digest, tmp_file in pending.items():
+            os.replace(tmp_file, self.path_for(digest))
+            with self.lock:
+                del self.pending[digest]
+
+        folders = {os.path.dirname(self.path_for(digest)) for digest in pending}
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            list(pool.map(_fsync, sorted(folders) + [self.root]))
+
+        metrics.count(syscalls=4 * len(pending) + 3 * (len(folders) + 1))
+
+    def abort(self) -> None:
+        "Remove the chunks written since the last commit."
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.known.difference_update(pending)
+
+        for tmp_file in pending.values():
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(tmp_file)
+
+    def get(self, digest: str) -> bytes:
+        filename = self.pending.get(digest) or self.path_for(digest)
+        with open(filename, "rb") as istream:
+            packed = istream.read()
+
+        metrics.count(bytes_read=len(packed), syscalls=3)
+        tag, data = packed[:1], packed[1:]
+        if tag == ZLIB_TAG:
+            return zlib.decompress(data)
+
+        if tag == RAW_TAG:
+            return data
+
+        raise ValueError(f"corrupt chunk: {digest}")
+
+
+def make_archive(
+    src_path: str,
+    dest_filename: str,
+    store: ChunkStore,
+    threads: int = 1,
+    remove_source: bool = False,
+    scan: Optional[Callable[[str, bool], fs.DirScan]] = None,
+    trash_dir: Optional[str] = None,
+) -> str:
+    """
+    Archive a folder into the store, writing its manifest to dest_filename
+    once every chunk is safely on disk. The source is walked once, with a
+    different scan function if given (see fs.scan_tree), and anything it
+    leaves out is removed with the rest of the source, or moved to trash_dir
+    with it to be deleted later.
+    """
+    src_path = os.path.abspath(src_path)
+    base_dir = os.path.basename(src_path)
+    entries: List[Entry] = []
+    files: List[str] = []
+    dirs: List[str] = []
+    ignored: List[os.DirEntry] = []
+
+    try:
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            pending = []
+            if not os.path.isdir(src_path) or os.path.islink(src_path):
+                pending.append(pool.submit(_store_file, src_path, base_dir, store))
+                files.append(src_path)
+            else:
+                for folder in fs.scan_tree(src_path, scan=scan):
+                    rel_path = os.path.relpath(folder.path, src_path)
+                    arc_dir = os.path.normpath(os.path.join(base_dir, rel_path))
+                    arc_dir = arc_dir.replace(os.sep, "/")
+                    entries.append(_entry_for(folder.path, arc_dir))
+                    dirs.append(folder.path)
+                    ignored.extend(folder.ignored)
+
+                    for entry in folder.files + folder.dir_links:
+                        # sockets and the like can't be archived, so leave them
+                        if not _is_archivable(entry):
+                            continue
+
+                        name = f"{arc_dir}/{entry.name}"
+                        pending.append(
+                            pool.submit(_store_file, entry.path, name, store)
+                        )
+                        files.append(entry.path)
+
+            entries.extend(future.result() for future in pending)
+
+        with metrics.phase("sync"):
+            store.commit(threads=threads)
+
+    except BaseException:
+        # no manifest will refer to the chunks
+        store.abort()
+        raise
+
+    with metrics.phase("manifest"):
+        write_manifest(dest_filename, entries)
+
+    if remove_source:
+        with metrics.phase("remove"):
+            if trash_dir:
+                from proj import trash
+
+                trash.discard(src_path, trash_dir, files, dirs, ignored)
+            else:
+                fs.remove_walked(files, dirs, ignored)
+
+    return dest_filename
+
+
+def unpack_archive(
+    filename: str, extract_dir: str, store: ChunkStore, threads: int = 1
+) -> None:
+    "Restore every file and folder in a manifest into extract_dir."
+    _materialise(read_manifest(filename), extract_dir, store, threads)
+
+
+def list_members(filename: str) -> List[Member]:
+    return [e.to_member() for e in read_manifest(filename)]
+
+
+def extract_members(
+    filename: str, names: Set[str], extract_dir: str, store: ChunkStore
+) -> None:
+    "Restore just the named files and folders in a manifest into extract_dir."
+    entries = [e for e in read_manifest(filename) if e.name in names]
+    _materialise(entries, extract_dir, store)
+
+
+def iter_chunks(istream: BinaryIO) -> Iterator[bytes]:
+    "Cut a file into content-defined chunks."
+    buf = b""
+    eof = False
+    while True:
+        while not eof and len(buf) < MAX_CHUNK:
+            data = istream.read(MAX_CHUNK)
+            eof = not data
+            buf += data
+
+        if not buf:
+            return
+
+        cut = _find_cut(buf) if not eof or len(buf) > MIN_CHUNK else len(buf)
+        yield buf[:cut]
+        buf = buf[cut:]
+
+
+def write_manifest(filename: str, entries: List[Entry]) -> None:
+    record = {
+        "version": MANIFEST_VERSION,
+        "entries": [astuple(e) for e in entries],
+    }
+    data = gzip.compress(json.dumps(record, separators=(",", ":")).encode("utf8"))
+    _write_durably(filename, data)
+
+
+def read_manifest(filename: str) -> List[Entry]:
+    with gzip.open(filename, "rb") as istream:
+        record = json.load(istream)
+
+    if record.get("version") != MANIFEST_VERSION:
+        raise ValueError(f"unsupported manifest version: {filename}")
+
+    return [Entry(*e) for e in record["entries"]]
+
+
+def _find_cut(buf: bytes) -> int:
+    "Where to end the chunk at the start of the buffer."
+    limit = min(len(buf), MAX_CHUNK)
+    mask = (1 << CUT_BITS) - 1
+    i = buf.find(ANCHOR, MIN_CHUNK, limit)
+    while i >= 0:
+        if not zlib.crc32(buf[i - WINDOW : i]) & mask:
+            return i + 1
+
+        i = buf.find(ANCHOR, i + 1, limit)
+
+    return limit
+
+
+def _is_archivable(entry: os.DirEntry) -> bool:
+    return entry.is_symlink() or entry.is_file(follow_symlinks=False)
+
+
+def _store_file(path: str, name: str, store: ChunkStore) -> Entry:
+    entry = _entry_for(path, name)
+    if entry.type == "f":
+        with throttle.open_file(path) as istream:
+            entry.chunks = [store.put(chunk) for chunk in iter_chunks(istream)]
+
+        metrics.count(bytes_read=entry.size, syscalls=3)
+
+    return entry
+
+
+def _entry_for(path: str, name: str) -> Entry:
+    st = os.lstat(path)
+    if os.path.islink(path):
+        return Entry(name, "l", 0o777, st.st_mtime, 0, target=os.readlink(path))
+
+    mode = st.st_mode & 0o7777
+    if os.path.isdir(path):
+        return Entry(name, "d", mode, st.st_mtime, 0)
+
+    return Entry(name, "f", mode, st.st_mtime, st.st_size)
+
+
+def _materialise(
+    entries: List[Entry], extract_dir: str, store: ChunkStore, threads: int = 1
+) -> None:
+    dirs = [e for e in entries if e.type == "d"]
+    for e in dirs:
+        fs.mkdir(os.path.join(extract_dir, e.name))
+
+    def restore(e: Entry) -> None:
+        dest = os.path.join(extract_dir, e.name)
+        fs.mkdir(os.path.dirname(dest))
+        if e.type == "l":
+            os.symlink(e.target, dest)
+            return
+
+        with open(dest, "wb") as ostream:
+            for digest in e.chunks:
+                ostream.write(store.get(digest))
+
+        os.chmod(dest, e.mode)
+        os.utime(dest, (e.mtime, e.mtime))
+        metrics.count(bytes_written=e.size)
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(restore, [e for e in entries if e.type != "d"]))
+
+    # restoring files changes their folders, so fix folders up last
+    for e in reversed(dirs):
+        dest = os.path.join(extract_dir, e.name)
+        os.chmod(dest, e.mode)
+        os.utime(dest, (e.mtime, e.mtime))
+
+
+def _write_durably(filename: str, data: bytes) -> None:
+    "Write a file whole, fsyncing it before it's under its name and its folder after."
+    tmp_file = _write_tmp(filename, data)
+    try:
+        _fsync(tmp_file)
+        os.replace(tmp_file, filename)
+        _fsync(os.path.dirname(os.path.abspath(filename)))
+        metrics.count(syscalls=5)
+
+    finally:
+        if os.path.exists(tmp_file):
+            os.unlink(tmp_file)
+
+
+def _write_tmp(filename: str, data: bytes) -> str:
+    "Write a file under a temporary name beside where it's going."
+    fs.mkdir(os.path.dirname(filename))
+    tmp_file = f"{filename}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_file, "wb") as ostream:
+        ostream.write(data)
+
+    metrics.count(bytes_written=len(data), syscalls=3)
+    return tmp_file
+
+
+def _fsync(path: str) -> None:
+    "Flush a file or folder to disk."
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
@@ -8,3 +8,8 @@
 class CommandError(Exception):
     "An expected error type with a helpful message for the user."
     pass
+
+
+class PartialArchiveError(CommandError):
+    "Archiving failed after removing files that only the partial archive holds."
+    pass
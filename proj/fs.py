@@ -8,19 +8,57 @@
 Filesystem operations.
 """
 
+import errno
 import os
-from typing import Iterator
-
-import arrow
+import shutil
+import stat
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import (
+    TYPE_CHECKING,
+    Callable,
+    Generator,
+    Iterator,
+    List,
+    Optional,
+    Set,
+)
 
+from proj import metrics, throttle
 from proj.exceptions import CommandError
 
+# arrow is slow to import, so times are plain timestamps in here and only
+# become Arrow objects at the edges
+if TYPE_CHECKING:  # pragma: no cover
+    import arrow
+
 
 SUPPORTED_FORMATS = {
     "bztar": ".tar.bz2",
     "gztar": ".tar.gz",
     "zip": ".zip",
     "tar": ".tar",
+    "xztar": ".tar.xz",
+    "dedup": ".dedup",
+}
+
+# directory listings are latency-bound, so overlap many of them at once
+WALK_THREADS = 16
+
+# files to copy at once when moving between filesystems, and how much of
+# each to copy per system call
+COPY_THREADS = 8
+COPY_CHUNK = 8 * 1024 * 1024
+
+UNSUPPORTED_COPY_ERRORS = {
+    errno.ENOSYS,
+    errno.EXDEV,
+    errno.EINVAL,
+    errno.EBADF,
+    errno.ENOTSUP,
+    errno.EOPNOTSUPP,
 }
 
 
@@ -33,10 +71,17 @@ def mkdir(p: str) -> None:
         parent_dir = os.path.dirname(stack[-1])
         stack.append(parent_dir)
 
+    metrics.count(syscalls=len(stack))
     while stack:
         p = stack.pop()
         if not isdir(p):
-            os.mkdir(p)
+            try:
+                metrics.count(syscalls=1)
+                os.mkdir(p)
+            except FileExistsError:
+                # someone else may be making the same folder at the same time
+                if not isdir(p):
+                    raise
 
 
 def is_compressed(path: str) -> bool:
@@ -52,33 +97,389 @@ def trim_archive_extension(path: str) -> str:
     return path
 
 
-def last_modified(file_or_folder: str) -> arrow.Arrow:
+def last_modified(file_or_folder: str) -> "arrow.Arrow":
     "Work out when the most recent file in a folder was modified."
-    try:
-        return max(
-            mtime(f) for f in iter_files(file_or_folder) if not os.path.islink(f)
-        )
+    import arrow
 
-    except ValueError:
+    stats = tree_stats(file_or_folder)
+    if stats.latest is None:
         raise CommandError(f"no files in folder: {file_or_folder}")
 
+    return arrow.get(stats.latest)
+
+
+@dataclass
+class TreeStats:
+    "A summary of the files in a folder, not counting symlinks."
+    latest: Optional[float] = None
+    size: int = 0
+    files: int = 0
+
+
+def tree_stats(
+    file_or_folder: str,
+    scan: Optional[Callable[[str, bool], "DirScan"]] = None,
+    stop_after: Optional[float] = None,
+) -> TreeStats:
+    """
+    Find the newest mtime and total size of the files in a folder, optionally
+    listing each folder with a different scan function (see scan_tree).
+
+    If we only need to know whether anything is newer than `stop_after`, the
+    walk stops as soon as it finds something, leaving the size and number of
+    files incomplete.
+    """
+    stats = TreeStats()
+
+    if os.path.isdir(file_or_folder):
+        walk = scan_tree(file_or_folder, stat=True, scan=scan)
+        for folder in walk:
+            stats.size += folder.size
+            stats.files += folder.n_files
+            if folder.latest is not None and (
+                stats.latest is None or folder.latest > stats.latest
+            ):
+                stats.latest = folder.latest
+
+                if stop_after is not None and stats.latest > stop_after:
+                    walk.close()
+                    break
+
+    elif not os.path.islink(file_or_folder):
+        st = os.stat(file_or_folder)
+        metrics.count(files_visited=1, syscalls=2)
+        stats = TreeStats(latest=st.st_mtime, size=st.st_size, files=1)
+
+    return stats
+
 
 def iter_files(file_or_folder: str) -> Iterator[str]:
     "Walk the given path and iterate over all files within it."
     if os.path.isdir(file_or_folder):
-        for dirname, subdirs, filenames in os.walk(file_or_folder):
-            for basename in filenames:
-                filename = os.path.join(dirname, basename)
-                yield filename
+        for scan in scan_tree(file_or_folder):
+            for entry in scan.files:
+                yield entry.path
     else:
         # it's actually just a file
         yield file_or_folder
 
 
-def mtime(filename: str) -> arrow.Arrow:
+@dataclass
+class DirScan:
+    "The result of listing a single directory during a walk."
+    path: str
+    files: List[os.DirEntry] = field(default_factory=list)
+    subdirs: List[str] = field(default_factory=list)
+
+    # symlinks to directories, which are never followed
+    dir_links: List[os.DirEntry] = field(default_factory=list)
+
+    # entries left out by the walk's ignore rules, and never descended into
+    ignored: List[os.DirEntry] = field(default_factory=list)
+
+    # the newest mtime and total size of the files directly inside this
+    # directory, only filled in when the walk is asked to stat files
+    latest: Optional[float] = None
+    size: int = 0
+    n_files: int = 0
+
+
+def scan_tree(
+    top: str,
+    stat: bool = False,
+    threads: int = WALK_THREADS,
+    scan: Optional[Callable[[str, bool], DirScan]] = None,
+) -> Generator[DirScan, None, None]:
+    """
+    Walk a directory tree, listing subdirectories concurrently in a thread pool.
+
+    Like os.walk(), symlinks to directories are reported as neither files nor
+    subdirectories and never descended into, and unreadable directories are
+    silently skipped. Each directory is yielded before any of its children,
+    but siblings may arrive in any order.
+
+    Each directory is listed with scan_dir(), unless another `scan` function
+    is given, e.g. one that can answer from a cache.
+    """
+    scan_dir_ = scan or scan_dir
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        pending: Set[Future] = {pool.submit(scan_dir_, top, stat)}
+        try:
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    result = future.result()
+                    for subdir in result.subdirs:
+                        pending.add(pool.submit(scan_dir_, subdir, stat))
+
+                    yield result
+
+        finally:
+            # the caller may stop early, so don't wait on the rest of the tree
+            for future in pending:
+                future.cancel()
+
+
+def scan_dir(
+    path: str, stat: bool, ignore: Optional[Callable[[str, bool], bool]] = None
+) -> DirScan:
+    """
+    List a single directory, and if asked, stat the files directly inside it.
+    Entries for which ignore(name, is_dir) is true are set aside unstatted.
+    """
+    scan = DirScan(path)
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+
+                if ignore and ignore(entry.name, is_dir):
+                    scan.ignored.append(entry)
+                elif not is_dir:
+                    scan.files.append(entry)
+                elif entry.is_symlink():
+                    scan.dir_links.append(entry)
+                else:
+                    scan.subdirs.append(entry.path)
+
+    except OSError:
+        return scan
+
+    metrics.count(files_visited=len(scan.files), syscalls=1)
+    if stat:
+        for entry in scan.files:
+            if entry.is_symlink():
+                continue
+
+            try:
+                metrics.count(syscalls=1)
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+
+            scan.size += st.st_size
+            scan.n_files += 1
+            if scan.latest is None or st.st_mtime > scan.latest:
+                scan.latest = st.st_mtime
+
+    return scan
+
+
+def mtime(filename: str) -> "arrow.Arrow":
+    import arrow
+
     return arrow.get(os.stat(filename).st_mtime)
 
 
+@dataclass
+class MoveStats:
+    "What it took to move a file or folder."
+    renamed: bool
+    files: int = 0
+    size: int = 0
+    seconds: float = 0.0
+
+    @property
+    def rate(self) -> float:
+        "Bytes copied per second."
+        return self.size / self.seconds if self.seconds > 0 else 0.0
+
+
+def move(src: str, dest: str, threads: int = COPY_THREADS) -> MoveStats:
+    """
+    Move a file or folder to dest, which must not exist yet. Within a
+    filesystem this is a single rename. Across filesystems, files are copied
+    in parallel (without passing through Python where the OS allows it),
+    keeping their permissions and mtimes, and then the original is removed.
+    """
+    if os.path.lexists(dest):
+        raise CommandError(f"file or directory already exists at: {dest}")
+
+    dest_dir = os.path.dirname(os.path.abspath(dest))
+    metrics.count(syscalls=3)
+    if os.lstat(src).st_dev == os.stat(dest_dir).st_dev:
+        try:
+            metrics.count(syscalls=1)
+            os.rename(src, dest)
+            return MoveStats(renamed=True)
+
+        except OSError as e:
+            # e.g. bind mounts of the same device
+            if e.errno != errno.EXDEV:
+                raise
+
+    start = time.monotonic()
+    with metrics.phase("copy"):
+        stats = copy_tree(src, dest, threads=threads)
+
+    with metrics.phase("remove"):
+        if os.path.isdir(src) and not os.path.islink(src):
+            # an unlink per file, not counting the folders
+            metrics.count(syscalls=stats.files)
+            shutil.rmtree(src)
+        else:
+            os.unlink(src)
+
+    stats.seconds = time.monotonic() - start
+    return stats
+
+
+def copy_tree(src: str, dest: str, threads: int = COPY_THREADS) -> MoveStats:
+    "Copy a file or folder, preserving permissions and mtimes."
+    stats = MoveStats(renamed=False)
+
+    if not os.path.isdir(src) or os.path.islink(src):
+        stats.size = _copy_entry(src, dest)
+        stats.files = 1
+        return stats
+
+    dirs = []
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        copies = []
+        for scan in scan_tree(src):
+            dest_dir = os.path.join(dest, os.path.relpath(scan.path, src))
+            metrics.count(syscalls=1)
+            os.mkdir(os.path.normpath(dest_dir))
+            dirs.append((scan.path, dest_dir))
+
+            for entry in scan.files + scan.dir_links:
+                target = os.path.join(dest_dir, entry.name)
+                copies.append(pool.submit(_copy_entry, entry.path, target))
+
+        for future in copies:
+            stats.size += future.result()
+            stats.files += 1
+
+    # copying files into a folder changes its mtime, so set these last
+    metrics.count(syscalls=3 * len(dirs))
+    for src_dir, dest_dir in reversed(dirs):
+        shutil.copystat(src_dir, dest_dir)
+
+    return stats
+
+
+def _copy_entry(src: str, dest: str) -> int:
+    "Copy a single file or symlink, returning the number of bytes copied."
+    if os.path.islink(src):
+        # an lstat, a readlink and a symlink
+        metrics.count(syscalls=3)
+        os.symlink(os.readlink(src), dest)
+        return 0
+
+    if not stat.S_ISREG(os.stat(src).st_mode):
+        raise CommandError(f"cannot copy special file: {src}")
+
+    with open(src, "rb") as istream, open(dest, "wb") as ostream:
+        size = _copy_data(istream.fileno(), ostream.fileno())
+
+    # the lstat and stat above, two opens and two closes; copystat's calls
+    # vary by platform and by what the file has to copy, so aren't counted
+    metrics.count(syscalls=6)
+    shutil.copystat(src, dest)
+    return size
+
+
+def _copy_data(infd: int, outfd: int) -> int:
+    """
+    Copy everything from one file descriptor to another, in the kernel if
+    possible: copy_file_range() can even share blocks on filesystems that
+    support it, and sendfile() avoids copying through user space.
+    """
+    copied = 0
+    # throttled, copy in smaller pieces so that none of them hogs the disk
+    chunk = COPY_CHUNK if throttle.active() is None else throttle.CHUNK
+    for method in ["copy_file_range", "sendfile"]:
+        if not hasattr(os, method):
+            continue
+
+        try:
+            while True:
+                start = time.perf_counter()
+                if method == "copy_file_range":
+                    n = os.copy_file_range(  # type: ignore
+                        infd, outfd, chunk, copied, copied
+                    )
+                else:
+                    os.lseek(outfd, copied, os.SEEK_SET)
+                    n = os.sendfile(outfd, infd, copied, chunk)
+
+                metrics.count(syscalls=1, bytes_read=n, bytes_written=n)
+                throttle.copied(infd, outfd, copied, n, time.perf_counter() - start)
+                if n == 0:
+                    return copied
+
+                copied += n
+
+        except OSError as e:
+            # not supported for this pair of files, try the next way
+            if e.errno not in UNSUPPORTED_COPY_ERRORS:
+                raise
+
+    os.lseek(infd, copied, os.SEEK_SET)
+    os.lseek(outfd, copied, os.SEEK_SET)
+    while True:
+        start = time.perf_counter()
+        buf = os.read(infd, chunk)
+        seconds = time.perf_counter() - start
+        metrics.count(syscalls=1, bytes_read=len(buf))
+        if not buf:
+            return copied
+
+        view = memoryview(buf)
+        while view:
+            n = os.write(outfd, view)
+            metrics.count(syscalls=1, bytes_written=n)
+            view = view[n:]
+
+        throttle.copied(infd, outfd, copied, len(buf), seconds)
+        copied += len(buf)
+
+
+def remove_walked(
+    files: List[str], dirs: List[str], ignored: Optional[List[os.DirEntry]] = None
+) -> None:
+    """
+    Remove what a walk of a tree found: its files, anything it set aside as
+    ignored, then its folders. Folders must be in the order they were walked,
+    parents first. A folder that gained files in the meantime is left alone.
+    """
+    metrics.count(syscalls=len(files))
+    for path in files:
+        os.unlink(path)
+
+    for entry in ignored or []:
+        metrics.count(syscalls=1)
+        if entry.is_dir(follow_symlinks=False):
+            shutil.rmtree(entry.path)
+        else:
+            os.unlink(entry.path)
+
+    for path in reversed(dirs):
+        try:
+            metrics.count(syscalls=1)
+            os.rmdir(path)
+        except OSError:
+            pass
+
+
+def write_atomic(filename: str, data: bytes) -> None:
+    "Replace a file's contents in one go, so readers never see half of it."
+    mkdir(os.path.dirname(filename))
+    tmp_file = f"{filename}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_file, "wb") as ostream:
+            ostream.write(data)
+
+        os.replace(tmp_file, filename)
+
+    finally:
+        if os.path.exists(tmp_file):
+            os.unlink(tmp_file)
+
+
 def touch(filename: str) -> None:
     with open(filename, "a"):
         pass
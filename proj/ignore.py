@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+#
+#  ignore.py
+#  proj
+#
+
+"""
+Rules for files and folders that don't count as real work on a project, like
+node_modules or __pycache__, so that walking a project can skip them.
+
+Rules are shell-style patterns, from the `ignore` list in the config plus a
+`.projignore` file at the top of the project, one per line:
+
+- a pattern without a slash matches a name at any depth, e.g. `*.pyc`
+- a pattern with a slash matches a path from the top of the project, e.g.
+  `.git/objects` or `/build`
+- a trailing slash only matches folders, e.g. `target/`
+
+Blank lines and lines starting with # are skipped.
+"""
+
+import fnmatch
+import os
+import re
+from typing import Callable, List, Optional
+
+from proj import fs
+
+
+IGNORE_FILENAME = ".projignore"
+
+
+class IgnoreRules:
+    def __init__(self, root: str, patterns: List[str]) -> None:
+        self.root = root
+        self.patterns = patterns
+
+        # names and paths, for files and folders alike or for folders only
+        names: List[str] = []
+        dir_names: List[str] = []
+        paths: List[str] = []
+        dir_paths: List[str] = []
+        for pattern in patterns:
+            dirs_only = pattern.endswith("/")
+            pattern = pattern.rstrip("/")
+            if "/" in pattern:
+                (dir_paths if dirs_only else paths).append(pattern.lstrip("/"))
+            else:
+                (dir_names if dirs_only else names).append(pattern)
+
+        self._names = _compile(names)
+        self._dir_names = _compile(names + dir_names)
+        self._paths = _compile(paths)
+        self._dir_paths = _compile(paths + dir_paths)
+
+    @classmethod
+    def for_project(
+        cls, root: str, patterns: Optional[List[str]] = None
+    ) -> Optional["IgnoreRules"]:
+        """
+        The rules for a project, combining the given patterns with any in its
+        .projignore, or None if there are none.
+        """
+        patterns = list(patterns or [])
+        patterns += read_patterns(os.path.join(root, IGNORE_FILENAME))
+        if not patterns:
+            return None
+
+        return cls(root, patterns)
+
+    @property
+    def fingerprint(self) -> str:
+        "Changes whenever the rules do."
+        return "\n".join(self.patterns)
+
+    def for_dir(self, path: str) -> Callable[[str, bool], bool]:
+        "A test of whether each name in a folder of the project is ignored."
+        rel_dir = os.path.relpath(path, self.root).replace(os.sep, "/")
+        prefix = "" if rel_dir == "." else f"{rel_dir}/"
+
+        def ignores(name: str, is_dir: bool) -> bool:
+            names, paths = (
+                (self._dir_names, self._dir_paths)
+                if is_dir
+                else (self._names, self._paths)
+            )
+            if names and names.match(name):
+                return True
+
+            return bool(paths and paths.match(prefix + name))
+
+        return ignores
+
+    def scan_dir(self, path: str, stat: bool) -> fs.DirScan:
+        "List a folder like fs.scan_dir(), leaving out what's ignored."
+        return fs.scan_dir(path, stat, ignore=self.for_dir(path))
+
+
+def read_patterns(filename: str) -> List[str]:
+    "Read the patterns in an ignore file, if there is one."
+    try:
+        with open(filename) as istream:
+            lines = [line.strip() for line in istream]
+
+    except OSError:
+        return []
+
+    return [line for line in lines if line and not line.startswith("#")]
+
+
+def _compile(patterns: List[str]) -> Optional["re.Pattern[str]"]:
+    if not patterns:
+        return None
+
+    return re.compile("|".join(fnmatch.translate(p) for p in patterns))
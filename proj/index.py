@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+#
+#  index.py
+#  proj
+#
+
+"""
+A persistent index of the archive, so that listing and restoring projects
+doesn't need to glob every year and quarter folder.
+
+The index lives in a SQLite file at the top of the archive directory. It
+records the mtime of every year/quarter folder it has scanned; when a
+folder's mtime drifts (something was added or removed behind our back), only
+that quarter is listed again.
+"""
+
+import os
+import sqlite3
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from proj import fs
+
+
+INDEX_FILENAME = ".proj-index.sqlite"
+
+# filesystems with coarse timestamps can change a folder twice within the
+# same mtime, so we never trust an mtime this close to the time of the scan
+MTIME_GRACE_NS = 2 * 10 ** 9
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS projects (
+    quarter TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    name TEXT NOT NULL,
+    PRIMARY KEY (quarter, filename)
+);
+CREATE INDEX IF NOT EXISTS projects_by_name ON projects (name);
+CREATE TABLE IF NOT EXISTS quarters (
+    quarter TEXT PRIMARY KEY,
+    mtime_ns INTEGER
+);
+"""
+
+
+class ArchiveIndex:
+    def __init__(self, archive_dir: str, conn: sqlite3.Connection) -> None:
+        self.archive_dir = archive_dir
+        self.conn = conn
+
+    @classmethod
+    def open(cls, archive_dir: str, refresh: bool = True) -> "ArchiveIndex":
+        "Open the index for an archive, by default bringing it up to date first."
+        filename = os.path.join(archive_dir, INDEX_FILENAME)
+        try:
+            conn = sqlite3.connect(filename, timeout=30)
+            conn.executescript(SCHEMA)
+
+        except sqlite3.Error:
+            # a read-only archive still works, we just can't keep the index
+            conn = sqlite3.connect(":memory:")
+            conn.executescript(SCHEMA)
+
+        index = cls(archive_dir, conn)
+        if refresh:
+            index.refresh()
+
+        return index
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def __enter__(self) -> "ArchiveIndex":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def refresh(self, full: bool = False) -> int:
+        """
+        Rescan any quarter whose folder has changed since we last saw it, or
+        every quarter if `full` is set. Returns the number rescanned.
+        """
+        on_disk = _list_quarters(self.archive_dir)
+        known = dict(self.conn.execute("SELECT quarter, mtime_ns FROM quarters"))
+
+        rescanned = 0
+        with self.conn:
+            for quarter in set(known) - set(on_disk):
+                self._forget(quarter)
+
+            for quarter, mtime_ns in sorted(on_disk.items()):
+                if full or mtime_ns is None or known.get(quarter) != mtime_ns:
+                    self._scan(quarter)
+                    rescanned += 1
+
+        return rescanned
+
+    def rescan(self, quarter: str) -> None:
+        "List a single quarter again, e.g. after we've changed it ourselves."
+        with self.conn:
+            if os.path.isdir(os.path.join(self.archive_dir, quarter)):
+                self._scan(quarter)
+            else:
+                self._forget(quarter)
+
+    def projects(self) -> Iterator[Tuple[str, str, str]]:
+        """
+        Stream every (quarter, filename, name) triple in the archive, sorted by
+        quarter and then by name, so that copies of a project differing only
+        by extension are adjacent.
+        """
+        return self.conn.execute(
+            "SELECT quarter, filename, name FROM projects "
+            "ORDER BY quarter || '/' || name, filename"
+        )
+
+    def find(self, name: str) -> List[str]:
+        """
+        Find every archived copy of a project, by name without any archive
+        extension. Returns paths relative to the archive directory.
+        """
+        rows = self.conn.execute(
+            "SELECT quarter, filename FROM projects WHERE name = ?", (name,)
+        )
+        return sorted(os.path.join(quarter, filename) for quarter, filename in rows)
+
+    def names_with_prefix(self, prefix: str, limit: int = 100) -> List[str]:
+        """
+        Project names starting with a prefix, in order. This is a range scan
+        over the index on names, so it stays fast on huge archives.
+        """
+        if not prefix:
+            rows = self.conn.execute(
+                "SELECT DISTINCT name FROM projects ORDER BY name LIMIT ?", (limit,)
+            )
+        else:
+            upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+            rows = self.conn.execute(
+                "SELECT DISTINCT name FROM projects WHERE name >= ? AND name < ? "
+                "ORDER BY name LIMIT ?",
+                (prefix, upper, limit),
+            )
+
+        return [name for (name,) in rows]
+
+    def quarters(self) -> Dict[str, Optional[int]]:
+        "Every quarter we know of, and its folder's mtime when we last listed it."
+        return dict(self.conn.execute("SELECT quarter, mtime_ns FROM quarters"))
+
+    def __len__(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM projects").fetchone()[0]
+
+    def _scan(self, quarter: str) -> None:
+        quarter_dir = os.path.join(self.archive_dir, quarter)
+        mtime_ns = _stable_mtime_ns(quarter_dir)
+        filenames = _list_visible(quarter_dir)
+
+        self.conn.execute("DELETE FROM projects WHERE quarter = ?", (quarter,))
+        self.conn.executemany(
+            "INSERT INTO projects (quarter, filename, name) VALUES (?, ?, ?)",
+            [(quarter, f, fs.trim_archive_extension(f)) for f in filenames],
+        )
+        self.conn.execute(
+            "INSERT OR REPLACE INTO quarters (quarter, mtime_ns) VALUES (?, ?)",
+            (quarter, mtime_ns),
+        )
+
+    def _forget(self, quarter: str) -> None:
+        self.conn.execute("DELETE FROM projects WHERE quarter = ?", (quarter,))
+        self.conn.execute("DELETE FROM quarters WHERE quarter = ?", (quarter,))
+
+
+def _list_quarters(archive_dir: str) -> Dict[str, Optional[int]]:
+    "Find every year/quarter folder in the archive along with its mtime."
+    quarters = {}
+    for year in _list_visible(archive_dir, dirs_only=True):
+        year_dir = os.path.join(archive_dir, year)
+        for quarter in _list_visible(year_dir, dirs_only=True):
+            quarter_dir = os.path.join(year_dir, quarter)
+            quarters[f"{year}/{quarter}"] = _stable_mtime_ns(quarter_dir)
+
+    return quarters
+
+
+def _list_visible(path: str, dirs_only: bool = False) -> List[str]:
+    "List the entries of a folder that a shell glob would match."
+    try:
+        with os.scandir(path) as it:
+            entries = [entry for entry in it if not entry.name.startswith(".")]
+            return [entry.name for entry in entries if entry.is_dir() or not dirs_only]
+
+    except OSError:
+        return []
+
+
+def _stable_mtime_ns(path: str) -> Optional[int]:
+    """
+    The mtime of a folder, or None if it's too recent to tell apart from a
+    change that might still happen in the same timestamp tick.
+    """
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+    if time.time_ns() - mtime_ns < MTIME_GRACE_NS:
+        return None
+
+    return mtime_ns
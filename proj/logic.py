@@ -8,100 +8,810 @@
 High level operations for proj.
 """
 
+import calendar
+import contextlib
+import errno
+import heapq
 import os
-from typing import List, Tuple
+from typing import (
+    TYPE_CHECKING,
+    Callable,
+    ContextManager,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
+import time
+import re
 import shutil
-import glob
+import tempfile
 import datetime as dt
-from functools import reduce
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 
 import click
 
+from proj import configfile, daemon, fs, matching, metrics, throttle, tiers
 from proj.configfile import Config
-from proj import fs
-from proj.exceptions import CommandError
+from proj.exceptions import CommandError, PartialArchiveError
+from proj.ignore import IgnoreRules
+from proj.index import ArchiveIndex
+from proj.seekable import Member
+from proj.treecache import TreeCache
+from proj.ui import format_size
+from proj.vcs import GitRepo
 
+if TYPE_CHECKING:  # pragma: no cover
+    from proj import compress, trash
 
-def archive(src_path: str, config: Config, dry_run: bool = False) -> None:
+
+# ways to tell when a project was last worked on; folders that aren't
+# repositories always fall back to mtime
+ACTIVITY_STRATEGIES = ["mtime", "git"]
+
+
+@dataclass
+class ArchiveResult:
+    src_path: str
+    dest_path: str
+    size: int
+    seconds: float
+
+
+@dataclass
+class RestoreResult:
+    source: str
+    dest_path: str
+    seconds: float
+
+
+def archive(
+    src_path: str,
+    config: Config,
+    dry_run: bool = False,
+    echo: Callable[[str], None] = print,
+) -> ArchiveResult:
     "Take a folder from the current directory and move it to the archive."
+    start = time.monotonic()
     if not os.path.exists(src_path):
         raise CommandError(f"no such file or folder: {src_path}")
 
-    dest_path = _archive_path(src_path, config)
-
-    print(src_path, "-->", dest_path)
-    if not dry_run:
-        _archive_project(src_path, dest_path, config)
+    rules = IgnoreRules.for_project(src_path, config.ignore)
+    cache = _tree_cache(src_path, config, rules)
+    with metrics.phase("walk"):
+        stats = _tree_stats(src_path, config, rules, cache)
 
+    dest_path = _archive_path(src_path, config, stats=stats)
 
-def restore(dest_path: str, config: Config) -> None:
-    "Take a project folder out of the archive and place it in the current working directory."
+    echo(f"{src_path} --> {dest_path}")
+    if not dry_run:
+        with _throttled(config):
+            moved = _archive_project(src_path, dest_path, config, rules=rules, echo=echo)
+        if cache:
+            cache.forget()
+
+        with metrics.phase("index"):
+            _update_index(dest_path, config)
+        if moved:
+            echo(_describe_copy(moved))
+
+    return ArchiveResult(src_path, dest_path, stats.size, time.monotonic() - start)
+
+
+def archive_many(
+    src_paths: List[str], config: Config, jobs: int = 1, dry_run: bool = False
+) -> List[Optional[ArchiveResult]]:
+    """
+    Archive several projects, working on up to `jobs` of them at once. Each
+    project's output is printed in the order the projects were given, and a
+    project that fails doesn't stop the others; its result is None.
+    """
+
+    def work(src_path: str) -> Tuple[List[str], Optional[ArchiveResult], str]:
+        lines: List[str] = []
+        try:
+            result = archive(src_path, config, dry_run=dry_run, echo=lines.append)
+            return lines, result, ""
+
+        # a permission denied, full disk or file that vanished mid-walk is
+        # that project's failure, not the whole batch's
+        except (CommandError, OSError) as e:
+            return lines, None, str(e)
+
+    results = []
+    # throttled, the projects share one budget, and the workers need to start
+    # at low priority to keep it
+    throttled = contextlib.nullcontext() if dry_run else _throttled(config)
+    with throttled, ThreadPoolExecutor(max_workers=jobs) as pool:
+        for lines, result, error in pool.map(work, src_paths):
+            for line in lines:
+                print(line)
+
+            if error:
+                click.echo(f"error: {error}", err=True)
+
+            results.append(result)
+
+    return results
+
+
+def restore(
+    dest_path: str,
+    config: Config,
+    source: Optional[str] = None,
+    echo: Callable[[str], None] = print,
+) -> RestoreResult:
+    """
+    Take a project folder out of the archive and place it in the current
+    working directory, from the given source if we've found it already.
+    """
+    start = time.monotonic()
     if os.path.exists(dest_path):
         raise CommandError(f"file or directory already exists at: {dest_path}")
 
-    source = _find_restore_match(dest_path, config.archive_dir)
+    if source is None:
+        with metrics.phase("index"):
+            source = _find_restore_match(dest_path, tiers.archive_dirs(config))
 
     if fs.is_compressed(source):
-        nice_source = fs.trim_archive_extension(source)
-        print(nice_source, "-->", dest_path)
+        echo(f"{fs.trim_archive_extension(source)} --> {dest_path}")
+        with metrics.phase("extract"):
+            _extract_in_place(source, config)
 
-        shutil.unpack_archive(source, ".")
-        os.unlink(source)
+        with metrics.phase("remove"):
+            _discard_archive(source, dest_path, config)
     else:
-        print(source, "-->", dest_path)
-        shutil.move(source, ".")
+        echo(f"{source} --> {dest_path}")
+        with metrics.phase("move"):
+            moved = fs.move(source, dest_path)
 
+        if not moved.renamed:
+            echo(_describe_copy(moved))
 
-def list_projects(patterns: List[str], config: Config) -> List[str]:
-    # strategy: pick the intersection of all the patterns the user provides
-    globs = ["*{0}*".format(p) for p in patterns] + ["*"]
+    with metrics.phase("index"):
+        _update_index(source, config)
 
-    match_sets = []
-    offset = len(config.archive_dir) + 1
-    for suffix in globs:
-        glob_pattern = f"{config.archive_dir}/*/*/{suffix}"
+    return RestoreResult(source, dest_path, time.monotonic() - start)
 
-        match_set = set()
-        for full_filename in glob.glob(glob_pattern):
-            tail_filename = full_filename[offset:]
-            base = fs.trim_archive_extension(tail_filename)
-            match_set.add(base)
 
-        match_sets.append(match_set)
+def restore_many(
+    proj_names: List[str], config: Config, jobs: int = 1
+) -> List[Optional[RestoreResult]]:
+    """
+    Restore several projects, finding them all in one look at the index and
+    working on up to `jobs` of them at once. As with archive_many(), output
+    comes in the order the projects were given, and a project that fails
+    doesn't stop the others; its result is None.
+    """
+    import tarfile
 
-    final_set = reduce(lambda x, y: x.intersection(y), match_sets)
+    with metrics.phase("index"):
+        sources = _find_restore_matches(proj_names, tiers.archive_dirs(config))
 
-    return sorted(final_set)
+    def work(
+        item: Tuple[str, Optional[str]]
+    ) -> Tuple[List[str], Optional[RestoreResult], str]:
+        proj_name, source = item
+        lines: List[str] = []
+        if source is None:
+            return lines, None, f"no project matches: {proj_name}"
 
+        try:
+            result = restore(proj_name, config, source=source, echo=lines.append)
+            return lines, result, ""
+
+        # a corrupt archive is that project's failure, not the whole batch's
+        except (CommandError, OSError, EOFError, tarfile.TarError) as e:
+            return lines, None, str(e)
+
+    results = []
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        for lines, result, error in pool.map(work, zip(proj_names, sources)):
+            for line in lines:
+                print(line)
+
+            if error:
+                click.echo(f"error: {error}", err=True)
+
+            results.append(result)
+
+    return results
+
+
+def list_archived(proj_name: str, config: Config) -> Tuple[str, List[Member]]:
+    "Find an archived project, and list the files and folders in it."
+    from proj import compress
+
+    with metrics.phase("index"):
+        source = _find_restore_match(proj_name, tiers.archive_dirs(config))
+
+    with metrics.phase("list"):
+        return source, compress.list_members(source)
 
-def _archive_path(src_path: str, config: Config) -> str:
-    "Find where to archive the path to based on when it was last changed."
-    t = fs.last_modified(src_path)
-    year, quarter = _to_quarter(t)
-    return os.path.join(config.archive_dir, year, quarter, os.path.basename(src_path))
 
+def extract(
+    proj_name: str, paths: List[str], config: Config, dest_dir: str = "."
+) -> Tuple[str, List[Member]]:
+    """
+    Get some files or folders back from an archived project, leaving it in
+    the archive. They're extracted under a folder named after the project.
+    """
+    from proj import compress
+
+    with metrics.phase("index"):
+        source = _find_restore_match(proj_name, tiers.archive_dirs(config))
+
+    with metrics.phase("extract"):
+        members = compress.extract_members(
+            source, paths, dest_dir, chunk_store=config.chunk_store
+        )
+        return source, members
+
+
+def tune(src_path: str, config: Config, sample_size: int) -> "compress.TuneReport":
+    """
+    Try each compression format on a sample of a project, leaving out
+    whatever archiving it would leave out.
+    """
+    from proj import compress
+
+    if not os.path.isdir(src_path):
+        raise CommandError(f"no such folder: {src_path}")
+
+    scan = None
+    rules = IgnoreRules.for_project(src_path, config.ignore)
+    if rules and config.exclude_ignored:
+        scan = rules.scan_dir
+
+    with metrics.phase("tune"):
+        return compress.tune(src_path, sample_size, scan=scan)
+
+
+def gc(folder: str, threads: int) -> List["trash.Emptied"]:
+    """
+    Finish deleting archived projects that are still in the trash of a
+    folder of active projects.
+    """
+    from proj import trash
+
+    if not os.path.isdir(folder):
+        raise CommandError(f"no such folder: {folder}")
+
+    with metrics.phase("remove"):
+        return trash.empty(os.path.join(folder, trash.TRASH_DIR), threads=threads)
+
+
+@dataclass
+class Migration:
+    # e.g. "2012/q3"
+    quarter: str
+    src_dir: str
+    dest_dir: str
+    projects: int = 0
+    errors: List[str] = field(default_factory=list)
+
+
+def migrate(
+    config: Config,
+    jobs: int = 4,
+    dry_run: bool = False,
+    now: Optional[dt.datetime] = None,
+) -> List[Migration]:
+    """
+    Move every quarter of the archive that has aged into a colder tier (or
+    been configured into a warmer one) to where it now belongs, moving up to
+    `jobs` projects at once. Projects move whole or not at all, so running
+    this again after an interruption carries on where it left off.
+    """
+    all_tiers = tiers.tiers_for(config)
+    migrations = []
+    for tier in all_tiers:
+        if not os.path.isdir(tier.archive_dir):
+            continue
+
+        with metrics.phase("index"), ArchiveIndex.open(tier.archive_dir) as index:
+            quarters = sorted(index.quarters())
+
+        for quarter in quarters:
+            year, q = quarter.split("/")
+            dest = tiers.tier_for(all_tiers, year, q, now=now)
+            if dest != tier:
+                migrations.append(
+                    Migration(quarter, tier.archive_dir, dest.archive_dir)
+                )
+
+    with _throttled(config):
+        for migration in migrations:
+            _migrate_quarter(migration, config, jobs, dry_run)
+
+    return migrations
+
+
+def _migrate_quarter(
+    migration: Migration, config: Config, jobs: int, dry_run: bool
+) -> None:
+    src_quarter = os.path.join(migration.src_dir, migration.quarter)
+    dest_quarter = os.path.join(migration.dest_dir, migration.quarter)
+    names = sorted(n for n in os.listdir(src_quarter) if not n.startswith("."))
+    migration.projects = len(names)
+    if dry_run:
+        return
+
+    def work(name: str) -> str:
+        try:
+            _migrate_project(
+                os.path.join(src_quarter, name), os.path.join(dest_quarter, name)
+            )
+            return ""
+
+        except (CommandError, OSError) as e:
+            return str(e)
+
+    fs.mkdir(dest_quarter)
+    with metrics.phase("move"), ThreadPoolExecutor(max_workers=jobs) as pool:
+        migration.errors = [e for e in pool.map(work, names) if e]
+
+    # leave the folders if anything failed to move, or arrived meanwhile
+    for folder in [src_quarter, os.path.dirname(src_quarter)]:
+        try:
+            os.rmdir(folder)
+        except OSError:
+            break
+
+    with metrics.phase("index"):
+        _rescan_quarter(dest_quarter, config)
+        _rescan_quarter(src_quarter, config)
+
+
+def _migrate_project(src: str, dest: str) -> None:
+    """
+    Move an archived project to another tier. Across filesystems it's copied
+    under a hidden name first, so that it only appears once it's whole.
+    """
+    if os.path.lexists(dest):
+        raise CommandError(f"file or directory already exists at: {dest}")
+
+    try:
+        os.rename(src, dest)
+        return
+
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+
+    tmp = os.path.join(os.path.dirname(dest), f".{os.path.basename(dest)}.migrating")
+    # left behind by a migration that was interrupted
+    if os.path.lexists(tmp):
+        _remove(tmp)
+
+    fs.copy_tree(src, tmp)
+    os.rename(tmp, dest)
+    _remove(src)
+
+
+def _remove(path: str) -> None:
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.unlink(path)
+
+
+def list_projects(
+    patterns: List[str], config: Config, regex: bool = False, ignore_case: bool = False
+) -> List[str]:
+    return list(iter_projects(patterns, config, regex=regex, ignore_case=ignore_case))
+
+
+def iter_projects(
+    patterns: List[str], config: Config, regex: bool = False, ignore_case: bool = False
+) -> Iterator[str]:
+    """
+    Stream the archived projects matching every one of the patterns, in sorted
+    order. Patterns are substrings (with shell wildcards) of the archived file
+    name by default, or regular expressions searched for within it.
+
+    With several tiers, they're all searched at once and the results merged.
+    """
+    is_match = matching.compile_matcher(patterns, regex=regex, ignore_case=ignore_case)
+    request = {
+        "op": "list",
+        "patterns": patterns,
+        "regex": regex,
+        "ignore_case": ignore_case,
+    }
+
+    archive_dirs = [d for d in tiers.archive_dirs(config) if os.path.isdir(d)]
+    if len(archive_dirs) < 2:
+        for archive_dir in archive_dirs:
+            yield from _iter_tier_projects(archive_dir, request, is_match)
+        return
+
+    def search(archive_dir: str) -> List[str]:
+        return list(_iter_tier_projects(archive_dir, request, is_match))
+
+    with ThreadPoolExecutor(max_workers=len(archive_dirs)) as pool:
+        found = list(pool.map(search, archive_dirs))
+
+    # a quarter part way through migrating is in two tiers at once
+    seen = set()
+    for project in heapq.merge(*found):
+        if project not in seen:
+            seen.add(project)
+            yield project
+
+
+def _iter_tier_projects(
+    archive_dir: str, request: dict, is_match: Callable[[str], bool]
+) -> Iterator[str]:
+    "The matching projects in one tier, from its daemon if it has one."
+    with metrics.phase("index"):
+        served = daemon.query(archive_dir, request)
+        if served is not None:
+            yield from served
+            return
+
+        index = ArchiveIndex.open(archive_dir)
+
+    with index:
+        yield from matching.unique_projects(index.projects(), is_match)
+
+
+def iter_stale(
+    folder: str, cutoff: float, config: Config, jobs: int = 1
+) -> Iterator[Tuple[str, str]]:
+    """
+    Find the projects in a folder that haven't been worked on since the cutoff
+    timestamp, checking up to `jobs` of them at once. Yields the path of each
+    one, in order, along with the year/quarter it would be archived to.
+    """
+
+    def quarter_if_stale(src_path: str) -> Optional[str]:
+        rules = IgnoreRules.for_project(src_path, config.ignore)
+        cache = _tree_cache(src_path, config, rules)
+        stats = _tree_stats(src_path, config, rules, cache, stop_after=cutoff)
+        if stats.latest is None or stats.latest > cutoff:
+            return None
+
+        latest = dt.datetime.fromtimestamp(stats.latest, dt.timezone.utc)
+        return "/".join(_to_quarter(latest))
+
+    src_paths = _list_active(folder, config)
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        quarters = pool.map(quarter_if_stale, src_paths)
+        for src_path, quarter in zip(src_paths, quarters):
+            if quarter:
+                yield src_path, quarter
+
+
+def cutoff_for(age: str, now: Optional[dt.datetime] = None) -> float:
+    """
+    The timestamp an age like 30d, 2w, 6m or 1y ago, counting months and
+    years by the calendar.
+    """
+    match = re.fullmatch(r"(\d+)([dwmy])", age.strip().lower())
+    if not match:
+        raise CommandError(f"invalid age {age!r}, expected e.g. 30d, 2w, 6m or 1y")
+
+    n, unit = int(match.group(1)), match.group(2)
+    now = now or dt.datetime.now(dt.timezone.utc)
+    if unit in "dw":
+        days = n * (7 if unit == "w" else 1)
+        return (now - dt.timedelta(days=days)).timestamp()
+
+    months = n * (12 if unit == "y" else 1)
+    year, month = divmod(now.year * 12 + now.month - 1 - months, 12)
+    if year < dt.MINYEAR:
+        raise CommandError(f"age is too old: {age}")
+
+    day = min(now.day, calendar.monthrange(year, month + 1)[1])
+    return now.replace(year=year, month=month + 1, day=day).timestamp()
+
+
+def _list_active(folder: str, config: Config) -> List[str]:
+    "The project folders in a folder of active projects, except the archive."
+    if not os.path.isdir(folder):
+        raise CommandError(f"no such folder: {folder}")
+
+    archive_dirs = {os.path.abspath(d) for d in tiers.archive_dirs(config)}
+    src_paths = []
+    with os.scandir(folder) as it:
+        for entry in it:
+            if entry.name.startswith(".") or not entry.is_dir(follow_symlinks=False):
+                continue
+
+            if os.path.abspath(entry.path) in archive_dirs:
+                continue
+
+            src_paths.append(os.path.normpath(entry.path))
+
+    return sorted(src_paths)
+
+
+def reindex(config: Config, full: bool = False) -> Tuple[int, int]:
+    """
+    Bring the index of each tier of the archive up to date, rescanning any
+    quarter that changed. Returns the number of quarters rescanned and the
+    number of projects.
+    """
+    # a colder tier may not have had anything migrated to it yet, or the
+    # first tier may be empty and gone
+    archive_dirs = [d for d in tiers.archive_dirs(config) if os.path.isdir(d)]
+    if not archive_dirs:
+        raise CommandError(f"archive directory does not exist: {config.archive_dir}")
+
+    rescanned = n_projects = 0
+    for archive_dir in archive_dirs:
+        with metrics.phase("index"), ArchiveIndex.open(archive_dir) as index:
+            rescanned += index.refresh(full=full)
+            n_projects += len(index)
+
+    return rescanned, n_projects
+
+
+def _tree_cache(
+    src_path: str, config: Config, rules: Optional[IgnoreRules] = None
+) -> Optional[TreeCache]:
+    if not config.mtime_cache:
+        return None
+
+    return TreeCache.for_project(src_path, configfile.cache_dir(), rules=rules)
+
+
+def _tree_stats(
+    src_path: str,
+    config: Config,
+    rules: Optional[IgnoreRules] = None,
+    cache: Optional[TreeCache] = None,
+    stop_after: Optional[float] = None,
+) -> fs.TreeStats:
+    """
+    Summarise a project, leaving out what it ignores. Its latest time is when
+    it was last worked on, by whichever measure the config asks for. See
+    fs.tree_stats() for `stop_after`.
+    """
+    if config.activity not in ACTIVITY_STRATEGIES:
+        raise CommandError(
+            f"unknown activity strategy {config.activity!r}, "
+            f"expected one of: {', '.join(ACTIVITY_STRATEGIES)}"
+        )
+
+    repo = GitRepo.find(src_path) if config.activity == "git" else None
+    if repo:
+        try:
+            return repo.tree_stats(
+                rules.patterns if rules else None,
+                stop_after=stop_after,
+                cache_file=cache.cache_file if cache else None,
+            )
+
+        except (OSError, ValueError) as e:
+            click.echo(f"Warning: {e}, walking {src_path} instead", err=True)
+
+    if cache:
+        # a full walk keeps the cache complete, and is cheap once it's warm
+        stats = cache.tree_stats()
+    else:
+        scan = rules.scan_dir if rules else None
+        stats = fs.tree_stats(src_path, scan=scan, stop_after=stop_after)
+
+    if stats.latest is None and rules:
+        # a project of nothing but ignored files was still last changed sometime
+        stats = fs.tree_stats(src_path)
+
+    return stats
+
+
+def _archive_path(
+    src_path: str, config: Config, stats: Optional[fs.TreeStats] = None
+) -> str:
+    "Find where to archive the path to based on when it was last changed."
+    stats = stats or fs.tree_stats(src_path)
+    if stats.latest is None:
+        raise CommandError(f"no files in folder: {src_path}")
+
+    year, quarter = _to_quarter(
+        dt.datetime.fromtimestamp(stats.latest, dt.timezone.utc)
+    )
+    tier = tiers.tier_for(tiers.tiers_for(config), year, quarter)
+    return os.path.join(tier.archive_dir, year, quarter, os.path.basename(src_path))
+
+
+def _archive_project(
+    src_path: str,
+    dest_path: str,
+    config: Config,
+    rules: Optional[IgnoreRules] = None,
+    echo: Callable[[str], None] = print,
+) -> Optional[fs.MoveStats]:
+    """
+    Compress or move the project into place, returning how the move went if
+    it had to copy across filesystems. Ignored files are left out of
+    compressed archives if the config says so, and a project unchanged since
+    it was restored gets its old archive back, if it was kept.
+    """
+    scan = _scan_for(rules, config)
 
-def _archive_project(src_path: str, dest_path: str, config: Config) -> None:
     parent_dir = os.path.dirname(dest_path)
-    fs.mkdir(parent_dir)
+    with metrics.phase("mkdir"):
+        fs.mkdir(parent_dir)
 
     if config.compression:
         compression_format: str = config.compression_format  # type: ignore
-        _archive_compressed(
-            src_path, dest_path, compression_format, config.compression_ext
+        trash_dir = None
+        if config.background_delete:
+            from proj import trash
+
+            trash_dir = trash.trash_dir_for(src_path)
+
+        reused = config.restore_cache_mb > 0 and _archive_from_cache(
+            src_path, dest_path, config, scan, trash_dir
         )
-    else:
-        shutil.move(src_path, dest_path)
+        if reused:
+            echo("unchanged since it was restored, so its old archive was reused")
+        else:
+            with metrics.phase("compress"):
+                _archive_compressed(
+                    src_path,
+                    dest_path,
+                    compression_format,
+                    config.compression_ext,
+                    threads=config.compression_threads,
+                    low_disk=config.low_disk,
+                    write_buffer=config.write_buffer,
+                    scan=scan,
+                    chunk_store=config.chunk_store,
+                    adaptive=config.adaptive_compression,
+                    speed=config.compression_speed,
+                    trash_dir=trash_dir,
+                )
+
+        if trash_dir:
+            trash.empty_later(trash_dir)
+
+        return None
+
+    with metrics.phase("move"):
+        moved = fs.move(src_path, dest_path)
+
+    return None if moved.renamed else moved
+
+
+def _scan_for(
+    rules: Optional[IgnoreRules], config: Config
+) -> Optional[Callable[[str, bool], fs.DirScan]]:
+    "How to walk a project, leaving out ignored files if the config says so."
+    if rules and config.exclude_ignored:
+        return rules.scan_dir
+
+    return None
+
+
+def _archive_from_cache(
+    src_path: str,
+    dest_path: str,
+    config: Config,
+    scan: Optional[Callable[[str, bool], fs.DirScan]],
+    trash_dir: Optional[str],
+) -> bool:
+    """
+    Move back the archive the project was restored from, if it was kept and
+    the project hasn't changed since, then remove the project as archiving
+    it would have. Returns whether we did.
+    """
+    from proj import restorecache
+
+    name = os.path.basename(os.path.abspath(src_path))
+    kept = restorecache.candidates(config.restore_cache, name)
+    if not kept:
+        return False
+
+    with metrics.phase("fingerprint"):
+        fingerprint = restorecache.fingerprint(src_path, scan=scan)
+
+    archive = kept.pop(fingerprint.digest, None)
+    # the others are of the project as it was, so they'll never match again
+    for stale in kept.values():
+        os.unlink(stale)
+
+    if not archive:
+        return False
+
+    ext = archive[len(fs.trim_archive_extension(archive)) :]
+    with metrics.phase("move"):
+        fs.move(archive, dest_path + ext)
+
+    with metrics.phase("remove"):
+        walked = (fingerprint.files, fingerprint.dirs, fingerprint.ignored)
+        if trash_dir:
+            from proj import trash
+
+            trash.discard(src_path, trash_dir, *walked)
+        else:
+            fs.remove_walked(*walked)
+
+    _warn_if_changed(src_path)
+    return True
+
+
+def _discard_archive(source: str, dest_path: str, config: Config) -> None:
+    """
+    Delete the archive a project was just restored from, or keep it under
+    the project's fingerprint if the config asks, to reuse if the project is
+    archived again unchanged.
+    """
+    # an archive holding something else, which we can't fingerprint
+    if config.restore_cache_mb <= 0 or not os.path.lexists(dest_path):
+        os.unlink(source)
+        return
+
+    from proj import restorecache
+
+    rules = IgnoreRules.for_project(dest_path, config.ignore)
+    with metrics.phase("fingerprint"):
+        fingerprint = restorecache.fingerprint(dest_path, _scan_for(rules, config))
+
+    restorecache.keep(
+        source, fingerprint.digest, config.restore_cache, config.restore_cache_mb * 2**20
+    )
+
+
+def _throttled(config: Config) -> ContextManager:
+    "Throttle our reads while archiving, if the config asks for it."
+    if not config.throttle:
+        return contextlib.nullcontext()
+
+    return throttle.running(config.throttle_mb_per_s * 2**20, config.throttle_iops)
+
+
+def _describe_copy(moved: fs.MoveStats) -> str:
+    size = format_size(moved.size)
+    rate = format_size(moved.rate)
+    return f"copied {moved.files} files ({size}) across filesystems at {rate}/s"
 
 
 def _archive_compressed(
-    src_path: str, dest_path: str, compression_format: str, compression_ext: str
+    src_path: str,
+    dest_path: str,
+    compression_format: str,
+    compression_ext: str,
+    threads: int = 1,
+    low_disk: bool = False,
+    write_buffer: int = 16 * 1024 * 1024,
+    scan: Optional[Callable[[str, bool], fs.DirScan]] = None,
+    chunk_store: Optional[str] = None,
+    adaptive: bool = False,
+    speed: float = 0,
+    trash_dir: Optional[str] = None,
 ) -> None:
-    "Compress the folder into an file in the archive, then remove the original"
+    """
+    Compress the folder into an file in the archive, then remove the
+    original, or move it to trash_dir to be deleted later.
+    """
+    # compression is slow to import and only needed here
+    from proj import compress
+
     dest_filename = dest_path + compression_ext
 
     try:
-        shutil.make_archive(dest_path, compression_format, ".", src_path)
+        compress.make_archive(
+            src_path,
+            dest_path,
+            compression_format,
+            threads=threads,
+            remove_source=True,
+            low_disk=low_disk,
+            write_buffer=write_buffer,
+            scan=scan,
+            chunk_store=chunk_store,
+            adaptive=adaptive,
+            speed=speed,
+            trash_dir=trash_dir,
+        )
+
+    except PartialArchiveError:
+        # the partial archive holds the only copy of some files, so keep it
+        raise
 
     except Exception as e:
         # remove the partially compressed file
@@ -110,29 +820,112 @@ def _archive_compressed(
 
         raise e
 
-    shutil.rmtree(src_path)
+    _warn_if_changed(src_path)
 
 
-def _find_restore_match(proj_name: str, archive_dir: str) -> str:
-    base_pattern = os.path.join(archive_dir, "*", "*", proj_name)
-
-    patterns = [base_pattern]
-    for ext in fs.SUPPORTED_FORMATS.values():
-        patterns.append(base_pattern + ext)
+def _warn_if_changed(src_path: str) -> None:
+    if os.path.exists(src_path):
+        click.echo(
+            f"Warning: {src_path} changed while archiving, leaving the new files",
+            err=True,
+        )
 
-    matches = []
-    for pattern in patterns:
-        matches.extend(glob.glob(pattern))
 
-    if not matches:
+def _find_restore_match(proj_name: str, archive_dirs: List[str]) -> str:
+    (source,) = _find_restore_matches([proj_name], archive_dirs)
+    if source is None:
         raise CommandError(f"no project matches: {proj_name}")
 
-    if len(matches) > 1:
-        click.echo("Warning: multiple matches, picking the most recent", err=True)
+    return source
 
-    source = sorted(matches)[-1]
 
-    return source
+def _find_restore_matches(
+    proj_names: List[str], archive_dirs: List[str]
+) -> List[Optional[str]]:
+    """
+    Find the most recent copy of each project in any tier of the archive, or
+    None for those not archived, searching every tier at once.
+    """
+
+    def find(archive_dir: str) -> List[List[Tuple[str, str]]]:
+        "The (relative path, path) of every copy of each project in a tier."
+        if not os.path.isdir(archive_dir):
+            return [[] for _ in proj_names]
+
+        found = daemon.query(archive_dir, {"op": "find", "names": proj_names})
+        if found is None:
+            with ArchiveIndex.open(archive_dir) as index:
+                found = [index.find(proj_name) for proj_name in proj_names]
+
+        return [[(m, os.path.join(archive_dir, m)) for m in ms] for ms in found]
+
+    with ThreadPoolExecutor(max_workers=max(len(archive_dirs), 1)) as pool:
+        by_tier = list(pool.map(find, archive_dirs))
+
+    sources: List[Optional[str]] = []
+    for i, proj_name in enumerate(proj_names):
+        # relative paths start with the quarter, so the last is the most recent
+        matches = sorted(m for found in by_tier for m in found[i])
+        if len(matches) > 1:
+            click.echo(
+                f"Warning: multiple matches for {proj_name}, picking the most recent",
+                err=True,
+            )
+
+        sources.append(matches[-1][1] if matches else None)
+
+    return sources
+
+
+def _extract_in_place(source: str, config: Config) -> None:
+    """
+    Unpack an archive into the current directory. It's unpacked into a
+    hidden folder first and then renamed into place, so that a failure
+    part way through leaves nothing half-restored behind.
+    """
+    from proj import compress
+
+    tmp_dir = tempfile.mkdtemp(prefix=".proj-restore-", dir=".")
+    try:
+        compress.unpack_archive(
+            source, tmp_dir, config.compression_threads, chunk_store=config.chunk_store
+        )
+        names = os.listdir(tmp_dir)
+        for name in names:
+            if os.path.lexists(name):
+                raise CommandError(f"file or directory already exists at: {name}")
+
+        for name in names:
+            os.rename(os.path.join(tmp_dir, name), name)
+
+    except CommandError:
+        raise
+
+    except Exception as e:
+        raise CommandError(f"couldn't unpack {source}: {e}") from e
+
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def _update_index(archived_path: str, config: Config) -> None:
+    """
+    Record a change we've just made to one quarter of the archive, and make
+    sure the daemon knows about it before we return, if one is running.
+    """
+    _rescan_quarter(os.path.dirname(archived_path), config)
+
+
+def _rescan_quarter(quarter_dir: str, config: Config) -> None:
+    "List a quarter folder again in the index of whichever tier it's in."
+    tier = tiers.tier_of(tiers.tiers_for(config), quarter_dir)
+    archive_dir = tier.archive_dir if tier else config.archive_dir
+
+    quarter = os.path.relpath(quarter_dir, archive_dir)
+    with ArchiveIndex.open(archive_dir, refresh=False) as index:
+        index.rescan(quarter.replace(os.sep, "/"))
+
+    daemon.query(archive_dir, {"op": "refresh"})
 
 
 def _to_quarter(t: dt.datetime) -> Tuple[str, str]:
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+#
+#  matching.py
+#  proj
+#
+
+"""
+Matching archived projects against the patterns given to `proj list`, shared
+by the CLI and the `proj serve` daemon so that both answer the same way.
+"""
+
+import fnmatch
+import os
+import re
+from typing import Callable, Iterable, Iterator, List, Tuple
+
+from proj.exceptions import CommandError
+
+
+def compile_matcher(
+    patterns: List[str], regex: bool = False, ignore_case: bool = False
+) -> Callable[[str], bool]:
+    """
+    Combine every pattern into a single regular expression, one lookahead per
+    pattern, so that each name is tested in one pass and rejected as soon as
+    any pattern fails.
+    """
+    parts = []
+    for p in patterns:
+        if regex:
+            parts.append(f"(?=.*?(?:{p}))")
+        else:
+            # the same as globbing for *{p}*
+            parts.append(f"(?={fnmatch.translate(f'*{p}*')})")
+
+    flags = re.DOTALL | (re.IGNORECASE if ignore_case else 0)
+    try:
+        matcher = re.compile("".join(parts), flags)
+
+    except re.error as e:
+        raise CommandError(f"invalid pattern: {e}")
+
+    return lambda name: matcher.match(name) is not None
+
+
+def unique_projects(
+    rows: Iterable[Tuple[str, str, str]], is_match: Callable[[str], bool]
+) -> Iterator[str]:
+    "The matching projects in sorted (quarter, filename, name) rows, once each."
+    last = None
+    for quarter, filename, name in rows:
+        if not is_match(filename):
+            continue
+
+        # the same project may be archived with and without compression
+        project = os.path.join(quarter, name)
+        if project != last:
+            yield project
+            last = project
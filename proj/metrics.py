@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+#
+#  metrics.py
+#  proj
+#
+
+"""
+Phase timings and counters for a single run of proj, so that a slow command
+can tell us where its time went.
+
+Nothing is recorded unless a run asks for it with `--timings`, `--profile` or
+PROJ_METRICS_FILE, so the hooks scattered through proj cost next to nothing
+otherwise. Phases nest: a "remove" phase inside "compress" is recorded as
+"compress/remove". Phases in worker threads are summed, so with `--jobs`
+they can add up to more than the wall time.
+
+The counters are:
+
+- files_visited: files seen while walking projects
+- bytes_read, bytes_written: file contents read and written
+- syscalls: filesystem calls proj makes itself, not counting the reads and
+  writes of buffered files
+"""
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+import click
+
+from proj.ui import format_size
+
+
+# append a JSON line of metrics for every run to this file
+METRICS_ENV_VAR = "PROJ_METRICS_FILE"
+
+COUNTERS = ["files_visited", "bytes_read", "bytes_written", "syscalls"]
+
+_enabled = False
+_lock = threading.Lock()
+_local = threading.local()
+_phases: Dict[str, float] = {}
+_counters: Dict[str, int] = {}
+
+
+def count(**counters: int) -> None:
+    "Add to one or more counters, e.g. count(syscalls=1, bytes_read=n)."
+    if not _enabled:
+        return
+
+    with _lock:
+        for name, n in counters.items():
+            _counters[name] = _counters.get(name, 0) + n
+
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    "Time a phase of work, nested within any phase this thread is already in."
+    if not _enabled:
+        yield
+        return
+
+    stack: List[str] = _local.__dict__.setdefault("stack", [])
+    stack.append(name)
+    key = "/".join(stack)
+    with _lock:
+        # so that phases are reported in the order they started
+        _phases.setdefault(key, 0.0)
+
+    start = time.perf_counter()
+    try:
+        yield
+
+    finally:
+        elapsed = time.perf_counter() - start
+        stack.pop()
+        with _lock:
+            _phases[key] += elapsed
+
+
+def enable() -> None:
+    "Start recording, from a clean slate."
+    global _enabled
+
+    with _lock:
+        _phases.clear()
+        _counters.clear()
+        _enabled = True
+
+
+def disable() -> None:
+    global _enabled
+    _enabled = False
+
+
+def snapshot() -> Dict[str, Any]:
+    with _lock:
+        return {
+            "phases": dict(_phases),
+            "counters": {name: _counters.get(name, 0) for name in COUNTERS},
+        }
+
+
+def instrument(
+    command: Optional[str],
+    timings: bool = False,
+    profile: Optional[str] = None,
+    metrics_file: Optional[str] = None,
+) -> Callable[[], None]:
+    """
+    Start recording a run of a command, returning a function to call when it
+    finishes, which reports the results in each way that was asked for.
+    """
+    profiler = None
+    if profile:
+        import cProfile
+
+        profiler = cProfile.Profile()
+
+    enable()
+    start = time.perf_counter()
+    if profiler:
+        profiler.enable()
+
+    def finish() -> None:
+        if profiler:
+            profiler.disable()
+
+        wall_s = time.perf_counter() - start
+        disable()
+        report = snapshot()
+
+        if profiler and profile:
+            profiler.dump_stats(profile)
+
+        if timings:
+            click.echo(format_report(report, wall_s), err=True)
+
+        if metrics_file:
+            record = {
+                "time": time.time(),
+                "host": os.uname().nodename,
+                "pid": os.getpid(),
+                "command": command,
+                "wall_s": wall_s,
+                **report,
+            }
+            write_record(metrics_file, record)
+
+    return finish
+
+
+def format_report(report: Dict[str, Any], wall_s: float) -> str:
+    "A human-readable breakdown of where the time went."
+    phases = report["phases"]
+    width = max([len(name) for name in phases] + [len("total")])
+
+    lines = [f"{'phase':{width}}  {'seconds':>9}"]
+    for name, seconds in phases.items():
+        lines.append(f"{name:{width}}  {seconds:9.3f}")
+    lines.append(f"{'total':{width}}  {wall_s:9.3f}")
+
+    counters = report["counters"]
+    lines.append("")
+    for name in COUNTERS:
+        label = name.replace("_", " ")
+        if name.startswith("bytes"):
+            lines.append(f"{label:14}  {format_size(counters[name])}")
+        else:
+            lines.append(f"{label:14}  {counters[name]:,}")
+
+    return "\n".join(lines)
+
+
+def write_record(filename: str, record: Dict[str, Any]) -> None:
+    """
+    Append a record as a single JSON line. One write call per line keeps
+    records from concurrent runs from interleaving.
+    """
+    line = json.dumps(record) + "\n"
+    try:
+        fd = os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode("utf8"))
+        finally:
+            os.close(fd)
+
+    except OSError as e:
+        click.echo(f"Warning: could not write metrics to {filename}: {e}", err=True)
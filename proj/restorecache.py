@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+#
+#  restorecache.py
+#  proj
+#
+
+"""
+Keeping the archives of restored projects, so that archiving one again
+unchanged is a rename rather than compressing it all over again.
+
+Restoring a project normally deletes its archive. With a restore cache, the
+archive is moved into a cache folder in the archive instead, named for a
+fingerprint of the project as restored: a Merkle hash of the paths, sizes,
+mtimes and permissions of everything in it. Archiving the project later
+fingerprints it again, and if nothing has changed, the old archive is moved
+back instead. If something has, the old archive can never match again, so it
+is deleted.
+
+Like the mtime cache (see treecache.py), this trusts mtimes: a file rewritten
+at the same size with its old mtime put back looks unchanged.
+
+The cache is kept within a size limit, evicting the archives that were kept
+longest ago first. Each is used at most once, so that is the least recently
+used.
+"""
+
+import hashlib
+import os
+import re
+import stat
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional
+
+from proj import fs, metrics
+
+
+DIGEST_PATTERN = re.compile(r"[0-9a-f]{64}")
+
+
+@dataclass
+class Fingerprint:
+    digest: str
+
+    # what the walk found, so that the project can be removed without
+    # walking it again
+    files: List[str] = field(default_factory=list)
+    dirs: List[str] = field(default_factory=list)
+    ignored: List[os.DirEntry] = field(default_factory=list)
+
+
+def fingerprint(
+    src_path: str, scan: Optional[Callable[[str, bool], fs.DirScan]] = None
+) -> Fingerprint:
+    """
+    Hash the paths, sizes, mtimes and permissions of everything in a project,
+    walking it with a different scan function if given (see fs.scan_tree).
+    Each folder's hash covers its files and its subfolders' hashes, so a
+    change anywhere changes the hash at the top.
+    """
+    name = os.fsencode(os.path.basename(os.path.abspath(src_path)))
+    if not os.path.isdir(src_path) or os.path.islink(src_path):
+        metrics.count(syscalls=1)
+        line = _line(src_path, name, os.lstat(src_path))
+        return Fingerprint(_hash(name, [line]), files=[src_path])
+
+    result = Fingerprint("")
+    lines: Dict[str, List[bytes]] = {}
+    subdirs: Dict[str, List[str]] = {}
+    for folder in fs.scan_tree(src_path, scan=scan):
+        entries = folder.files + folder.dir_links
+        metrics.count(syscalls=len(entries))
+        lines[folder.path] = [
+            _line(e.path, os.fsencode(e.name), e.stat(follow_symlinks=False))
+            for e in entries
+        ]
+        subdirs[folder.path] = folder.subdirs
+        result.dirs.append(folder.path)
+        result.files.extend(e.path for e in entries)
+        result.ignored.extend(folder.ignored)
+
+    # folders come before their subfolders, so hash from the bottom up
+    hashes: Dict[str, str] = {}
+    for path in reversed(result.dirs):
+        for subdir in subdirs[path]:
+            subdir_name = os.fsencode(os.path.basename(subdir))
+            # an unreadable folder was skipped by the walk
+            subdir_hash = hashes.get(subdir, "").encode("ascii")
+            lines[path].append(b"d\0" + subdir_name + b"\0" + subdir_hash)
+        hashes[path] = _hash(b"", lines.pop(path))
+
+    result.digest = _hash(name, [hashes[src_path].encode("ascii")])
+    return result
+
+
+def keep(archive: str, digest: str, cache_dir: str, limit: int) -> bool:
+    """
+    Move the archive of a restored project into the cache, under the
+    project's fingerprint, then evict the oldest archives to bring the cache
+    within limit bytes. Returns whether the archive is still in the cache.
+    """
+    filename = os.path.basename(archive)
+    name = fs.trim_archive_extension(filename)
+    ext = filename[len(name) :]
+    kept = os.path.join(cache_dir, f"{name}.{digest}{ext}")
+
+    fs.mkdir(cache_dir)
+    if os.path.lexists(kept):
+        os.unlink(kept)
+    # a rename, unless the archive is in a tier on another filesystem
+    fs.move(archive, kept)
+    # when it was kept, to evict by
+    os.utime(kept)
+    metrics.count(syscalls=2)
+
+    return kept not in evict(cache_dir, limit)
+
+
+def evict(cache_dir: str, limit: int) -> List[str]:
+    "Remove the archives kept longest ago until the rest fit in limit bytes."
+    try:
+        with os.scandir(cache_dir) as it:
+            entries = [(e.stat().st_mtime, e.stat().st_size, e.path) for e in it]
+    except FileNotFoundError:
+        return []
+
+    total = sum(size for _, size, _ in entries)
+    evicted = []
+    for _, size, path in sorted(entries):
+        if total <= limit:
+            break
+
+        os.unlink(path)
+        evicted.append(path)
+        total -= size
+
+    return evicted
+
+
+def candidates(cache_dir: str, name: str) -> Dict[str, str]:
+    "The archives kept for a project, by fingerprint."
+    try:
+        filenames = os.listdir(cache_dir)
+    except FileNotFoundError:
+        return {}
+
+    found = {}
+    for filename in filenames:
+        base = fs.trim_archive_extension(filename)
+        prefix, _, digest = base.rpartition(".")
+        if prefix == name and DIGEST_PATTERN.fullmatch(digest):
+            found[digest] = os.path.join(cache_dir, filename)
+
+    return found
+
+
+def _line(path: str, name: bytes, st: os.stat_result) -> bytes:
+    if stat.S_ISLNK(st.st_mode):
+        kind, extra = b"l", os.fsencode(os.readlink(path))
+    else:
+        kind, extra = b"f", b""
+
+    parts = [kind, name, b"%d" % st.st_size, b"%d" % st.st_mtime_ns]
+    return b"\0".join(parts + [b"%o" % (st.st_mode & 0o7777), extra])
+
+
+def _hash(name: bytes, lines: List[bytes]) -> str:
+    h = hashlib.sha256(name + b"\0")
+    for line in sorted(lines):
+        h.update(line + b"\n")
+    return h.hexdigest()
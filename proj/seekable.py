@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+#
+#  seekable.py
+#  proj
+#
+
+"""
+An index of the members of a gzipped tarball, stored inside the archive, so
+that we can list it without reading it and get single files back by
+decompressing only the blocks that hold them.
+
+Our gzipped tarballs are already a series of independently compressed
+blocks (see compress.py). After the last block we write two empty gzip
+members, which gzip and tar skip over as if they weren't there:
+
+- the index member, whose comment field holds the index: every member's
+  name, type, size, mtime and offset into the tar stream, and every block's
+  offset in the file and in the tar stream, as base64'd zlib'd JSON
+- the locator member, a fixed-size member at the very end of the file, whose
+  extra field holds the offset of the index member
+
+Reading the index means reading the last few bytes of the file, then
+jumping straight to the index.
+"""
+
+import base64
+import bisect
+import json
+import os
+import struct
+import zlib
+from dataclasses import astuple, dataclass, field
+from typing import TYPE_CHECKING, BinaryIO, List, Optional, Tuple
+
+if TYPE_CHECKING:  # pragma: no cover
+    import tarfile
+
+
+INDEX_VERSION = 1
+
+# id, deflate, FCOMMENT, mtime 0, no flags, unknown OS
+INDEX_HEADER = b"\x1f\x8b\x08\x10\x00\x00\x00\x00\x00\xff"
+INDEX_COMMENT = b"proj-index:"
+
+# id, deflate, FEXTRA, mtime 0, no flags, unknown OS, XLEN 12, "PI", LEN 8
+LOCATOR_HEADER = b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x0c\x00PI\x08\x00"
+
+# an empty deflate stream, then the crc and size of no data
+EMPTY_BODY = b"\x03\x00" + b"\x00" * 8
+
+LOCATOR_SIZE = len(LOCATOR_HEADER) + 8 + len(EMPTY_BODY)
+
+
+@dataclass
+class Member:
+    name: str
+    # d for folders, f for files, l for symlinks, h for hard links, o otherwise
+    type: str
+    size: int
+    mtime: int
+    # where its header starts in the uncompressed tar stream
+    offset: int
+
+    @classmethod
+    def from_tarinfo(cls, tarinfo: "tarfile.TarInfo", offset: int = 0) -> "Member":
+        if tarinfo.isdir():
+            type_ = "d"
+        elif tarinfo.isreg():
+            type_ = "f"
+        elif tarinfo.issym():
+            type_ = "l"
+        elif tarinfo.islnk():
+            type_ = "h"
+        else:
+            type_ = "o"
+
+        return cls(tarinfo.name, type_, tarinfo.size, int(tarinfo.mtime), offset)
+
+
+@dataclass
+class SeekableIndex:
+    members: List[Member]
+    # the offset of each block in the file, and in the tar stream
+    blocks: List[Tuple[int, int]]
+    # where the last block ends in the file
+    data_end: int
+    _starts: List[int] = field(init=False, repr=False)
+
+    def __post_init__(self) -> None:
+        self._starts = [start for _, start in self.blocks]
+
+    def block_at(self, offset: int) -> int:
+        "The block holding an offset into the tar stream."
+        return max(0, bisect.bisect_right(self._starts, offset) - 1)
+
+    def block_extent(self, i: int) -> Tuple[int, int]:
+        "Where a block starts and ends in the file."
+        end = self.blocks[i + 1][0] if i + 1 < len(self.blocks) else self.data_end
+        return self.blocks[i][0], end
+
+
+def write_index(ostream: BinaryIO, index: SeekableIndex) -> None:
+    "Append the index and locator members at the current end of the archive."
+    record = {
+        "version": INDEX_VERSION,
+        "members": [astuple(m) for m in index.members],
+        "blocks": index.blocks,
+    }
+    payload = zlib.compress(json.dumps(record, separators=(",", ":")).encode("utf8"))
+
+    ostream.write(INDEX_HEADER + INDEX_COMMENT)
+    ostream.write(base64.b64encode(payload) + b"\0" + EMPTY_BODY)
+    ostream.write(LOCATOR_HEADER + struct.pack("<Q", index.data_end) + EMPTY_BODY)
+
+
+def read_index(filename: str) -> Optional[SeekableIndex]:
+    """
+    Read the index at the end of an archive, or None if it doesn't have one
+    we can understand, in which case it has to be read the slow way.
+    """
+    try:
+        with open(filename, "rb") as istream:
+            return _read_index(istream)
+
+    except (OSError, ValueError, TypeError, KeyError, zlib.error):
+        return None
+
+
+def _read_index(istream: BinaryIO) -> Optional[SeekableIndex]:
+    file_size = istream.seek(0, os.SEEK_END)
+    if file_size < LOCATOR_SIZE:
+        return None
+
+    istream.seek(file_size - LOCATOR_SIZE)
+    locator = istream.read(LOCATOR_SIZE)
+    if not locator.startswith(LOCATOR_HEADER):
+        return None
+
+    (data_end,) = struct.unpack_from("<Q", locator, len(LOCATOR_HEADER))
+    istream.seek(data_end)
+    footer = istream.read(file_size - LOCATOR_SIZE - data_end)
+    prefix = INDEX_HEADER + INDEX_COMMENT
+    if not footer.startswith(prefix):
+        return None
+
+    payload = footer[len(prefix) : footer.index(b"\0", len(prefix))]
+    record = json.loads(zlib.decompress(base64.b64decode(payload)))
+    if record.get("version") != INDEX_VERSION:
+        return None
+
+    return SeekableIndex(
+        members=[Member(*m) for m in record["members"]],
+        blocks=[(c, u) for c, u in record["blocks"]],
+        data_end=data_end,
+    )
@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+#
+#  server.py
+#  proj
+#
+
+"""
+The `proj serve` daemon, which keeps the archive catalog in memory and
+answers questions about it over a Unix socket (see daemon.py for the
+protocol and the client).
+
+The catalog is loaded from the archive index (see index.py), and loaded
+again whenever a year or quarter folder changes. On Linux we hear about
+changes from inotify, which the standard library has no binding for, so we
+call it through ctypes. Elsewhere, or if that fails, we poll the folders'
+mtimes instead. Either way the index is also refreshed every so often, in
+case a change slipped past us, such as one made on another machine sharing
+the archive.
+
+Each reload builds a new snapshot of the catalog and swaps it in whole, so
+requests never see a half-built one and never wait for a reload.
+"""
+
+import bisect
+import ctypes
+import json
+import os
+import select
+import socketserver
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+from proj import daemon, matching
+from proj.exceptions import CommandError
+from proj.index import ArchiveIndex
+
+
+# how often to check for changes when polling, and to refresh regardless
+POLL_INTERVAL = 1.0
+REFRESH_INTERVAL = 60.0
+
+# after a change, wait this long for more before reloading, since archiving
+# or restoring a project changes several folders in quick succession
+SETTLE_TIME = 0.05
+
+# what inotify should tell us about: entries coming and going
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_ONLYDIR = 0x01000000
+IN_CLOEXEC = 0o2000000
+ENTRY_EVENTS = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+WATCH_MASK = ENTRY_EVENTS | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+
+@dataclass
+class Snapshot:
+    # (quarter, filename, name) for every project, sorted as in the index
+    rows: List[Tuple[str, str, str]] = field(default_factory=list)
+    # every project name, sorted, and the archived copies of each
+    names: List[str] = field(default_factory=list)
+    by_name: Dict[str, List[str]] = field(default_factory=dict)
+    n_quarters: int = 0
+    loaded_at: float = 0.0
+
+    @classmethod
+    def build(cls, rows: List[Tuple[str, str, str]], n_quarters: int) -> "Snapshot":
+        by_name: Dict[str, List[str]] = {}
+        for quarter, filename, name in rows:
+            by_name.setdefault(name, []).append(os.path.join(quarter, filename))
+
+        for paths in by_name.values():
+            paths.sort()
+
+        return cls(rows, sorted(by_name), by_name, n_quarters, time.time())
+
+
+class Catalog:
+    def __init__(self, archive_dir: str) -> None:
+        self.archive_dir = archive_dir
+        self.snapshot = Snapshot()
+        self.quarters: Optional[Dict[str, Optional[int]]] = None
+        self.lock = threading.Lock()
+        # how we hear about changes, for the curious
+        self.watching = ""
+
+    def reload(self) -> bool:
+        "Bring the index up to date, and reload if it changed. Returns whether."
+        with self.lock, ArchiveIndex.open(self.archive_dir) as index:
+            quarters = index.quarters()
+            # a quarter changed too recently to trust its mtime may change again
+            # without its mtime showing it, so always reload those
+            if quarters == self.quarters and None not in quarters.values():
+                return False
+
+            self.snapshot = Snapshot.build(list(index.projects()), len(quarters))
+            self.quarters = quarters
+            return True
+
+    def answer(self, request: Dict[str, Any]) -> Any:
+        snapshot = self.snapshot
+        op = request["op"]
+        if op == "list":
+            is_match = matching.compile_matcher(
+                request.get("patterns", []),
+                regex=request.get("regex", False),
+                ignore_case=request.get("ignore_case", False),
+            )
+            return list(matching.unique_projects(snapshot.rows, is_match))
+
+        if op == "find":
+            return [snapshot.by_name.get(name, []) for name in request["names"]]
+
+        if op == "names":
+            prefix = request.get("prefix", "")
+            limit = request.get("limit", 100)
+            start = bisect.bisect_left(snapshot.names, prefix)
+            names = []
+            for name in snapshot.names[start : start + limit]:
+                if not name.startswith(prefix):
+                    break
+                names.append(name)
+            return names
+
+        if op == "stat":
+            return {
+                "archive_dir": self.archive_dir,
+                "projects": len(snapshot.rows),
+                "quarters": snapshot.n_quarters,
+                "loaded_at": snapshot.loaded_at,
+                "watching": self.watching,
+                "pid": os.getpid(),
+            }
+
+        if op == "refresh":
+            return self.reload()
+
+        raise CommandError(f"unknown request: {op}")
+
+
+class PollingWatcher:
+    "Hears about changes by waking up every so often to check."
+
+    name = "polling"
+
+    def wait(self, timeout: float) -> bool:
+        "Wait up to timeout seconds for a change, returning if there may be one."
+        time.sleep(min(timeout, POLL_INTERVAL))
+        return True
+
+    def close(self) -> None:
+        pass
+
+
+class InotifyWatcher:
+    "Hears about changes to the archive's year and quarter folders from inotify."
+
+    name = "inotify"
+
+    def __init__(self, archive_dir: str) -> None:
+        self.archive_dir = archive_dir
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        self._watch_all()
+
+    def wait(self, timeout: float) -> bool:
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return False
+
+        # let a burst of changes settle, then take them all at once
+        while readable:
+            os.read(self.fd, 64 * 1024)
+            readable, _, _ = select.select([self.fd], [], [], SETTLE_TIME)
+
+        # new year and quarter folders need watching too
+        self._watch_all()
+        return True
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+    def _watch_all(self) -> None:
+        for path in _watched_dirs(self.archive_dir):
+            # watching a folder again is harmless, and folders may vanish
+            self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+
+
+def make_watcher(archive_dir: str) -> Any:
+    "The best way we have of hearing about changes to the archive."
+    try:
+        return InotifyWatcher(archive_dir)
+
+    except (OSError, AttributeError):
+        # not Linux, or no inotify instances left
+        return PollingWatcher()
+
+
+class Handler(socketserver.StreamRequestHandler):
+    def handle(self) -> None:
+        catalog: Catalog = self.server.catalog  # type: ignore
+        for line in self.rfile:
+            try:
+                response = {"result": catalog.answer(json.loads(line))}
+
+            except CommandError as e:
+                response = {"error": str(e)}
+
+            except (ValueError, KeyError, TypeError) as e:
+                response = {"error": f"bad request: {e!r}"}
+
+            self.wfile.write(json.dumps(response).encode("utf8") + b"\n")
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class Daemon:
+    """
+    Serves the catalog of an archive on its socket: requests are answered on
+    a thread of their own, while the thread that calls run() watches for
+    changes and reloads.
+    """
+
+    def __init__(self, archive_dir: str) -> None:
+        if not os.path.isdir(archive_dir):
+            raise CommandError(f"archive directory does not exist: {archive_dir}")
+
+        self.archive_dir = archive_dir
+        self.socket_path = daemon.socket_path(archive_dir)
+        self.catalog = Catalog(archive_dir)
+        self.watcher: Any = None
+        self.server: Optional[Server] = None
+        self.stopped = threading.Event()
+
+    def start(self) -> None:
+        "Load the catalog, and start answering requests."
+        if daemon.query(self.archive_dir, {"op": "stat"}) is not None:
+            raise CommandError(f"already serving {self.archive_dir}")
+
+        self.catalog.reload()
+        self.watcher = make_watcher(self.archive_dir)
+        self.catalog.watching = self.watcher.name
+
+        # a socket left behind by a daemon that died
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+        os.makedirs(os.path.dirname(self.socket_path), exist_ok=True)
+        self.server = Server(self.socket_path, Handler)
+        os.chmod(self.socket_path, 0o600)
+        self.server.catalog = self.catalog  # type: ignore
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def run(self) -> None:
+        "Reload the catalog as the archive changes, until stopped."
+        last_refresh = time.monotonic()
+        try:
+            while not self.stopped.is_set():
+                changed = self.watcher.wait(POLL_INTERVAL)
+                if changed or time.monotonic() - last_refresh > REFRESH_INTERVAL:
+                    self.catalog.reload()
+                    last_refresh = time.monotonic()
+
+        finally:
+            self.watcher.close()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+
+def _watched_dirs(archive_dir: str) -> List[str]:
+    "The archive folder and its year and quarter folders."
+    years = _list_dirs(archive_dir)
+    return [archive_dir] + years + [q for year in years for q in _list_dirs(year)]
+
+
+def _list_dirs(path: str) -> List[str]:
+    try:
+        with os.scandir(path) as it:
+            return [
+                entry.path
+                for entry in it
+                if not entry.name.startswith(".") and entry.is_dir()
+            ]
+
+    except OSError:
+        return []
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+#
+#  throttle.py
+#  proj
+#
+
+"""
+Archiving gently on a busy machine, such as a shared build host, where
+reading a big project flat out would starve other programs of the disk.
+
+In throttled mode, proj:
+
+- reads at most so many bytes and makes at most so many reads a second,
+  shared between every file it reads and every project it archives at once
+- runs at low CPU and I/O priority, where the OS lets us set them
+- tells the OS it won't need what it read or wrote again, so that the page
+  cache keeps other programs' data rather than filling up with ours
+- backs off when its own reads get slow, which is a sign that the disk is
+  busy with something else, and speeds up again once they're quick
+
+Like metrics.py, this is switched on for the whole process, and the hooks in
+fs.py, compress.py and dedup.py cost next to nothing when it's off.
+"""
+
+import io
+import os
+import platform
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import BinaryIO, Iterator, Optional
+
+from proj import metrics
+
+
+# the most to read at once in throttled mode, so that no single read hogs
+# the disk, and so that the time a read takes tells us how busy the disk is
+CHUNK = 256 * 1024
+
+# a read of CHUNK taking longer than this means the disk is busy
+SLOW_READ = 0.05
+
+# while reads are slow, pause between them, doubling the pause for each slow
+# read and halving it for each quick one
+MIN_PAUSE = 0.01
+MAX_PAUSE = 1.0
+
+# how much nicer to be than we were started with
+NICENESS = 10
+
+# ioprio_set(2) isn't in the standard library, so we call it by number
+IOPRIO_SET = {"x86_64": 251, "aarch64": 30, "ppc64le": 273, "s390x": 282}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_SHIFT = 13
+# the lowest level of the best-effort class; the idle class would be lower,
+# but on a disk that is never idle it would never finish
+IOPRIO_CLASS_BE = 2
+IOPRIO_LOWEST = 7
+
+_lock = threading.Lock()
+_active: Optional["Throttle"] = None
+_users = 0
+_lowered = False
+
+
+class TokenBucket:
+    """
+    Allows `rate` units a second on average, in bursts of up to a second's
+    worth. Taking more than there is borrows from the future, and the taker
+    waits until it is paid back.
+    """
+
+    def __init__(self, rate: float) -> None:
+        self.rate = rate
+        self.tokens = rate
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, n: float) -> float:
+        "Take n units, returning how long to wait before using them."
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= n
+            return max(0.0, -self.tokens / self.rate)
+
+
+class Throttle:
+    "A budget of bytes and reads a second, with a back-off for slow reads."
+
+    def __init__(self, bytes_per_s: float = 0, ops_per_s: float = 0) -> None:
+        self.bytes = TokenBucket(bytes_per_s) if bytes_per_s > 0 else None
+        self.ops = TokenBucket(ops_per_s) if ops_per_s > 0 else None
+        self.pause = 0.0
+        self.lock = threading.Lock()
+
+    def delay(self, n_bytes: int, seconds: float, ops: int = 1) -> float:
+        """
+        Account for reading n_bytes in `ops` reads that took `seconds`,
+        returning how long to wait before reading more.
+        """
+        with self.lock:
+            if seconds > SLOW_READ:
+                self.pause = min(MAX_PAUSE, max(MIN_PAUSE, 2 * self.pause))
+            elif self.pause:
+                self.pause = self.pause / 2 if self.pause >= 2 * MIN_PAUSE else 0.0
+            wait = self.pause
+
+        if self.bytes:
+            wait = max(wait, self.bytes.take(n_bytes))
+        if self.ops:
+            wait = max(wait, self.ops.take(ops))
+
+        return wait
+
+    def done(self, n_bytes: int, seconds: float, ops: int = 1) -> None:
+        "Account for some reads, waiting as long as the budget needs."
+        wait = self.delay(n_bytes, seconds, ops)
+        if wait > 0:
+            with metrics.phase("throttled"):
+                time.sleep(wait)
+
+
+class ThrottledReader(io.RawIOBase):
+    "Reads a file at most CHUNK at a time, within the budget."
+
+    def __init__(self, raw: BinaryIO, throttle: Throttle) -> None:
+        self.raw = raw
+        self.throttle = throttle
+        self.offset = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:  # type: ignore
+        view = memoryview(b)[:CHUNK]
+        start = time.perf_counter()
+        n = self.raw.readinto(view)  # type: ignore
+        self.throttle.done(n, time.perf_counter() - start)
+        if n:
+            forget(self.raw.fileno(), self.offset, n)
+            self.offset += n
+        return n
+
+    def close(self) -> None:
+        self.raw.close()
+        super().close()
+
+
+@contextmanager
+def running(bytes_per_s: float = 0, ops_per_s: float = 0) -> Iterator[Throttle]:
+    """
+    Throttle proj's reads until the last of its users is done, lowering our
+    priority for good. Several users at once share the first one's budget.
+    """
+    global _active, _users
+
+    with _lock:
+        if _active is None:
+            _active = Throttle(bytes_per_s, ops_per_s)
+            lower_priority()
+        _users += 1
+        throttle = _active
+
+    try:
+        yield throttle
+
+    finally:
+        with _lock:
+            _users -= 1
+            if not _users:
+                _active = None
+
+
+def active() -> Optional[Throttle]:
+    return _active
+
+
+def open_file(path: str, buffering: int = -1) -> BinaryIO:
+    "Open a file to read, throttled if throttling is on."
+    throttle = _active
+    if throttle is None:
+        return open(path, "rb", buffering=buffering)
+
+    # opening a file costs a read of its metadata
+    throttle.done(0, 0.0)
+    raw = open(path, "rb", buffering=0)
+    return io.BufferedReader(ThrottledReader(raw, throttle), CHUNK)  # type: ignore
+
+
+def copied(infd: int, outfd: int, offset: int, n_bytes: int, seconds: float) -> None:
+    "Account for copying part of a file, if throttling is on."
+    throttle = _active
+    if throttle is None:
+        return
+
+    throttle.done(n_bytes, seconds)
+    if n_bytes:
+        forget(infd, offset, n_bytes)
+        forget(outfd, offset, n_bytes)
+
+
+def forget(fd: int, offset: int = 0, length: int = 0) -> None:
+    """
+    Tell the OS we won't need part of a file again, so it can drop it from
+    the page cache, if throttling is on. Pages not yet written are written
+    out first, so only drop what's been written once it's synced.
+    """
+    if _active is None or not hasattr(os, "posix_fadvise"):
+        return
+
+    metrics.count(syscalls=1)
+    try:
+        os.posix_fadvise(fd, offset, length, os.POSIX_FADV_DONTNEED)
+    except OSError:
+        pass
+
+
+def lower_priority() -> None:
+    "Run at low CPU and I/O priority from now on, as far as the OS allows."
+    global _lowered
+
+    if _lowered:
+        return
+    _lowered = True
+
+    # threads inherit these from the one that started them, so this must
+    # happen before any worker threads are started
+    try:
+        os.nice(NICENESS)
+    except (AttributeError, OSError):
+        pass
+
+    _set_ioprio(IOPRIO_CLASS_BE, IOPRIO_LOWEST)
+
+
+def _set_ioprio(io_class: int, level: int) -> bool:
+    number = IOPRIO_SET.get(platform.machine())
+    if not sys.platform.startswith("linux") or number is None:
+        return False
+
+    import ctypes
+
+    libc = ctypes.CDLL(None, use_errno=True)
+    ioprio = io_class << IOPRIO_CLASS_SHIFT | level
+    return libc.syscall(number, IOPRIO_WHO_PROCESS, 0, ioprio) == 0
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+#
+#  tiers.py
+#  proj
+#
+
+"""
+Keeping older quarters of the archive somewhere slower and cheaper.
+
+The archive directory in the config is the first tier, and holds recent
+quarters. Colder tiers each take the quarters from a given age onwards:
+
+    archive_dir: /ssd/archive
+    tiers:
+      - archive_dir: /bulk/archive
+        after_quarters: 8
+
+Here the last eight quarters live on the SSD and everything older on the bulk
+volume. Projects are archived straight to the tier their quarter belongs in,
+and `proj migrate` moves quarters down as they age. Each tier has its own
+index (see index.py), and commands that look for projects search every tier
+at once.
+
+Chunks of dedup archives and the restore cache stay in the first tier.
+"""
+
+import datetime as dt
+import os
+from dataclasses import dataclass
+from typing import List, Optional
+
+from proj.configfile import Config
+from proj.exceptions import CommandError
+
+
+@dataclass(frozen=True)
+class Tier:
+    archive_dir: str
+
+    # quarters at least this many quarters old belong here
+    after_quarters: int = 0
+
+
+def tiers_for(config: Config) -> List[Tier]:
+    "The tiers of the archive, hottest first."
+    tiers = [Tier(config.archive_dir)]
+    for i, record in enumerate(config.tiers, 1):
+        try:
+            tier = Tier(str(record["archive_dir"]), int(record["after_quarters"]))
+
+        except (KeyError, TypeError, ValueError):
+            raise CommandError(f"tier {i} needs an archive_dir and after_quarters")
+
+        if tier.after_quarters < 1:
+            raise CommandError(f"tier {i} must be for quarters at least 1 old")
+
+        tiers.append(tier)
+
+    tiers.sort(key=lambda t: t.after_quarters)
+    ages = [t.after_quarters for t in tiers]
+    dirs = [os.path.abspath(t.archive_dir) for t in tiers]
+    if len(set(ages)) < len(ages) or len(set(dirs)) < len(dirs):
+        raise CommandError("each tier needs an archive_dir and age of its own")
+
+    return tiers
+
+
+def archive_dirs(config: Config) -> List[str]:
+    "Every tier's archive directory, hottest first."
+    return [tier.archive_dir for tier in tiers_for(config)]
+
+
+def quarter_age(year: str, quarter: str, now: Optional[dt.datetime] = None) -> int:
+    "How many quarters ago a year/quarter was, e.g. 1 for last quarter."
+    now = now or dt.datetime.now(dt.timezone.utc)
+    this_quarter = now.year * 4 + (now.month - 1) // 3
+    return this_quarter - (int(year) * 4 + int(quarter.lstrip("q")) - 1)
+
+
+def tier_for(
+    tiers: List[Tier], year: str, quarter: str, now: Optional[dt.datetime] = None
+) -> Tier:
+    "The coldest tier a quarter is old enough for."
+    age = quarter_age(year, quarter, now=now)
+    old_enough = [tier for tier in tiers if tier.after_quarters <= age]
+    # a quarter from the future, by a clock somewhere, is as recent as can be
+    return old_enough[-1] if old_enough else tiers[0]
+
+
+def tier_of(tiers: List[Tier], path: str) -> Optional[Tier]:
+    "The tier holding an archived path, if any does."
+    path = os.path.abspath(path)
+    for tier in tiers:
+        if path.startswith(os.path.join(os.path.abspath(tier.archive_dir), "")):
+            return tier
+
+    return None
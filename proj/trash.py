@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+#
+#  trash.py
+#  proj
+#
+
+"""
+Deleting archived projects in the background.
+
+Removing a big project file by file can take as long as archiving it did.
+Instead, once its archive is safely on disk, the project is renamed into a
+trash folder beside it, which is a single rename on the same filesystem,
+along with a manifest of what was archived. A detached process then deletes
+it from there on several threads, and `proj gc` finishes any that were
+interrupted.
+
+Only what the manifest lists is deleted. Anything that appeared in the
+project while it was being archived is put back where the project was, just
+as removing the project in place would have left it behind.
+
+Each trash entry is a folder holding the manifest and the project itself.
+Whoever is creating or emptying an entry holds a lock on its manifest, so
+several deleters can work on the same trash without getting in each other's
+way.
+"""
+
+import fcntl
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import IO, List, Optional, Tuple
+
+from proj import fs, metrics
+
+
+TRASH_DIR = ".proj-trash"
+TRASH_VERSION = 1
+
+MANIFEST = "manifest.json"
+TREE = "tree"
+
+DELETE_THREADS = 8
+
+# files to unlink in one go on each thread
+BATCH_SIZE = 1000
+
+# an entry with no manifest this old was abandoned before it was filled
+ABANDONED_AFTER = 60 * 60
+
+
+@dataclass
+class Emptied:
+    # where the project used to be
+    source: str
+    files: int
+    # where anything added while archiving ended up, if anything was
+    kept: Optional[str] = None
+    # why it couldn't be emptied, in which case source is the trash entry
+    error: Optional[str] = None
+
+
+def trash_dir_for(src_path: str) -> str:
+    "The trash on the same filesystem as a project, in the folder holding it."
+    return os.path.join(os.path.dirname(os.path.abspath(src_path)), TRASH_DIR)
+
+
+def discard(
+    src_path: str,
+    trash_dir: str,
+    files: Optional[List[str]] = None,
+    dirs: Optional[List[str]] = None,
+    ignored: Optional[List[os.DirEntry]] = None,
+) -> bool:
+    """
+    Move an archived project into the trash to be deleted later. The files,
+    folders and ignored entries are what a walk of it found (see
+    fs.remove_walked), or None to delete everything in it.
+
+    If the project can't be renamed into the trash, it is removed in place
+    instead, and we return False.
+    """
+    entry = os.path.join(
+        trash_dir, f"{os.path.basename(os.path.abspath(src_path))}.{time.time_ns()}"
+    )
+    manifest = _manifest(src_path, files, dirs, ignored)
+    try:
+        fs.mkdir(entry)
+        tmp_file = os.path.join(entry, MANIFEST + ".tmp")
+        with open(tmp_file, "w") as ostream:
+            _lock(ostream)
+            json.dump(manifest, ostream, separators=(",", ":"))
+            ostream.flush()
+            os.replace(tmp_file, os.path.join(entry, MANIFEST))
+            os.rename(src_path, os.path.join(entry, TREE))
+            metrics.count(syscalls=4)
+
+    except OSError:
+        shutil.rmtree(entry, ignore_errors=True)
+        if files is None:
+            _remove_everything(src_path)
+        else:
+            fs.remove_walked(files, dirs or [], ignored)
+        return False
+
+    return True
+
+
+def empty(trash_dir: str, threads: int = DELETE_THREADS) -> List[Emptied]:
+    """
+    Delete everything in the trash that nobody else is deleting already,
+    returning what was deleted. An entry we can't empty doesn't stop the
+    rest, it comes back with its error instead.
+    """
+    if not os.path.isdir(trash_dir):
+        return []
+
+    emptied = []
+    for name in sorted(os.listdir(trash_dir)):
+        entry = os.path.join(trash_dir, name)
+        try:
+            result = _empty_entry(entry, threads)
+        except OSError as e:
+            result = Emptied(entry, 0, error=f"couldn't empty {entry}: {e}")
+
+        if result:
+            emptied.append(result)
+
+    try:
+        os.rmdir(trash_dir)
+    except OSError:
+        pass
+
+    return emptied
+
+
+def empty_later(trash_dir: str) -> bool:
+    """
+    Start a process that empties the trash after we've exited, if there's
+    anything in it. Returns whether we did.
+    """
+    try:
+        if not os.listdir(trash_dir):
+            return False
+
+    except FileNotFoundError:
+        return False
+
+    # make sure it runs the same proj as we are, installed or not
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    python_path = os.pathsep.join(
+        p for p in [package_root, os.environ.get("PYTHONPATH")] if p
+    )
+    subprocess.Popen(
+        [sys.executable, "-m", "proj.trash", trash_dir],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        env=dict(os.environ, PYTHONPATH=python_path),
+        start_new_session=True,
+    )
+    return True
+
+
+def _manifest(
+    src_path: str,
+    files: Optional[List[str]],
+    dirs: Optional[List[str]],
+    ignored: Optional[List[os.DirEntry]],
+) -> dict:
+    # paths from the walk start with src_path, so slicing is much cheaper than
+    # os.path.relpath() for a million files
+    prefix = len(os.path.join(src_path, ""))
+
+    def rel(path: str) -> str:
+        return path[prefix:] if path != src_path else ""
+
+    record: dict = {
+        "version": TRASH_VERSION,
+        "source": os.path.abspath(src_path),
+        "files": None,
+        "dirs": [],
+        "ignored": [],
+    }
+    if files is not None:
+        record["files"] = [rel(p) for p in files]
+        record["dirs"] = [rel(p) for p in dirs or []]
+        record["ignored"] = [
+            [rel(e.path), e.is_dir(follow_symlinks=False)] for e in ignored or []
+        ]
+
+    return record
+
+
+def _empty_entry(entry: str, threads: int) -> Optional[Emptied]:
+    manifest_file = os.path.join(entry, MANIFEST)
+    tree = os.path.join(entry, TREE)
+    try:
+        istream = open(manifest_file)
+
+    except FileNotFoundError:
+        # being made right now, or abandoned before the project was moved in
+        if not os.path.lexists(tree) and _age(entry) > ABANDONED_AFTER:
+            shutil.rmtree(entry, ignore_errors=True)
+        return None
+
+    with istream:
+        try:
+            _lock(istream)
+        except BlockingIOError:
+            return None
+
+        if not os.path.exists(manifest_file):
+            # emptied by someone else between listing and locking
+            return None
+
+        record = json.load(istream)
+        if record.get("version") != TRASH_VERSION:
+            return None
+
+        n_files = _delete(tree, record, threads)
+
+        kept = None
+        if os.path.lexists(tree):
+            kept = _put_back(tree, record["source"])
+
+        if kept != tree:
+            os.unlink(manifest_file)
+            os.rmdir(entry)
+
+    return Emptied(record["source"], n_files, kept)
+
+
+def _delete(tree: str, record: dict, threads: int) -> int:
+    "Delete what the manifest lists, returning the number of files."
+    if not os.path.lexists(tree):
+        return 0
+
+    if record["files"] is None:
+        files, dirs = _walk(tree)
+        ignored: List[Tuple[str, bool]] = []
+    else:
+        files = [_join(tree, p) for p in record["files"]]
+        dirs = [_join(tree, p) for p in record["dirs"]]
+        ignored = [(_join(tree, p), is_dir) for p, is_dir in record["ignored"]]
+
+    batches = [files[i : i + BATCH_SIZE] for i in range(0, len(files), BATCH_SIZE)]
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(_unlink_all, batches))
+        list(pool.map(_remove_ignored, ignored))
+
+    metrics.count(syscalls=len(files) + len(ignored))
+
+    for path in reversed(dirs):
+        try:
+            metrics.count(syscalls=1)
+            os.rmdir(path)
+        except OSError:
+            pass
+
+    return len(files)
+
+
+def _put_back(tree: str, source: str) -> str:
+    "Put back what was added while archiving, unless the project is back."
+    if os.path.lexists(source):
+        return tree
+
+    try:
+        os.rename(tree, source)
+    except OSError:
+        return tree
+
+    return source
+
+
+def _walk(tree: str) -> Tuple[List[str], List[str]]:
+    if not os.path.isdir(tree) or os.path.islink(tree):
+        return [tree], []
+
+    files: List[str] = []
+    dirs: List[str] = []
+    for folder in fs.scan_tree(tree):
+        dirs.append(folder.path)
+        files.extend(e.path for e in folder.files + folder.dir_links)
+
+    return files, dirs
+
+
+def _unlink_all(paths: List[str]) -> None:
+    for path in paths:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            # deleted already, by an earlier attempt that was interrupted
+            pass
+
+
+def _remove_ignored(item: Tuple[str, bool]) -> None:
+    path, is_dir = item
+    if is_dir:
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        _unlink_all([path])
+
+
+def _remove_everything(path: str) -> None:
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.unlink(path)
+
+
+def _join(tree: str, rel_path: str) -> str:
+    return os.path.join(tree, rel_path) if rel_path else tree
+
+
+def _lock(f: IO) -> None:
+    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+
+def _age(path: str) -> float:
+    try:
+        return time.time() - os.lstat(path).st_mtime
+    except OSError:
+        return 0.0
+
+
+if __name__ == "__main__":
+    empty(sys.argv[1])
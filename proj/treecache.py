@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+#
+#  treecache.py
+#  proj
+#
+
+"""
+A persistent summary of each project's tree, so that walking a project again
+costs a stat per folder rather than a stat per file.
+
+For every folder in a project we remember the newest mtime, total size and
+count of the files directly inside it, along with the folder's own inode,
+mtime and ctime. Creating, removing or renaming a file changes its folder's
+mtime, so a folder that looks the same as last time can be summarised
+without listing it or statting its files. The ctime catches tools like tar
+and rsync that put an old mtime back.
+
+The catch is that a file edited in place, rather than replaced, doesn't
+touch its folder, and goes unnoticed until something else in that folder
+changes. Most editors save by replacing the file, but not everything does,
+which is why the cache is opt-in with ``mtime_cache: true``.
+"""
+
+import hashlib
+import json
+import os
+import time
+from typing import Any, Dict, List, Optional
+
+from proj import fs, metrics
+from proj.ignore import IgnoreRules
+
+
+CACHE_SUBDIR = "trees"
+
+# don't trust a folder that changed this recently, since it may change again
+# within the same timestamp tick
+GRACE_NS = 2 * 10 ** 9
+
+
+class TreeCache:
+    def __init__(
+        self, root: str, cache_file: str, rules: Optional[IgnoreRules] = None
+    ) -> None:
+        self.root = os.path.abspath(root)
+        self.cache_file = cache_file
+        self.rules = rules
+
+        # folder summaries keyed by path relative to the root, as they were
+        # on the last walk and as they are on this one
+        self.old: Dict[str, List[Any]] = self._load()
+        self.new: Dict[str, List[Any]] = {}
+
+    @classmethod
+    def for_project(
+        cls, root: str, cache_dir: str, rules: Optional[IgnoreRules] = None
+    ) -> "TreeCache":
+        key = hashlib.sha1(os.fsencode(os.path.abspath(root))).hexdigest()
+        cache_file = os.path.join(cache_dir, CACHE_SUBDIR, f"{key}.json")
+        return cls(root, cache_file, rules=rules)
+
+    def tree_stats(self) -> fs.TreeStats:
+        "Summarise the project like fs.tree_stats(), then save the cache."
+        if not os.path.isdir(self.root) or os.path.islink(self.root):
+            return fs.tree_stats(self.root)
+
+        self.new = {}
+        stats = fs.tree_stats(self.root, scan=self.scan_dir)
+        if self.new != self.old:
+            self._save()
+
+        return stats
+
+    def scan_dir(self, path: str, stat: bool) -> fs.DirScan:
+        """
+        Summarise a folder from the cache if it hasn't changed, or list it
+        again if it has. Folders from the cache have no file entries.
+        """
+        rel_path = os.path.relpath(path, self.root)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return fs.DirScan(path)
+
+        metrics.count(syscalls=1)
+        signature = self._signature(rel_path, st)
+        cached = self.old.get(rel_path)
+        if cached and cached[0] == signature:
+            _, latest, size, n_files, subdirs = cached
+            self.new[rel_path] = cached
+            return fs.DirScan(
+                path,
+                subdirs=[os.path.join(path, d) for d in subdirs],
+                latest=latest,
+                size=size,
+                n_files=n_files,
+            )
+
+        scan = self._list(path)
+        if time.time_ns() - max(st.st_mtime_ns, st.st_ctime_ns) > GRACE_NS:
+            subdirs = [os.path.basename(d) for d in scan.subdirs]
+            self.new[rel_path] = [
+                signature,
+                scan.latest,
+                scan.size,
+                scan.n_files,
+                subdirs,
+            ]
+
+        return scan
+
+    def _signature(self, rel_path: str, st: os.stat_result) -> List[Any]:
+        "What has to stay the same for a folder's summary to still hold."
+        return [st.st_ino, st.st_mtime_ns, st.st_ctime_ns]
+
+    def _list(self, path: str) -> fs.DirScan:
+        "List a folder that has changed, statting its files."
+        ignore = self.rules.for_dir(path) if self.rules else None
+        return fs.scan_dir(path, stat=True, ignore=ignore)
+
+    def forget(self) -> None:
+        "Drop the cache, e.g. once the project has been archived."
+        if os.path.exists(self.cache_file):
+            os.unlink(self.cache_file)
+
+    def _rules_fingerprint(self) -> Optional[str]:
+        return self.rules.fingerprint if self.rules else None
+
+    def _load(self) -> Dict[str, List[Any]]:
+        try:
+            with open(self.cache_file) as istream:
+                record = json.load(istream)
+
+        except (OSError, ValueError):
+            return {}
+
+        if not isinstance(record, dict) or record.get("root") != self.root:
+            return {}
+
+        # the summaries only hold for the rules they were made with
+        if record.get("rules") != self._rules_fingerprint():
+            return {}
+
+        return record.get("dirs", {})
+
+    def _save(self) -> None:
+        "Save the cache, and don't worry if we can't."
+        record = {
+            "root": self.root,
+            "rules": self._rules_fingerprint(),
+            "dirs": self.new,
+        }
+        try:
+            fs.write_atomic(self.cache_file, json.dumps(record).encode("utf8"))
+
+        except OSError:
+            pass
@@ -13,3 +13,14 @@ import click
 def bail(message: str) -> NoReturn:
     click.echo(message, err=True)
     sys.exit(1)
+
+
+def format_size(n_bytes: float) -> str:
+    "Describe a number of bytes in human-friendly units."
+    for unit in ["B", "KB", "MB", "GB", "TB"]:
+        if n_bytes < 1024 or unit == "TB":
+            break
+
+        n_bytes /= 1024
+
+    return f"{n_bytes:.0f} {unit}" if unit == "B" else f"{n_bytes:.1f} {unit}"
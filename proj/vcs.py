@@ -0,0 +1,347 @@
+# -*- coding: utf-8 -*-
+#
+#  vcs.py
+#  proj
+#
+
+"""
+Work out when a git repository was last worked on from its metadata, read
+straight from the .git folder, instead of from every file in it.
+
+A repository's last activity is the newest of:
+
+- its reflogs, which record every commit, checkout, merge, stash and so on
+- the index, which records each file's mtime when it was last staged
+- files in the working tree that have changed since they were staged, or
+  that git doesn't track, leaving out what .gitignore ignores
+
+Nothing under .git/objects is read, no git command is run, and nothing
+touches the network. Only the top-level .gitignore and .git/info/exclude are
+read, and negated patterns in them are skipped.
+
+Comparing the working tree with the index means a stat per file. With the
+mtime cache on (see treecache.py), a folder that hasn't changed since the
+last walk, and whose entries in the index haven't either, is summarised
+without looking at its files, so only changed folders cost a stat per file.
+"""
+
+import hashlib
+import os
+import re
+import struct
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from proj import fs, metrics
+from proj.ignore import IgnoreRules, read_patterns
+from proj.treecache import TreeCache
+
+
+GIT_DIR = ".git"
+
+# the reflogs worth reading; remote-tracking branches move when we fetch,
+# which isn't work on the project
+REFLOGS = ["HEAD", "refs/heads", "refs/stash"]
+
+# how far from the end of a reflog to look for its last entry
+REFLOG_TAIL = 4096
+
+# the stat data at the start of each index entry that we need: the mtime in
+# seconds and nanoseconds, and the size
+INDEX_ENTRY = struct.Struct(">8xII20xI")
+INDEX_EXTENDED = 0x4000
+
+
+class GitRepo:
+    def __init__(self, root: str, git_dir: str, common_dir: str) -> None:
+        self.root = root
+        self.git_dir = git_dir
+
+        # shared between worktrees, and the same as git_dir without them
+        self.common_dir = common_dir
+
+    @classmethod
+    def find(cls, root: str) -> Optional["GitRepo"]:
+        "The repository at the top of a folder, if there is one."
+        dot_git = os.path.join(root, GIT_DIR)
+        if os.path.isdir(dot_git):
+            git_dir = dot_git
+
+        elif os.path.isfile(dot_git):
+            # worktrees and submodules point elsewhere with "gitdir: <path>"
+            with open(dot_git) as istream:
+                line = istream.readline().strip()
+
+            if not line.startswith("gitdir:"):
+                return None
+
+            git_dir = os.path.join(root, line[len("gitdir:") :].strip())
+
+        else:
+            return None
+
+        common_dir = git_dir
+        try:
+            with open(os.path.join(git_dir, "commondir")) as istream:
+                common_dir = os.path.join(git_dir, istream.read().strip())
+
+        except OSError:
+            pass
+
+        return cls(root, git_dir, common_dir)
+
+    def tree_stats(
+        self,
+        patterns: Optional[List[str]] = None,
+        stop_after: Optional[float] = None,
+        cache_file: Optional[str] = None,
+    ) -> fs.TreeStats:
+        """
+        Summarise the working tree like fs.tree_stats(), except that its
+        latest time is when the repository was last worked on. The size and
+        number of files don't count .git or anything ignored.
+
+        Like fs.tree_stats(), it stops early if all we need to know is that
+        there was activity after `stop_after`. Given a cache file, folders
+        are summarised from it where they can be, and the whole tree is
+        walked to keep it complete.
+
+        Raises ValueError if the index can't be understood.
+        """
+        index = read_index(
+            os.path.join(self.git_dir, "index"), hash_size=self._hash_size()
+        )
+
+        times = [sec + ns / 1e9 for sec, ns, _ in index.values()]
+        ref_update = self.last_ref_update()
+        if ref_update is not None:
+            times.append(ref_update)
+
+        latest = max(times, default=None)
+        if stop_after is not None and latest is not None and latest > stop_after:
+            return fs.TreeStats(latest=latest)
+
+        patterns = list(patterns or []) + [GIT_DIR]
+        for filename in [
+            os.path.join(self.root, ".gitignore"),
+            os.path.join(self.common_dir, "info", "exclude"),
+        ]:
+            patterns += [p for p in read_patterns(filename) if not p.startswith("!")]
+
+        rules = IgnoreRules(self.root, patterns)
+
+        if cache_file:
+            stats = GitTreeCache(self, index, rules, cache_file).tree_stats()
+
+        else:
+
+            def scan_dir(path: str, stat: bool) -> fs.DirScan:
+                return self._scan_changes(path, rules, index)
+
+            stats = fs.tree_stats(self.root, scan=scan_dir, stop_after=stop_after)
+
+        if latest is not None and (stats.latest is None or latest > stats.latest):
+            stats.latest = latest
+
+        return stats
+
+    def last_ref_update(self) -> Optional[float]:
+        "The time of the newest entry in any of the reflogs that matter."
+        times = []
+        for name in REFLOGS:
+            base_dir = self.git_dir if name == "HEAD" else self.common_dir
+            for filename in _walk_files(os.path.join(base_dir, "logs", name)):
+                t = _last_reflog_time(filename)
+                if t is not None:
+                    times.append(t)
+
+        return max(times, default=None)
+
+    def _scan_changes(
+        self, path: str, rules: IgnoreRules, index: Dict[str, Tuple[int, int, int]]
+    ) -> fs.DirScan:
+        """
+        List a folder, keeping the usual size and count of its files, but
+        only counting towards its latest time the files that differ from the
+        index, like `git status` would.
+        """
+        scan = fs.scan_dir(path, stat=False, ignore=rules.for_dir(path))
+
+        rel_dir = os.path.relpath(path, self.root).replace(os.sep, "/")
+        prefix = "" if rel_dir == "." else f"{rel_dir}/"
+        for entry in scan.files:
+            if entry.is_symlink():
+                continue
+
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+
+            scan.size += st.st_size
+            scan.n_files += 1
+
+            # git's own quick check for whether a file has changed
+            staged = index.get(prefix + entry.name)
+            if staged and staged[0] == int(st.st_mtime):
+                if staged[2] == st.st_size & 0xFFFFFFFF:
+                    continue
+
+            if scan.latest is None or st.st_mtime > scan.latest:
+                scan.latest = st.st_mtime
+
+        metrics.count(syscalls=scan.n_files)
+        return scan
+
+    def _hash_size(self) -> int:
+        "Repositories using SHA-256 have longer object ids in the index."
+        try:
+            with open(os.path.join(self.common_dir, "config")) as istream:
+                config = istream.read()
+
+        except OSError:
+            return 20
+
+        return 32 if re.search(r"objectformat\s*=\s*sha256", config, re.I) else 20
+
+
+class GitTreeCache(TreeCache):
+    """
+    A tree cache of folders summarised by comparing their files with the
+    index. Staging or unstaging a file changes its folder's summary without
+    touching the folder, so each folder's entries in the index are part of
+    what has to stay the same.
+    """
+
+    def __init__(
+        self,
+        repo: GitRepo,
+        index: Dict[str, Tuple[int, int, int]],
+        rules: IgnoreRules,
+        cache_file: str,
+    ) -> None:
+        self.repo = repo
+        self.index = index
+        self.staged = _digest_by_dir(index)
+        super().__init__(repo.root, cache_file, rules=rules)
+
+    def _signature(self, rel_path: str, st: os.stat_result) -> List[Any]:
+        return super()._signature(rel_path, st) + [self.staged.get(rel_path)]
+
+    def _list(self, path: str) -> fs.DirScan:
+        return self.repo._scan_changes(path, self.rules, self.index)  # type: ignore
+
+    def _rules_fingerprint(self) -> Optional[str]:
+        # summaries of changed files only, not of every file
+        return f"git:{super()._rules_fingerprint()}"
+
+
+def _digest_by_dir(index: Dict[str, Tuple[int, int, int]]) -> Dict[str, str]:
+    "A digest of the index entries directly inside each folder, by its path."
+    hashes: Dict[str, Any] = {}
+    for path, (mtime_s, mtime_ns, size) in index.items():
+        rel_dir, _, name = path.rpartition("/")
+        key = rel_dir.replace("/", os.sep) if rel_dir else "."
+        if key not in hashes:
+            hashes[key] = hashlib.sha1()
+        hashes[key].update(f"{name}\0{mtime_s}\0{mtime_ns}\0{size}\n".encode())
+
+    return {key: h.hexdigest() for key, h in hashes.items()}
+
+
+def read_index(filename: str, hash_size: int = 20) -> Dict[str, Tuple[int, int, int]]:
+    """
+    Read the path, mtime in seconds and nanoseconds, and size (modulo 2**32)
+    of every entry in a git index file. A missing index is an empty one.
+    Raises ValueError for anything we don't understand.
+    """
+    try:
+        with open(filename, "rb") as istream:
+            data = istream.read()
+
+    except FileNotFoundError:
+        return {}
+
+    metrics.count(bytes_read=len(data), syscalls=1)
+    if len(data) < 12 or data[:4] != b"DIRC":
+        raise ValueError(f"not a git index: {filename}")
+
+    version, n_entries = struct.unpack_from(">II", data, 4)
+    if version not in (2, 3, 4):
+        raise ValueError(f"unsupported git index version {version}: {filename}")
+
+    entries = {}
+    offset = 12
+    path = b""
+    try:
+        for _ in range(n_entries):
+            mtime_s, mtime_ns, size = INDEX_ENTRY.unpack_from(data, offset)
+            flags_at = offset + INDEX_ENTRY.size + hash_size
+            (flags,) = struct.unpack_from(">H", data, flags_at)
+            path_at = flags_at + 2
+            if version >= 3 and flags & INDEX_EXTENDED:
+                path_at += 2
+
+            if version == 4:
+                # each path drops some bytes from the end of the last one,
+                # then adds its own
+                strip, path_at = _varint(data, path_at)
+                end = data.index(b"\0", path_at)
+                path = path[: len(path) - strip] + data[path_at:end]
+                offset = end + 1
+            else:
+                end = data.index(b"\0", path_at)
+                path = data[path_at:end]
+                # entries are padded with NULs to a multiple of eight bytes
+                offset += (end - offset + 8) & ~7
+
+            entries[os.fsdecode(path)] = (mtime_s, mtime_ns, size)
+
+    except (struct.error, ValueError):
+        raise ValueError(f"corrupt git index: {filename}")
+
+    return entries
+
+
+def _varint(data: bytes, offset: int) -> Tuple[int, int]:
+    "Decode one of git's offset varints, returning it and the next offset."
+    c = data[offset]
+    value = c & 0x7F
+    while c & 0x80:
+        offset += 1
+        c = data[offset]
+        value = ((value + 1) << 7) | (c & 0x7F)
+
+    return value, offset + 1
+
+
+def _last_reflog_time(filename: str) -> Optional[float]:
+    """
+    The time of the last entry in a reflog, whose lines look like:
+
+        <old> <new> A U Thor <author@example.com> 1600000000 +1000\t<message>
+    """
+    try:
+        with open(filename, "rb") as istream:
+            istream.seek(0, os.SEEK_END)
+            istream.seek(max(0, istream.tell() - REFLOG_TAIL))
+            tail = istream.read()
+
+    except OSError:
+        return None
+
+    last_line = tail.rstrip(b"\n").rsplit(b"\n", 1)[-1]
+    try:
+        return float(last_line.split(b"\t", 1)[0].rsplit(b" ", 2)[1])
+
+    except (IndexError, ValueError):
+        return None
+
+
+def _walk_files(path: str) -> Iterator[str]:
+    if os.path.isfile(path):
+        yield path
+        return
+
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            yield os.path.join(dirpath, filename)
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+#
+#  test_completion.py
+#  proj
+#
+
+import os
+from os import path
+import shutil
+import tempfile
+import time
+from unittest.mock import patch
+
+from proj import completion, fs
+from proj.configfile import Config
+from proj.index import ArchiveIndex
+
+
+class TestCompletion:
+    def setup_method(self):
+        self.archive = tempfile.mkdtemp()
+        for relpath in [
+            "2001/q1/abacus",
+            "2001/q1/abbey.tar.gz",
+            "2003/q2/abbey",
+            "2003/q2/zebra.zip",
+        ]:
+            fs.mkdir(path.join(self.archive, relpath))
+
+        self.config = Config(archive_dir=self.archive)
+
+        # build the index, as archiving or listing would have done
+        ArchiveIndex.open(self.archive).close()
+
+    def teardown_method(self):
+        shutil.rmtree(self.archive)
+
+    def complete(self, prefix):
+        with patch.object(Config, "autoload", return_value=self.config):
+            return completion.complete_projects(prefix)
+
+    def test_complete_by_prefix(self):
+        assert self.complete("ab") == ["abacus", "abbey"]
+        assert self.complete("abb") == ["abbey"]
+        assert self.complete("z") == ["zebra"]
+        assert self.complete("q") == []
+
+    def test_complete_everything(self):
+        assert self.complete("") == ["abacus", "abbey", "zebra"]
+
+    def test_complete_without_config(self):
+        with patch.object(Config, "autoload", side_effect=Exception):
+            assert completion.complete_projects("ab") == []
+
+    def test_complete_without_archive(self):
+        os.rename(self.archive, self.archive + ".moved")
+        try:
+            assert self.complete("ab") == []
+        finally:
+            os.rename(self.archive + ".moved", self.archive)
+
+    def test_complete_across_tiers(self):
+        cold = path.join(self.archive, ".cold")
+        fs.mkdir(path.join(cold, "1999", "q1", "abalone"))
+        fs.mkdir(path.join(cold, "1999", "q1", "abbey.tar.bz2"))
+        self.config.tiers = [{"archive_dir": cold, "after_quarters": 8}]
+        ArchiveIndex.open(cold).close()
+
+        assert self.complete("ab") == ["abacus", "abalone", "abbey"]
+
+    def test_completer_for_this_click(self):
+        kwargs = completion.completer(lambda prefix: [prefix])
+        assert len(kwargs) == 1
+
+        (callback,) = kwargs.values()
+        assert callback(None, None, "x") == ["x"]
+
+    def test_large_archive(self):
+        with ArchiveIndex.open(self.archive, refresh=False) as index:
+            with index.conn:
+                index.conn.executemany(
+                    "INSERT INTO projects (quarter, filename, name) VALUES (?, ?, ?)",
+                    [
+                        (
+                            f"20{i % 20:02d}/q{i % 4 + 1}",
+                            f"p{i:05d}.tar.gz",
+                            f"p{i:05d}",
+                        )
+                        for i in range(50000)
+                    ],
+                )
+
+        start = time.perf_counter()
+        names = self.complete("p1234")
+        elapsed = time.perf_counter() - start
+
+        assert names == [f"p1234{i}" for i in range(10)]
+        # generous, to keep slow CI machines happy
+        assert elapsed < 0.5
@@ -0,0 +1,401 @@
+# -*- coding: utf-8 -*-
+#
+#  test_compress.py
+#  proj
+#
+
+import bz2
+import dataclasses
+import gzip
+import io
+import lzma
+import os
+from os import path
+import random
+import shutil
+import tarfile
+import tempfile
+from unittest.mock import Mock, patch
+
+import pytest
+
+from proj import compress, fs, trash
+from proj.exceptions import CommandError, PartialArchiveError
+
+
+class TestCompress:
+    def setup_method(self):
+        self.old_cwd = os.getcwd()
+        self.base = tempfile.mkdtemp()
+        os.chdir(self.base)
+
+        # small blocks so that a small project spans many members
+        self.codecs = {
+            name: dataclasses.replace(codec, block_size=4096)
+            for name, codec in compress.CODECS.items()
+        }
+
+        fs.mkdir("proj/sub")
+        rng = random.Random(0)
+        with open("proj/random", "wb") as ostream:
+            ostream.write(bytes(rng.getrandbits(8) for _ in range(50000)))
+        with open("proj/sub/text", "w") as ostream:
+            ostream.write("the quick brown fox\n" * 5000)
+
+    def teardown_method(self):
+        os.chdir(self.old_cwd)
+        shutil.rmtree(self.base)
+
+    @pytest.mark.parametrize("compression_format", ["gztar", "bztar", "xztar"])
+    def test_parallel_round_trip(self, compression_format):
+        with patch.dict(compress.CODECS, self.codecs):
+            filename = compress.make_archive(
+                "proj", "out", compression_format, threads=3
+            )
+            assert filename == "out" + fs.SUPPORTED_FORMATS[compression_format]
+
+            # standard tools can still read the multi-member output
+            with tarfile.open(filename) as tar:
+                assert sorted(tar.getnames()) == [
+                    "proj",
+                    "proj/random",
+                    "proj/sub",
+                    "proj/sub/text",
+                ]
+
+            compress.unpack_archive(filename, "restored", threads=3)
+
+        self.assert_restored()
+
+    def test_zip_uses_shutil(self):
+        with patch("shutil.make_archive") as make_archive:
+            compress.make_archive("proj", "out", "zip")
+
+        make_archive.assert_called_once_with("out", "zip", self.base, "proj")
+
+    @pytest.mark.parametrize(
+        "compression_format", ["tar", "gztar", "bztar", "xztar", "dedup"]
+    )
+    def test_remove_source(self, compression_format):
+        shutil.copytree("proj", "expected/proj", symlinks=True)
+        os.symlink("sub", "proj/dirlink")
+        os.symlink("random", "proj/filelink")
+
+        filename = compress.make_archive(
+            "proj", "out", compression_format, remove_source=True, chunk_store="chunks"
+        )
+        assert not path.exists("proj")
+
+        compress.unpack_archive(filename, "restored", chunk_store="chunks")
+        assert path.islink("restored/proj/dirlink")
+        assert os.readlink("restored/proj/filelink") == "random"
+        self.assert_restored(expected_dir="expected")
+
+    @pytest.mark.parametrize("compression_format", ["gztar", "zip", "dedup"])
+    def test_remove_source_to_trash(self, compression_format):
+        shutil.copytree("proj", "expected/proj")
+        filename = compress.make_archive(
+            "proj",
+            "out",
+            compression_format,
+            remove_source=True,
+            chunk_store="chunks",
+            trash_dir="trash",
+        )
+        assert not path.exists("proj")
+        assert len(os.listdir("trash")) == 1
+
+        (emptied,) = trash.empty("trash")
+        assert emptied.files == 2
+        assert emptied.kept is None
+
+        compress.unpack_archive(filename, "restored", chunk_store="chunks")
+        self.assert_restored(expected_dir="expected")
+
+    def test_remove_source_zip(self):
+        compress.make_archive("proj", "out", "zip", remove_source=True)
+        assert not path.exists("proj")
+
+    def test_low_disk_removes_files_as_it_goes(self):
+        shutil.copytree("proj", "expected/proj")
+        sizes = []
+
+        def record_removal(path):
+            sizes.append(os.path.getsize("out.tar.gz"))
+            real_unlink(path)
+
+        real_unlink = os.unlink
+        with patch.object(compress, "LOW_DISK_COMMIT_SIZE", 1), patch(
+            "os.unlink", record_removal
+        ):
+            compress.make_archive("proj", "out", "gztar", low_disk=True)
+
+        # the first file was removed before the archive was complete
+        assert len(sizes) == 2
+        assert 0 < sizes[0] < os.path.getsize("out.tar.gz")
+        assert not path.exists("proj")
+
+        compress.unpack_archive("out.tar.gz", "restored")
+        self.assert_restored(expected_dir="expected")
+
+    def test_low_disk_failure_keeps_partial_archive(self):
+        fs.touch("proj/sub/zzz")
+        real_open = open
+
+        def fail_on_second_file(path, *args, **kwargs):
+            if path.startswith("proj/sub"):
+                raise OSError("disk on fire")
+            return real_open(path, *args, **kwargs)
+
+        with patch.object(compress, "LOW_DISK_COMMIT_SIZE", 1), patch(
+            "builtins.open", fail_on_second_file
+        ):
+            with pytest.raises(PartialArchiveError):
+                compress.make_archive("proj", "out", "bztar", low_disk=True)
+
+        assert not path.exists("proj/random")
+        assert path.exists("proj/sub/text")
+        with tarfile.open("out.tar.bz2") as tar:
+            assert "proj/random" in tar.getnames()
+
+    def test_remove_source_leaves_new_files(self):
+        real_close = compress.StreamingArchive.close
+
+        def sneak_then_close(self):
+            fs.touch("proj/sub/sneaky")
+            real_close(self)
+
+        with patch.object(compress.StreamingArchive, "close", sneak_then_close):
+            compress.make_archive("proj", "out", "tar", remove_source=True)
+
+        assert os.listdir("proj") == ["sub"]
+        assert os.listdir("proj/sub") == ["sneaky"]
+
+    def test_archive_single_file(self):
+        compress.make_archive("proj/random", "out", "tar", remove_source=True)
+
+        with tarfile.open("out.tar") as tar:
+            assert tar.getnames() == ["random"]
+
+        assert not path.exists("proj/random")
+
+    def test_archive_by_absolute_path(self):
+        compress.make_archive(path.abspath("proj"), "out", "bztar")
+        compress.unpack_archive("out.tar.bz2", "restored", threads=2)
+        self.assert_restored()
+
+    def test_parallel_restore_of_foreign_archive(self):
+        # a single huge member, as written by the gzip tool
+        with tarfile.open("out.tar", "w") as tar:
+            tar.add("proj")
+        with open("out.tar", "rb") as istream:
+            with gzip.open("out.tar.gz", "wb") as ostream:
+                shutil.copyfileobj(istream, ostream)
+
+        with patch.object(compress, "MAX_MEMBER_SIZE", 1000):
+            compress.unpack_archive("out.tar.gz", "restored", threads=4)
+
+        self.assert_restored()
+
+    def test_parallel_restore_with_magic_inside_data(self):
+        # store the magic prefix uncompressed, so it appears mid-member
+        with open("proj/sub/magic", "wb") as ostream:
+            ostream.write(compress.GZIP_MAGIC * 100)
+
+        codec = dataclasses.replace(self.codecs["gztar"], level=0)
+        with patch.dict(compress.CODECS, {"gztar": codec}):
+            compress.make_archive("proj", "out", "gztar", threads=2)
+            compress.unpack_archive("out.tar.gz", "restored", threads=2)
+
+        self.assert_restored()
+        with open("restored/proj/sub/magic", "rb") as istream:
+            assert istream.read() == compress.GZIP_MAGIC * 100
+
+    def test_parallel_xz_restore_with_magic_inside_data(self):
+        # LZMA2 keeps random data as it is, magic prefix and all
+        data = os.urandom(1 << 20) + compress.XZ_MAGIC + os.urandom(1 << 20)
+        with open("proj/sub/magic", "wb") as ostream:
+            ostream.write(data)
+
+        codec = dataclasses.replace(self.codecs["xztar"], level=0)
+        with patch.dict(compress.CODECS, {"xztar": codec}):
+            compress.make_archive("proj", "out", "xztar", threads=2)
+            compress.unpack_archive("out.tar.xz", "restored", threads=2)
+
+        self.assert_restored()
+        with open("restored/proj/sub/magic", "rb") as istream:
+            assert istream.read() == data
+
+    def test_split_bzip2_members_of_any_level(self):
+        blocks = [os.urandom(1000) + bytes(level * 1000) for level in [1, 5, 9]]
+        data = b"".join(bz2.compress(b, level) for b, level in zip(blocks, [1, 5, 9]))
+
+        with patch.object(compress, "READ_SIZE", 100):
+            members = list(
+                compress._split_members(io.BytesIO(data), compress.BZ2_MAGIC)
+            )
+
+        assert [bz2.decompress(m) for _, m in members] == blocks  # type: ignore
+
+    @pytest.mark.parametrize(
+        "compression_format", ["gztar", "bztar", "xztar", "tar", "zip", "dedup"]
+    )
+    def test_list_members(self, compression_format):
+        with patch.dict(compress.CODECS, self.codecs):
+            filename = compress.make_archive(
+                "proj", "out", compression_format, chunk_store="chunks"
+            )
+
+        members = compress.list_members(filename)
+        assert sorted((m.name, m.type, m.size) for m in members) == [
+            ("proj", "d", 0),
+            ("proj/random", "f", 50000),
+            ("proj/sub", "d", 0),
+            ("proj/sub/text", "f", 100000),
+        ]
+
+    def test_list_members_of_folder(self):
+        names = [m.name for m in compress.list_members("proj")]
+        assert sorted(names) == ["proj", "proj/random", "proj/sub", "proj/sub/text"]
+
+    @pytest.mark.parametrize(
+        "compression_format",
+        ["gztar", "bztar", "xztar", "tar", "zip", "dedup", None],
+    )
+    def test_extract_members(self, compression_format):
+        filename = "proj"
+        if compression_format:
+            with patch.dict(compress.CODECS, self.codecs):
+                filename = compress.make_archive(
+                    "proj", "out", compression_format, chunk_store="chunks"
+                )
+
+        extracted = compress.extract_members(
+            filename, ["sub"], "restored", chunk_store="chunks"
+        )
+        assert [m.name for m in extracted] == ["proj/sub", "proj/sub/text"]
+        assert not path.exists("restored/proj/random")
+        with open("restored/proj/sub/text") as istream:
+            assert istream.read() == "the quick brown fox\n" * 5000
+
+    def test_extract_decompresses_only_what_it_needs(self):
+        with patch.dict(compress.CODECS, self.codecs):
+            filename = compress.make_archive("proj", "out", "gztar", threads=2)
+
+        with patch("gzip.decompress", wraps=gzip.decompress) as decompress:
+            compress.extract_members(filename, ["sub/text"], "restored")
+
+        # the text spans 25 blocks, out of about 40
+        assert decompress.call_count <= 27
+        self.assert_restored_file("proj/sub/text")
+
+    def test_extract_old_gzip_archive(self):
+        with tarfile.open("old.tar.gz", "w:gz") as tar:
+            tar.add("proj")
+
+        compress.extract_members("old.tar.gz", ["random"], "restored")
+        self.assert_restored_file("proj/random")
+
+    def test_extract_missing_path(self):
+        filename = compress.make_archive("proj", "out", "gztar")
+        with pytest.raises(CommandError):
+            compress.extract_members(filename, ["random", "nothing"], "restored")
+
+    def test_extract_wont_overwrite(self):
+        filename = compress.make_archive("proj", "out", "gztar")
+        with pytest.raises(CommandError):
+            compress.extract_members(filename, ["random"], ".")
+
+    @pytest.mark.parametrize("compression_format", ["gztar", "bztar", "xztar"])
+    def test_adaptive_stores_what_wont_compress(self, compression_format):
+        codec = self.codecs[compression_format]
+        store = Mock(wraps=codec.store)
+        codecs = {compression_format: dataclasses.replace(codec, store=store)}
+        with patch.dict(compress.CODECS, codecs):
+            filename = compress.make_archive(
+                "proj", "out", compression_format, threads=2, adaptive=True
+            )
+            compress.unpack_archive(filename, "restored", threads=2)
+
+        # the random file's blocks, but not the text's
+        assert 10 <= store.call_count <= 14
+        self.assert_restored()
+
+    def test_xz_stored_blocks_are_plain_xz(self):
+        data = os.urandom(200000)
+        assert lzma.decompress(compress._xz_stored(data)) == data
+        assert lzma.decompress(compress._xz_stored(b"")) == b""
+
+    def test_compresses(self):
+        assert compress.compresses(b"the quick brown fox\n" * 10000)
+        assert not compress.compresses(os.urandom(1000000))
+        assert not compress.compresses(b"")
+
+    def test_level_chooser_keeps_up(self):
+        codec = compress.CODECS["gztar"]
+        chooser = compress.LevelChooser(codec, speed=10)
+        assert chooser.level == codec.level
+
+        # too slow: step down, but not past the fastest level
+        for _ in range(20):
+            chooser.record(chooser.level, 2**20, 1.0)
+        assert chooser.level == codec.fastest
+
+        # a block from before we stepped down doesn't count
+        chooser.record(codec.level, 2**20, 0.001)
+        assert chooser.level == codec.fastest
+
+        # plenty of time to spare: step back up, but no further than usual
+        for _ in range(20):
+            chooser.record(chooser.level, 2**20, 0.01)
+        assert chooser.level == codec.level
+
+    def test_level_chooser_without_speed(self):
+        chooser = compress.LevelChooser(compress.CODECS["gztar"])
+        chooser.record(chooser.level, 2**20, 100.0)
+        assert chooser.level == compress.CODECS["gztar"].level
+
+    def test_tune(self):
+        with patch.dict(compress.CODECS, self.codecs):
+            report = compress.tune("proj", 1000000)
+
+        # a small project is sampled whole
+        assert report.sample_size == report.total_size == 150000
+        assert report.n_files == 2
+
+        formats = {(r.compression_format, r.level) for r in report.results}
+        assert formats == {
+            (f, level) for f, levels in compress.TUNE_LEVELS.items() for level in levels
+        }
+        for r in report.results:
+            # the text all but vanishes, the random data doesn't
+            assert 0.3 < r.ratio < 0.4
+            assert r.mb_per_s > 0
+
+        # about a third of it is random
+        assert 0.25 < report.stored < 0.45
+
+    def test_tune_samples_every_file(self):
+        for i in range(10):
+            with open(f"proj/big{i}", "wb") as ostream:
+                ostream.write(bytes([i]) * 500000)
+
+        sample, n_files, total = compress.sample_files("proj", 1000000)
+        assert total == 5150000
+        assert n_files == 12
+        assert len(sample) <= 1000000
+
+    def test_all_threads(self):
+        assert compress.resolve_threads(0) == os.cpu_count()
+        assert compress.resolve_threads(3) == 3
+
+    def assert_restored_file(self, filename):
+        with open(filename, "rb") as expected:
+            with open(path.join("restored", filename), "rb") as actual:
+                assert actual.read() == expected.read()
+
+    def assert_restored(self, expected_dir="."):
+        for filename in ["proj/random", "proj/sub/text"]:
+            with open(path.join(expected_dir, filename), "rb") as expected:
+                with open(path.join("restored", filename), "rb") as actual:
+                    assert actual.read() == expected.read()
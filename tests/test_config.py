@@ -7,9 +7,15 @@
 """
 """
 
+import os
+from os import path
+import shutil
+import tempfile
+import time
 from tempfile import NamedTemporaryFile
+from unittest.mock import patch
 
-from proj import Config
+from proj import Config, fs
 
 
 def test_read_write_config():
@@ -22,3 +28,74 @@ def test_read_write_config():
         config.save(filename)
 
         assert Config.load(filename) == config
+
+
+class TestConfigCache:
+    def setup_method(self):
+        self.base = tempfile.mkdtemp()
+        self.filename = path.join(self.base, "proj.yml")
+        self.cache_file = path.join(self.base, "cache", "config.json")
+
+        Config(archive_dir="cached").save(self.filename)
+        self.make_old(self.filename)
+
+    def teardown_method(self):
+        shutil.rmtree(self.base)
+
+    def make_old(self, filename):
+        t = time.time() - 3600
+        os.utime(filename, (t, t))
+
+    def test_cache_is_reused(self):
+        config = Config.load_cached(self.filename, self.cache_file)
+        assert config.archive_dir == "cached"
+        assert path.exists(self.cache_file)
+
+        with patch.object(Config, "load", side_effect=AssertionError):
+            assert Config.load_cached(self.filename, self.cache_file) == config
+
+    def test_cache_is_invalidated_by_changes(self):
+        Config.load_cached(self.filename, self.cache_file)
+
+        Config(archive_dir="moved").save(self.filename)
+        self.make_old(self.filename)
+
+        config = Config.load_cached(self.filename, self.cache_file)
+        assert config.archive_dir == "moved"
+
+    def test_recent_changes_are_not_cached(self):
+        Config(archive_dir="fresh").save(self.filename)
+
+        assert Config.load_cached(self.filename, self.cache_file).archive_dir == "fresh"
+        assert not path.exists(self.cache_file)
+
+    def test_corrupt_cache(self):
+        fs.mkdir(path.dirname(self.cache_file))
+        with open(self.cache_file, "w") as ostream:
+            ostream.write("{not json")
+
+        config = Config.load_cached(self.filename, self.cache_file)
+        assert config.archive_dir == "cached"
+
+    def test_unwritable_cache(self):
+        # a file where the cache folder should be
+        fs.touch(path.join(self.base, "cache"))
+
+        config = Config.load_cached(self.filename, self.cache_file)
+        assert config.archive_dir == "cached"
+
+    def test_env_var_skips_the_config_file(self):
+        with patch.dict(os.environ, {"PROJ_ARCHIVE": "/from/env"}):
+            with patch.object(Config, "_get_config_file", side_effect=AssertionError):
+                config = Config.autoload()
+
+        assert config == Config(archive_dir="/from/env")
+
+    def test_autoload_uses_the_cache(self):
+        env = {"XDG_CACHE_HOME": path.join(self.base, "xdg")}
+        with patch.dict(os.environ, env), patch.dict(os.environ, {"PROJ_ARCHIVE": ""}):
+            with patch.object(Config, "_get_config_file", return_value=self.filename):
+                config = Config.autoload()
+
+        assert config.archive_dir == "cached"
+        assert path.exists(path.join(self.base, "xdg", "proj", "config-cache.json"))
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+#
+#  test_dedup.py
+#  proj
+#
+
+import io
+import os
+import random
+import shutil
+import stat
+import tempfile
+import time
+from os import path
+from unittest.mock import patch
+
+import pytest
+
+from proj import dedup, fs
+from proj.dedup import ChunkStore
+
+
+def random_text(rng, n_bytes):
+    words = ["".join(rng.choice("abcdefgh") for _ in range(5)) for _ in range(100)]
+    text = [rng.choice(words) + rng.choice(" \n") for _ in range(n_bytes // 6 + 1)]
+    return "".join(text)[:n_bytes].encode("utf8")
+
+
+def test_chunks_survive_insertion():
+    data = random_text(random.Random(0), 2 * 1024 * 1024)
+    before = list(dedup.iter_chunks(io.BytesIO(data)))
+    after = list(dedup.iter_chunks(io.BytesIO(data[:5000] + b"hello" + data[5000:])))
+
+    assert b"".join(before) == data
+    assert all(dedup.MIN_CHUNK <= len(c) <= dedup.MAX_CHUNK for c in before[:-1])
+    assert len(before) > 5
+
+    # only the chunk around the insertion changes
+    assert before[1:] == after[1:]
+
+
+def test_chunks_without_anchors():
+    data = b"\0" * (2 * dedup.MAX_CHUNK + 10)
+    chunks = list(dedup.iter_chunks(io.BytesIO(data)))
+    assert [len(c) for c in chunks] == [dedup.MAX_CHUNK, dedup.MAX_CHUNK, 10]
+    assert list(dedup.iter_chunks(io.BytesIO(b""))) == []
+
+
+class TestDedup:
+    def setup_method(self):
+        self.old_cwd = os.getcwd()
+        self.base = tempfile.mkdtemp()
+        os.chdir(self.base)
+
+        self.store = ChunkStore("chunks")
+        fs.mkdir("proj/sub")
+        with open("proj/sub/text", "wb") as ostream:
+            ostream.write(random_text(random.Random(1), 200000))
+        with open("proj/random", "wb") as ostream:
+            ostream.write(os.urandom(50000))
+        os.chmod("proj/random", 0o600)
+        os.utime("proj/random", (1000000000, 1000000000))
+        os.symlink("sub/text", "proj/link")
+
+    def teardown_method(self):
+        os.chdir(self.old_cwd)
+        shutil.rmtree(self.base)
+
+    def test_store(self):
+        digest = self.store.put(b"hello" * 100)
+        assert self.store.put(b"hello" * 100) == digest
+        assert self.store.get(digest) == b"hello" * 100
+
+        # incompressible chunks are stored as they are
+        data = os.urandom(1000)
+        assert self.store.get(self.store.put(data)) == data
+
+    def test_round_trip(self):
+        filename = dedup.make_archive(
+            "proj", "proj.dedup", self.store, threads=2, remove_source=True
+        )
+        assert not path.exists("proj")
+
+        dedup.unpack_archive(filename, "restored", ChunkStore("chunks"), threads=2)
+        st = os.stat("restored/proj/random")
+        assert stat.S_IMODE(st.st_mode) == 0o600
+        assert st.st_mtime == 1000000000
+        assert os.readlink("restored/proj/link") == "sub/text"
+        assert path.getsize("restored/proj/sub/text") == 200000
+
+    def test_chunks_are_synced_in_one_batch(self):
+        events = []
+        write_tmp, fsync = dedup._write_tmp, dedup._fsync
+
+        def logged_write(filename, data):
+            events.append(("write", filename))
+            return write_tmp(filename, data)
+
+        def logged_fsync(path):
+            events.append(("fsync", path))
+            fsync(path)
+
+        with patch.object(dedup, "_write_tmp", logged_write), patch.object(
+            dedup, "_fsync", logged_fsync
+        ):
+            dedup.make_archive("proj", "proj.dedup", self.store, threads=2)
+
+        # every new chunk is written before any is synced, and the manifest
+        # and its folder are written and synced last
+        writes = [i for i, (kind, _) in enumerate(events) if kind == "write"]
+        n_chunks = len(writes) - 1
+        assert n_chunks > 1
+        assert writes == list(range(n_chunks)) + [len(events) - 3]
+        assert events[-3] == ("write", "proj.dedup")
+        assert events[-1] == ("fsync", path.abspath("."))
+        assert self.store.pending == {}
+
+    def test_failed_archive_leaves_no_chunks(self):
+        with patch.object(dedup, "_entry_for", side_effect=OSError("vanished")):
+            with pytest.raises(OSError):
+                dedup.make_archive("proj/random", "random.dedup", self.store)
+
+        store_file = dedup._store_file
+
+        def flaky(src_path, name, store):
+            if name.endswith("random"):
+                raise OSError("vanished")
+            return store_file(src_path, name, store)
+
+        with patch.object(dedup, "_store_file", flaky):
+            with pytest.raises(OSError):
+                dedup.make_archive("proj", "proj.dedup", self.store, threads=2)
+
+        assert list(fs.iter_files("chunks")) == []
+        assert not path.exists("proj.dedup")
+        assert self.store.known == set()
+
+    def test_same_new_chunk_on_many_threads(self):
+        fs.mkdir("same")
+        for i in range(200):
+            with open(f"same/{i}", "w") as ostream:
+                ostream.write("the same\n" * 100)
+
+        write_tmp = dedup._write_tmp
+
+        def slow_write(filename, data):
+            # long enough for every thread to get to the same chunk
+            time.sleep(0.05)
+            return write_tmp(filename, data)
+
+        with patch.object(dedup, "_write_tmp", slow_write):
+            dedup.make_archive("same", "same.dedup", self.store, threads=8)
+
+        files = list(fs.iter_files("chunks"))
+        assert not [f for f in files if f.endswith(".tmp")]
+        assert len(files) == 1
+
+    def test_shared_files_are_stored_once(self):
+        shutil.copytree("proj", "copy", symlinks=True)
+        dedup.make_archive("proj", "proj.dedup", self.store)
+        n_chunks = len(list(fs.iter_files("chunks")))
+
+        dedup.make_archive("copy", "copy.dedup", ChunkStore("chunks"))
+        assert len(list(fs.iter_files("chunks"))) == n_chunks
+
+        names = [m.name for m in dedup.list_members("copy.dedup")]
+        assert sorted(names) == [
+            "copy",
+            "copy/link",
+            "copy/random",
+            "copy/sub",
+            "copy/sub/text",
+        ]
+
+    def test_single_file(self):
+        dedup.make_archive("proj/random", "random.dedup", self.store)
+        dedup.unpack_archive("random.dedup", "restored", self.store)
+        with open("proj/random", "rb") as expected:
+            with open("restored/random", "rb") as actual:
+                assert actual.read() == expected.read()
+
+    def test_extract_members(self):
+        dedup.make_archive("proj", "proj.dedup", self.store)
+        dedup.extract_members("proj.dedup", {"proj/sub/text"}, "out", self.store)
+        assert os.listdir("out/proj") == ["sub"]
+        assert path.getsize("out/proj/sub/text") == 200000
@@ -4,12 +4,17 @@
 #  proj
 #
 
+import errno
 import os
 from os import path
 import tempfile
 import shutil
+from unittest.mock import patch
+
+import pytest
 
 from proj import fs
+from proj.exceptions import CommandError
 
 
 class TestFs:
@@ -35,8 +40,185 @@ class TestFs:
         fs.mkdir(dest2)
         assert path.isdir(dest2)
 
+    def test_mkdir_race(self):
+        real_isdir = path.isdir
+
+        def racing_isdir(p):
+            # pretend someone else makes the folder just after we check
+            result = real_isdir(p)
+            if p.endswith("racy") and not result:
+                os.mkdir(p)
+            return result
+
+        with patch("os.path.isdir", racing_isdir):
+            fs.mkdir(path.join(self.current, "racy"))
+
+        assert path.isdir(path.join(self.current, "racy"))
+
+    def test_tree_stats(self):
+        self.make_tree()
+        with open("tree/a/b/c/deep", "w") as ostream:
+            ostream.write("12345")
+        for filename, t in [("top", 100), ("a/shallow", 200), ("a/b/c/deep", 3000)]:
+            os.utime(path.join("tree", filename), (t, t))
+
+        stats = fs.tree_stats("tree")
+        assert stats.latest == 3000
+        assert stats.size == 5
+        assert stats.files == 3
+
+    def test_tree_stats_stop_after(self):
+        self.make_tree()
+        for filename, t in [("top", 3000), ("a/shallow", 200), ("a/b/c/deep", 100)]:
+            os.utime(path.join("tree", filename), (t, t))
+
+        # the top folder alone is enough to know it's newer than the cutoff
+        stats = fs.tree_stats("tree", stop_after=1000)
+        assert stats.latest == 3000
+        assert stats.files == 1
+
+        assert fs.tree_stats("tree", stop_after=5000).files == 3
+
     def test_iter_single_file(self):
         filename = "example.out"
         fs.touch(filename)
 
         assert list(fs.iter_files(filename)) == [filename]
+
+    def test_iter_files_matches_os_walk(self):
+        self.make_tree()
+
+        expected = {
+            path.join(dirname, basename)
+            for dirname, _, filenames in os.walk("tree")
+            for basename in filenames
+        }
+        assert set(fs.iter_files("tree")) == expected
+
+    def test_scan_tree_yields_parents_first(self):
+        self.make_tree()
+
+        seen = set()
+        for scan in fs.scan_tree("tree"):
+            assert scan.path == "tree" or path.dirname(scan.path) in seen
+            seen.add(scan.path)
+
+        assert "tree/a/b/c" in seen
+        assert "tree/link" not in seen
+
+    def test_last_modified_ignores_symlinks(self):
+        self.make_tree()
+        os.utime("tree/a/b/c/deep", (1000, 1000))
+        os.utime("tree/a/shallow", (2000, 2000))
+        os.utime("tree/top", (500, 500))
+        os.utime("tree/filelink", (9000, 9000), follow_symlinks=False)
+
+        assert fs.last_modified("tree").timestamp == 2000
+
+    def test_last_modified_of_single_file(self):
+        fs.touch("example.out")
+        os.utime("example.out", (1234, 1234))
+        assert fs.last_modified("example.out").timestamp == 1234
+
+    def test_last_modified_only_symlinks(self):
+        fs.mkdir("links")
+        os.symlink("/does/not/exist", "links/broken")
+        with pytest.raises(CommandError):
+            fs.last_modified("links")
+
+    def make_tree(self):
+        fs.mkdir("tree/a/b/c")
+        for filename in ["tree/top", "tree/a/shallow", "tree/a/b/c/deep"]:
+            fs.touch(filename)
+
+        os.symlink(path.abspath("tree/a"), "tree/link")
+        os.symlink(path.abspath("tree/top"), "tree/filelink")
+
+    def test_move_renames_within_a_filesystem(self):
+        self.make_tree()
+        stats = fs.move("tree", "moved")
+
+        assert stats.renamed
+        assert not path.exists("tree")
+        assert path.exists("moved/a/b/c/deep")
+
+    def test_move_refuses_to_overwrite(self):
+        self.make_tree()
+        os.mkdir("moved")
+        with pytest.raises(CommandError):
+            fs.move("tree", "moved")
+
+    def test_move_across_filesystems(self):
+        self.make_tree()
+        with open("tree/a/shallow", "w") as ostream:
+            ostream.write("x" * 100)
+        os.chmod("tree/a/shallow", 0o640)
+        os.utime("tree/a/shallow", (1000, 1000))
+        os.utime("tree/a/b", (2000, 2000))
+
+        with patch("os.rename", side_effect=OSError(errno.EXDEV, "cross-device")):
+            stats = fs.move("tree", "moved")
+
+        assert not stats.renamed
+        assert stats.files == 5
+        assert stats.size == 100
+        assert stats.rate > 0
+        assert not path.exists("tree")
+
+        assert os.stat("moved/a/shallow").st_mtime == 1000
+        assert os.stat("moved/a/shallow").st_mode & 0o777 == 0o640
+        assert os.stat("moved/a/b").st_mtime == 2000
+        assert os.readlink("moved/filelink") == path.abspath("tree/top")
+        assert path.islink("moved/link")
+        assert fs.last_modified("moved").timestamp > 1000
+
+    def test_move_single_file_across_filesystems(self):
+        with open("single", "w") as ostream:
+            ostream.write("hello")
+
+        with patch("os.rename", side_effect=OSError(errno.EXDEV, "cross-device")):
+            stats = fs.move("single", "moved")
+
+        assert (stats.files, stats.size) == (1, 5)
+        assert not path.exists("single")
+
+    def test_move_other_rename_errors(self):
+        fs.touch("single")
+        with patch("os.rename", side_effect=OSError(errno.EACCES, "denied")):
+            with pytest.raises(OSError):
+                fs.move("single", "moved")
+
+    def test_copy_special_file(self):
+        os.mkfifo("fifo")
+        with pytest.raises(CommandError):
+            fs.copy_tree("fifo", "copied")
+
+    @pytest.mark.parametrize(
+        "unsupported", [["copy_file_range"], ["copy_file_range", "sendfile"]]
+    )
+    def test_copy_data_fallbacks(self, unsupported):
+        data = os.urandom(100000)
+        with open("src", "wb") as ostream:
+            ostream.write(data)
+
+        def fail(*args):
+            raise OSError(errno.ENOSYS, "not supported")
+
+        with patch.object(fs, "COPY_CHUNK", 4096):
+            patches = [patch(f"os.{name}", fail) for name in unsupported]
+            for p in patches:
+                p.start()
+            try:
+                fs.copy_tree("src", "dest")
+            finally:
+                for p in patches:
+                    p.stop()
+
+        with open("dest", "rb") as istream:
+            assert istream.read() == data
+
+    def test_copy_data_other_errors(self):
+        fs.touch("src")
+        with patch("os.copy_file_range", side_effect=OSError(errno.EIO, "broken")):
+            with pytest.raises(OSError):
+                fs.copy_tree("src", "dest")
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+#
+#  test_ignore.py
+#  proj
+#
+
+import shutil
+import tarfile
+import tempfile
+from os import path
+
+import pytest
+
+from proj import compress, fs
+from proj.ignore import IgnoreRules
+
+
+@pytest.fixture
+def project():
+    base = tempfile.mkdtemp()
+    root = path.join(base, "project")
+    for filename in [
+        "main.py",
+        "src/app.py",
+        "src/__pycache__/app.cpython-38.pyc",
+        "node_modules/left-pad/index.js",
+        "web/node_modules/react/index.js",
+        "build/out.o",
+        "src/build/notes.txt",
+        "target",
+    ]:
+        filename = path.join(root, filename)
+        fs.mkdir(path.dirname(filename))
+        with open(filename, "w") as ostream:
+            ostream.write("x")
+
+    yield root
+    shutil.rmtree(base)
+
+
+def walk(root, rules):
+    found = set()
+    for scan in fs.scan_tree(root, scan=rules.scan_dir if rules else None):
+        for entry in scan.files:
+            found.add(path.relpath(entry.path, root))
+
+    return found
+
+
+def test_names_match_at_any_depth(project):
+    rules = IgnoreRules(project, ["node_modules", "*.pyc"])
+    assert walk(project, rules) == {
+        "main.py",
+        "src/app.py",
+        "build/out.o",
+        "src/build/notes.txt",
+        "target",
+    }
+
+
+def test_paths_match_from_the_top(project):
+    rules = IgnoreRules(project, ["/build", "src/__pycache__"])
+    assert "build/out.o" not in walk(project, rules)
+    assert "src/build/notes.txt" in walk(project, rules)
+    assert "src/__pycache__/app.cpython-38.pyc" not in walk(project, rules)
+
+
+def test_trailing_slash_only_matches_folders(project):
+    fs.mkdir(path.join(project, "sub", "target"))
+    with open(path.join(project, "sub", "target", "a.out"), "w"):
+        pass
+
+    rules = IgnoreRules(project, ["target/"])
+    found = walk(project, rules)
+    assert "target" in found
+    assert "sub/target/a.out" not in found
+
+
+def test_ignored_folders_are_not_walked(project):
+    rules = IgnoreRules(project, ["node_modules"])
+    walked = [scan.path for scan in fs.scan_tree(project, scan=rules.scan_dir)]
+    assert not any("node_modules" in p for p in walked)
+
+
+def test_projignore(project):
+    with open(path.join(project, ".projignore"), "w") as ostream:
+        ostream.write("# regenerable\n\n__pycache__/\n")
+
+    rules = IgnoreRules.for_project(project, ["node_modules"])
+    assert rules is not None
+    assert rules.patterns == ["node_modules", "__pycache__/"]
+
+    assert IgnoreRules.for_project(path.join(project, "src")) is None
+
+
+def test_tree_stats_leaves_out_ignored(project):
+    rules = IgnoreRules(project, ["node_modules", "build", "__pycache__"])
+    stats = fs.tree_stats(project, scan=rules.scan_dir)
+    assert stats.files == 3
+
+
+@pytest.mark.parametrize("threads", [1, 2])
+def test_archive_excludes_and_removes_ignored(project, threads):
+    rules = IgnoreRules(project, ["node_modules", "__pycache__"])
+    dest = project + "-archived"
+    filename = compress.make_archive(
+        project, dest, "gztar", threads=threads, remove_source=True, scan=rules.scan_dir
+    )
+
+    assert not path.exists(project)
+    with tarfile.open(filename) as tar:
+        names = set(tar.getnames())
+
+    assert "project/src/app.py" in names
+    assert not any("node_modules" in n or "__pycache__" in n for n in names)
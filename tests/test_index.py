@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+#
+#  test_index.py
+#  proj
+#
+
+import os
+from os import path
+import tempfile
+import shutil
+
+from proj import fs
+from proj.index import ArchiveIndex, INDEX_FILENAME
+
+
+class TestIndex:
+    def setup_method(self):
+        self.archive = tempfile.mkdtemp()
+
+    def teardown_method(self):
+        shutil.rmtree(self.archive)
+
+    def add(self, relpath, age=3600):
+        filename = path.join(self.archive, relpath)
+        fs.mkdir(path.dirname(filename))
+        fs.touch(filename)
+
+        # make the quarter folder old enough that its mtime can be trusted
+        quarter_dir = path.dirname(filename)
+        t = os.stat(quarter_dir).st_mtime - age
+        os.utime(quarter_dir, (t, t))
+
+    def test_empty_archive(self):
+        with ArchiveIndex.open(self.archive) as index:
+            assert list(index.projects()) == []
+            assert index.find("anything") == []
+
+        assert path.exists(path.join(self.archive, INDEX_FILENAME))
+
+    def test_find_strips_extensions(self):
+        self.add("2001/q1/cheese.tar.bz2")
+        self.add("2003/q4/cheese")
+        self.add("2003/q4/cheesecake.zip")
+
+        with ArchiveIndex.open(self.archive) as index:
+            assert index.find("cheese") == ["2001/q1/cheese.tar.bz2", "2003/q4/cheese"]
+            assert index.find("cheesecake") == ["2003/q4/cheesecake.zip"]
+            assert len(index) == 3
+
+    def test_hidden_files_are_ignored(self):
+        self.add("2001/q1/.DS_Store")
+        self.add(".trash/q1/project")
+
+        with ArchiveIndex.open(self.archive) as index:
+            assert list(index.projects()) == []
+
+    def test_only_drifted_quarters_are_rescanned(self):
+        self.add("2001/q1/a")
+        self.add("2002/q2/b")
+
+        with ArchiveIndex.open(self.archive) as index:
+            assert index.refresh() == 0
+
+        # someone else adds a project behind our back
+        self.add("2002/q2/c", age=7200)
+
+        with ArchiveIndex.open(self.archive, refresh=False) as index:
+            assert index.refresh() == 1
+            assert list(index.projects()) == [
+                ("2001/q1", "a", "a"),
+                ("2002/q2", "b", "b"),
+                ("2002/q2", "c", "c"),
+            ]
+            assert index.refresh(full=True) == 2
+
+    def test_removed_quarters_are_forgotten(self):
+        self.add("2001/q1/a")
+        with ArchiveIndex.open(self.archive) as index:
+            assert len(index) == 1
+
+        shutil.rmtree(path.join(self.archive, "2001"))
+
+        with ArchiveIndex.open(self.archive) as index:
+            assert len(index) == 0
+
+    def test_rescan_single_quarter(self):
+        self.add("2001/q1/a")
+        with ArchiveIndex.open(self.archive) as index:
+            os.unlink(path.join(self.archive, "2001/q1/a"))
+            index.rescan("2001/q1")
+            assert index.find("a") == []
+
+            os.rmdir(path.join(self.archive, "2001/q1"))
+            index.rescan("2001/q1")
+            assert index.conn.execute("SELECT * FROM quarters").fetchall() == []
+
+    def test_unwritable_index_falls_back_to_memory(self):
+        self.add("2001/q1/a")
+        os.mkdir(path.join(self.archive, INDEX_FILENAME))
+
+        with ArchiveIndex.open(self.archive) as index:
+            assert index.find("a") == ["2001/q1/a"]
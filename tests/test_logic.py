@@ -4,6 +4,8 @@
 #  proj
 #
 
+import errno
+import glob
 import os
 from os import path
 import tempfile
@@ -13,6 +15,7 @@ import math
 from typing import Optional
 import random
 import string
+import tarfile
 from unittest.mock import patch
 
 import arrow
@@ -41,6 +44,27 @@ def test_last_quarter_end():
     assert logic._to_quarter(a) == ("2000", "q4")
 
 
+@pytest.mark.parametrize(
+    "age,expected",
+    [
+        ("30d", (2000, 7, 31)),
+        ("2w", (2000, 8, 16)),
+        ("6m", (2000, 2, 29)),
+        ("18m", (1999, 2, 28)),
+        ("1y", (1999, 8, 30)),
+    ],
+)
+def test_cutoff_for(age, expected):
+    now = arrow.get(2000, 8, 30, 12).datetime
+    assert logic.cutoff_for(age, now=now) == arrow.get(*expected, 12).timestamp
+
+
+@pytest.mark.parametrize("age", ["", "6", "m", "6 months", "-1d"])
+def test_cutoff_for_bad_age(age):
+    with pytest.raises(logic.CommandError):
+        logic.cutoff_for(age)
+
+
 class TestMainLogic:
     def setup_method(self):
         self.base = tempfile.mkdtemp()
@@ -123,6 +147,165 @@ class TestMainLogic:
         assert path.isdir(expected_loc)
         assert path.exists(path.join(expected_loc, "data"))
 
+    def test_archive_with_mtime_cache(self):
+        config = configfile.Config(archive_dir=self.archive, mtime_cache=True)
+        proj_name, proj_path = self.make_proj(a=arrow.get(2000, 1, 1))
+        cache_dir = path.join(self.base, "cache")
+
+        with patch.object(configfile, "cache_dir", return_value=cache_dir), patch(
+            "proj.treecache.GRACE_NS", -(10 ** 12)
+        ):
+            logic.archive(proj_name, config, dry_run=True)
+            cache = logic._tree_cache(proj_name, config)
+            assert path.exists(cache.cache_file)  # type: ignore
+
+            logic.archive(proj_name, config)
+            assert not path.exists(cache.cache_file)  # type: ignore
+
+        assert path.isdir(path.join(self.archive, "2000", "q1", proj_name))
+
+    def test_archive_with_ignore_rules(self):
+        config = configfile.Config(
+            archive_dir=self.archive,
+            compression=True,
+            compression_format="gztar",
+            ignore=["node_modules"],
+            exclude_ignored=True,
+        )
+        proj_name, proj_path = self.make_proj(a=arrow.get(2000, 1, 1))
+
+        # recently installed dependencies don't make the project recent
+        fs.mkdir(path.join(proj_path, "node_modules"))
+        fs.touch(path.join(proj_path, "node_modules", "index.js"))
+
+        logic.archive(proj_name, config)
+        assert not path.exists(proj_path)
+
+        archived = path.join(self.archive, "2000", "q1", f"{proj_name}.tar.gz")
+        with tarfile.open(archived) as tar:
+            assert tar.getnames() == [proj_name, f"{proj_name}/data"]
+
+    def test_tune_leaves_out_ignored_files(self):
+        config = configfile.Config(
+            archive_dir=self.archive, ignore=["node_modules"], exclude_ignored=True
+        )
+        proj_name, proj_path = self.make_proj(a=arrow.get(2000, 1, 1))
+        fs.mkdir(path.join(proj_path, "node_modules"))
+        with open(path.join(proj_path, "node_modules", "index.js"), "w") as ostream:
+            ostream.write("x" * 1000)
+
+        report = logic.tune(proj_name, config, 1024 * 1024)
+        assert report.n_files == 1
+        assert report.total_size == path.getsize(path.join(proj_path, "data"))
+
+        with pytest.raises(logic.CommandError):
+            logic.tune("nothing", config, 1024 * 1024)
+
+    def test_archive_with_everything_ignored(self):
+        config = configfile.Config(archive_dir=self.archive, ignore=["data"])
+        proj_name, _ = self.make_proj(a=arrow.get(2000, 1, 1))
+
+        logic.archive(proj_name, config)
+        assert path.isdir(path.join(self.archive, "2000", "q1", proj_name))
+
+    def test_archive_by_git_activity(self):
+        config = configfile.Config(archive_dir=self.archive, activity="git")
+        proj_name, proj_path = self.make_proj(a=arrow.get(2000, 1, 1))
+
+        # no repository, so the newest file decides
+        logic.archive(proj_name, config, dry_run=True)
+        stats = logic._tree_stats(proj_name, config)
+        assert stats.latest == arrow.get(2000, 1, 1).timestamp
+
+        # a repository whose index can't be read falls back the same way
+        fs.mkdir(path.join(proj_path, ".git"))
+        with open(path.join(proj_path, ".git", "index"), "wb") as ostream:
+            ostream.write(b"nonsense")
+
+        assert logic._tree_stats(proj_name, config) == fs.tree_stats(proj_name)
+
+    def test_unknown_activity_strategy(self):
+        config = configfile.Config(archive_dir=self.archive, activity="svn")
+        proj_name, _ = self.make_proj()
+        with pytest.raises(logic.CommandError):
+            logic.archive(proj_name, config)
+
+    def test_iter_stale(self):
+        old_name, _ = self.make_proj(a=arrow.get(2000, 5, 1))
+        self.make_proj(a=arrow.get(2020, 5, 1))
+        os.mkdir("empty")
+        os.mkdir(".hidden")
+        fs.touch(path.join(".hidden", "data"))
+
+        cutoff = arrow.get(2010, 1, 1).timestamp
+        stale = list(logic.iter_stale(".", cutoff, self.no_compression, jobs=2))
+        assert stale == [(old_name, "2000/q2")]
+
+    def test_iter_stale_skips_the_archive(self):
+        name, _ = self.make_proj(a=arrow.get(2000, 5, 1))
+        logic.archive(name, self.no_compression)
+        self.make_proj(a=arrow.get(2000, 5, 1))
+
+        stale = list(logic.iter_stale(self.base, time.time(), self.no_compression))
+        assert [p for p, _ in stale] == [self.current]
+
+    def test_iter_stale_missing_folder(self):
+        with pytest.raises(logic.CommandError):
+            list(logic.iter_stale("nowhere", time.time(), self.no_compression))
+
+    def test_archive_many(self, capsys):
+        names = []
+        for year in [2001, 2002, 2003, 2004]:
+            name, _ = self.make_proj(a=arrow.get(year, 5, 1), data="x" * year)
+            names.append(name)
+
+        results = logic.archive_many(
+            names + ["nonexistent"], self.bz2_compression, jobs=3
+        )
+
+        assert [r.src_path for r in results[:-1]] == names
+        assert [r.size for r in results[:-1]] == [2001, 2002, 2003, 2004]
+        assert results[-1] is None
+
+        out, err = capsys.readouterr()
+        assert out.splitlines() == [
+            f"{name} --> {self.archive}/{year}/q2/{name}"
+            for name, year in zip(names, [2001, 2002, 2003, 2004])
+        ]
+        assert err == "error: no such file or folder: nonexistent\n"
+
+        assert len(logic.list_projects([], self.bz2_compression)) == 4
+
+    def test_archive_many_with_os_error(self, capsys):
+        names = [self.make_proj(a=arrow.get(2000, 1, 1))[0] for _ in range(3)]
+        archive = logic.archive
+
+        def denied(src_path, *args, **kwargs):
+            if src_path == names[1]:
+                raise PermissionError(errno.EACCES, "Permission denied", src_path)
+            return archive(src_path, *args, **kwargs)
+
+        with patch("proj.logic.archive", side_effect=denied):
+            results = logic.archive_many(names, self.no_compression, jobs=2)
+
+        assert [r is not None for r in results] == [True, False, True]
+        assert "Permission denied" in capsys.readouterr().err
+        assert len(logic.list_projects([], self.no_compression)) == 2
+
+    def test_archive_and_restore_across_filesystems(self, capsys):
+        proj_name, proj_path = self.make_proj(a=arrow.get(2000, 1, 1), data="hello")
+
+        with patch("os.rename", side_effect=OSError(errno.EXDEV, "cross-device")):
+            logic.archive(proj_name, self.no_compression)
+            logic.restore(proj_name, self.no_compression)
+
+        out = capsys.readouterr().out.splitlines()
+        assert out[1].startswith("copied 1 files (5 B) across filesystems at ")
+        assert out[3].startswith("copied 1 files (5 B) across filesystems at ")
+
+        # the mtime survived both trips
+        assert fs.last_modified(proj_path) == arrow.get(2000, 1, 1)
+
     def test_list_projects(self):
         # archive a project
         a = arrow.get(2000, 1, 1)
@@ -141,6 +324,38 @@ class TestMainLogic:
         projects = logic.list_projects([prefix], self.no_compression)
         assert projects == expected
 
+    def test_list_projects_match_modes(self):
+        for relpath in [
+            "2001/q1/Cheese-Board",
+            "2001/q1/cheese-board.tar.bz2",
+            "2002/q3/chalkboard",
+            "2002/q3/cheese_2.zip",
+        ]:
+            fs.mkdir(path.join(self.archive, relpath))
+
+        def ls(patterns, **kwargs):
+            return logic.list_projects(patterns, self.no_compression, **kwargs)
+
+        assert ls(["board", "ch"]) == ["2001/q1/cheese-board", "2002/q3/chalkboard"]
+        assert ls(["cheese"], ignore_case=True) == [
+            "2001/q1/Cheese-Board",
+            "2001/q1/cheese-board",
+            "2002/q3/cheese_2",
+        ]
+        assert ls(["e*b"]) == ["2001/q1/cheese-board"]
+        assert ls([r"^ch.*_\d"], regex=True) == ["2002/q3/cheese_2"]
+        assert ls([r"board$", "^c"], regex=True) == ["2002/q3/chalkboard"]
+
+    def test_list_projects_with_and_without_compression(self):
+        fs.mkdir(path.join(self.archive, "2001", "q1", "twice"))
+        fs.touch(path.join(self.archive, "2001", "q1", "twice.tar.gz"))
+
+        assert logic.list_projects([], self.no_compression) == ["2001/q1/twice"]
+
+    def test_list_projects_bad_regex(self):
+        with pytest.raises(logic.CommandError):
+            logic.list_projects(["(unclosed"], self.no_compression, regex=True)
+
     def test_archive_and_restore(self):
         # make a project
         proj_name, proj_path = self.make_proj()
@@ -157,6 +372,21 @@ class TestMainLogic:
         config = configfile.Config(archive_dir="/tmp/does-not-exist")
         logic.list_projects([], config)
 
+    def test_reindex_missing_archive_dir(self):
+        config = configfile.Config(archive_dir="/tmp/does-not-exist")
+        with pytest.raises(logic.CommandError):
+            logic.reindex(config)
+
+        # only the colder tiers are left
+        cold = path.join(self.base, "cold")
+        fs.mkdir(path.join(cold, "2000", "q1", "old-project"))
+        config.tiers = [{"archive_dir": cold, "after_quarters": 4}]
+        assert logic.reindex(config) == (1, 1)
+
+    def test_list_sees_projects_added_behind_our_back(self):
+        fs.mkdir(path.join(self.archive, "1999", "q2", "sneaky"))
+        assert logic.list_projects([], self.no_compression) == ["1999/q2/sneaky"]
+
     def test_archive_nonexistent_folder(self):
         with pytest.raises(logic.CommandError):
             logic.archive("old-buddy-fred", self.no_compression)
@@ -181,6 +411,323 @@ class TestMainLogic:
         with open(f"{proj_name}/data") as istream:
             assert istream.read().strip() == data
 
+    def test_restore_compressed_in_parallel(self):
+        config = configfile.Config(
+            archive_dir=self.archive,
+            compression=True,
+            compression_format="gztar",
+            compression_threads=2,
+        )
+        proj_name, _ = self.make_proj(data="abracadabra")
+
+        logic.archive(proj_name, config)
+        logic.restore(proj_name, config)
+
+        with open(f"{proj_name}/data") as istream:
+            assert istream.read() == "abracadabra"
+
+    def test_archive_and_restore_deduplicated(self):
+        config = configfile.Config(
+            archive_dir=self.archive, compression=True, compression_format="dedup"
+        )
+        a = arrow.get(2000, 1, 1)
+        first, _ = self.make_proj(a=a, data="shared")
+        second, _ = self.make_proj(a=a, data="shared")
+
+        logic.archive(first, config)
+        logic.archive(second, config)
+        assert path.exists(path.join(self.archive, "2000", "q1", f"{first}.dedup"))
+        assert len(list(fs.iter_files(config.chunk_store))) == 1
+
+        assert logic.list_projects([second], config) == [f"2000/q1/{second}"]
+        _, members = logic.list_archived(second, config)
+        assert [m.name for m in members] == [second, f"{second}/data"]
+
+        logic.restore(first, config)
+        with open(f"{first}/data") as istream:
+            assert istream.read() == "shared"
+
+    @patch("proj.trash.empty_later")
+    def test_archive_with_background_delete(self, empty_later):
+        config = configfile.Config(
+            archive_dir=self.archive,
+            compression=True,
+            compression_format="gztar",
+            background_delete=True,
+        )
+        proj_name, proj_path = self.make_proj(a=arrow.get(2000, 1, 1))
+
+        logic.archive(proj_name, config)
+        assert not path.exists(proj_path)
+
+        trash_dir = path.join(self.current, ".proj-trash")
+        empty_later.assert_called_once_with(trash_dir)
+        assert len(os.listdir(trash_dir)) == 1
+
+        # the trash isn't a project
+        assert list(logic.iter_stale(".", time.time(), config)) == []
+
+        (emptied,) = logic.gc(".", threads=2)
+        assert emptied.source == proj_path
+        assert emptied.files == 1
+        assert not path.exists(trash_dir)
+
+        with pytest.raises(logic.CommandError):
+            logic.gc("nothing", threads=2)
+
+    @patch("proj.throttle.Throttle.done")
+    @patch("proj.throttle.lower_priority")
+    def test_archive_throttled(self, lower_priority, done):
+        config = configfile.Config(
+            archive_dir=self.archive,
+            compression=True,
+            compression_format="gztar",
+            throttle=True,
+            throttle_mb_per_s=100,
+        )
+        names = [self.make_proj(data=str(i))[0] for i in range(2)]
+
+        logic.archive_many(names, config, jobs=2)
+        lower_priority.assert_called_once()
+        # opening and reading each project's data
+        assert done.call_count == 2 * 2
+        assert logic.throttle.active() is None
+
+        logic.restore(names[1], config)
+        with open(f"{names[1]}/data") as istream:
+            assert istream.read() == "1"
+
+    def test_rearchive_from_restore_cache(self):
+        config = configfile.Config(
+            archive_dir=self.archive,
+            compression=True,
+            compression_format="gztar",
+            restore_cache_mb=1,
+        )
+        proj_name, proj_path = self.make_proj(a=arrow.get(2000, 1, 1), data="x")
+        archived = path.join(self.archive, "2000", "q1", f"{proj_name}.tar.gz")
+        logic.archive(proj_name, config)
+        inode = os.stat(archived).st_ino
+
+        logic.restore(proj_name, config)
+        assert not path.exists(archived)
+        (kept,) = os.listdir(config.restore_cache)
+        assert kept.startswith(f"{proj_name}.")
+
+        # the restore cache isn't a project
+        assert logic.list_projects([], config) == []
+
+        lines = []
+        with patch.object(logic, "_archive_compressed", side_effect=AssertionError):
+            logic.archive(proj_name, config, echo=lines.append)
+
+        assert "its old archive was reused" in lines[-1]
+        assert os.stat(archived).st_ino == inode
+        assert os.listdir(config.restore_cache) == []
+        assert not path.exists(proj_path)
+        assert logic.list_projects([], config) == [f"2000/q1/{proj_name}"]
+
+    def test_rearchive_changed_project(self):
+        config = configfile.Config(
+            archive_dir=self.archive,
+            compression=True,
+            compression_format="bztar",
+            restore_cache_mb=1,
+        )
+        proj_name, proj_path = self.make_proj(a=arrow.get(2000, 1, 1), data="x")
+        logic.archive(proj_name, config)
+        logic.restore(proj_name, config)
+
+        with open(path.join(proj_path, "data"), "w") as ostream:
+            ostream.write("changed")
+        os.utime(path.join(proj_path, "data"), (1e9, 1e9))
+
+        # the kept archive is out of date, so it goes
+        logic.archive(proj_name, config)
+        assert os.listdir(config.restore_cache) == []
+
+        logic.restore(proj_name, config)
+        with open(path.join(proj_path, "data")) as istream:
+            assert istream.read() == "changed"
+        assert len(os.listdir(config.restore_cache)) == 1
+
+    def test_restore_cache_off(self):
+        proj_name, _ = self.make_proj(a=arrow.get(2000, 1, 1))
+        logic.archive(proj_name, self.bz2_compression)
+        logic.restore(proj_name, self.bz2_compression)
+        assert not path.exists(self.bz2_compression.restore_cache)
+
+    def test_tiers(self, capsys):
+        cold = path.join(self.base, "cold")
+        config = configfile.Config(
+            archive_dir=self.archive,
+            tiers=[{"archive_dir": cold, "after_quarters": 4}],
+        )
+        old_name, _ = self.make_proj(a=arrow.get(2000, 1, 1))
+        new_name, _ = self.make_proj(a=arrow.utcnow())
+        year, quarter = logic._to_quarter(arrow.utcnow().datetime)
+
+        logic.archive_many([old_name, new_name], config)
+        assert path.isdir(path.join(cold, "2000", "q1", old_name))
+        assert path.isdir(path.join(self.archive, year, quarter, new_name))
+
+        assert logic.list_projects([], config) == [
+            f"2000/q1/{old_name}",
+            f"{year}/{quarter}/{new_name}",
+        ]
+        assert logic.reindex(config)[1] == 2
+
+        # a copy in each tier, and the most recent wins
+        fs.mkdir(path.join(self.archive, "1999", "q1", old_name))
+        logic.restore(old_name, config)
+        assert "multiple matches" in capsys.readouterr().err
+        assert not path.exists(path.join(cold, "2000", "q1", old_name))
+        shutil.rmtree(path.join(self.archive, "1999"))
+
+        logic.restore_many([new_name], config)
+        assert path.isdir(old_name) and path.isdir(new_name)
+        assert logic.list_projects([], config) == []
+
+        # a quarter part way through migrating, merged project by project
+        fs.mkdir(path.join(self.archive, "2013", "q1", "foo-bar"))
+        fs.mkdir(path.join(self.archive, "2013", "q1", "zzz"))
+        fs.mkdir(path.join(cold, "2013", "q1", "aaa"))
+        fs.mkdir(path.join(cold, "2013", "q1", "zzz"))
+        assert logic.list_projects([], config) == [
+            "2013/q1/aaa",
+            "2013/q1/foo-bar",
+            "2013/q1/zzz",
+        ]
+
+        # the archive's tiers aren't projects
+        assert logic._list_active(self.base, config) == [
+            path.join(self.base, "current")
+        ]
+
+    def test_migrate(self):
+        cold = path.join(self.base, "cold")
+        config = configfile.Config(
+            archive_dir=self.archive,
+            compression=True,
+            compression_format="gztar",
+            tiers=[{"archive_dir": cold, "after_quarters": 4}],
+        )
+        names = [self.make_proj(a=arrow.get(2000, 1, 1))[0] for _ in range(3)]
+        new_name, _ = self.make_proj(a=arrow.utcnow())
+
+        # archived before there were tiers
+        flat = configfile.Config(
+            archive_dir=self.archive, compression=True, compression_format="gztar"
+        )
+        logic.archive_many(names + [new_name], flat)
+        assert logic.list_projects([], config)
+
+        (dry_run,) = logic.migrate(config, dry_run=True)
+        assert (dry_run.quarter, dry_run.projects) == ("2000/q1", 3)
+        assert path.isdir(path.join(self.archive, "2000", "q1"))
+
+        (migration,) = logic.migrate(config, jobs=2)
+        assert migration == logic.Migration("2000/q1", self.archive, cold, 3, [])
+        assert sorted(os.listdir(path.join(cold, "2000", "q1"))) == sorted(
+            f"{name}.tar.gz" for name in names
+        )
+        assert not path.exists(path.join(self.archive, "2000"))
+        assert len(logic.list_projects([], config)) == 4
+
+        assert logic.migrate(config) == []
+
+        # tiers can be warmed up again too
+        warmer = configfile.Config(
+            archive_dir=self.archive,
+            tiers=[{"archive_dir": cold, "after_quarters": 400}],
+        )
+        (migration,) = logic.migrate(warmer)
+        assert (migration.src_dir, migration.dest_dir) == (cold, self.archive)
+        assert len(logic.list_projects([], config)) == 4
+
+    def test_migrate_across_filesystems(self):
+        cold = path.join(self.base, "cold")
+        config = configfile.Config(
+            archive_dir=self.archive,
+            tiers=[{"archive_dir": cold, "after_quarters": 4}],
+        )
+        names = [self.make_proj(a=arrow.get(2000, 1, 1))[0] for _ in range(2)]
+        logic.archive_many(names, configfile.Config(archive_dir=self.archive))
+
+        # one was interrupted part way through copying before
+        fs.mkdir(path.join(cold, "2000", "q1", f".{names[0]}.migrating"))
+        # and the other is in the way of a copy that already made it
+        fs.mkdir(path.join(cold, "2000", "q1", names[1]))
+
+        rename = os.rename
+
+        def no_renaming_across_tiers(src, dest):
+            if src.startswith(self.archive) and dest.startswith(cold):
+                raise OSError(errno.EXDEV, "cross-device link")
+            return rename(src, dest)
+
+        with patch("os.rename", side_effect=no_renaming_across_tiers):
+            (migration,) = logic.migrate(config)
+
+        assert migration.projects == 2
+        assert len(migration.errors) == 1 and "already exists" in migration.errors[0]
+        assert sorted(os.listdir(path.join(cold, "2000", "q1"))) == sorted(names)
+        assert os.listdir(path.join(self.archive, "2000", "q1")) == [names[1]]
+        with open(path.join(cold, "2000", "q1", names[0], "data")) as istream:
+            assert istream.read() == ""
+
+    def test_restore_many(self, capsys):
+        names = [self.make_proj(data=str(i))[0] for i in range(3)]
+        for name in names:
+            logic.archive(name, self.bz2_compression)
+        capsys.readouterr()
+
+        results = logic.restore_many(
+            names + ["my-dignity"], self.bz2_compression, jobs=2
+        )
+        assert [r.dest_path if r else None for r in results] == names + [None]
+        for i, name in enumerate(names):
+            with open(path.join(name, "data")) as istream:
+                assert istream.read() == str(i)
+
+        out, err = capsys.readouterr()
+        assert [line.split()[-1] for line in out.splitlines()] == names
+        assert err == "error: no project matches: my-dignity\n"
+        assert logic.list_projects([], self.bz2_compression) == []
+
+    def test_restore_many_with_corrupt_archive(self, capsys):
+        names = [self.make_proj(data=str(i))[0] for i in range(3)]
+        for name in names:
+            logic.archive(name, self.bz2_compression)
+        restore = logic.restore
+
+        def corrupt(dest_path, *args, **kwargs):
+            if dest_path == names[1]:
+                raise EOFError("Compressed file ended before the end-of-stream marker")
+            return restore(dest_path, *args, **kwargs)
+
+        with patch("proj.logic.restore", side_effect=corrupt):
+            results = logic.restore_many(names, self.bz2_compression, jobs=2)
+
+        assert [r is not None for r in results] == [True, False, True]
+        assert "end-of-stream" in capsys.readouterr().err
+        (left,) = logic.list_projects([], self.bz2_compression)
+        assert left.endswith(names[1])
+
+    def test_failed_restore_leaves_nothing_behind(self):
+        proj_name, _ = self.make_proj(data="x" * 100000)
+        logic.archive(proj_name, self.bz2_compression)
+        (source,) = glob.glob(path.join(self.archive, "*", "*", "*.tar.bz2"))
+        with open(source, "r+b") as ostream:
+            ostream.truncate(os.path.getsize(source) // 2)
+
+        with pytest.raises(logic.CommandError):
+            logic.restore(proj_name, self.bz2_compression)
+
+        # the archive is kept, and nothing is left half-restored
+        assert path.exists(source)
+        assert os.listdir(".") == []
+
     def test_restore_onto_existing_dir(self):
         # make a project
         proj_name, proj_path = self.make_proj()
@@ -233,7 +780,7 @@ class TestMainLogic:
 
         return proj_name, proj_path
 
-    @patch("shutil.make_archive")
+    @patch("proj.compress.make_archive")
     def test_archive_compressed_failure(self, make_archive):
 
         src_path, _ = self.make_proj()
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+#
+#  test_metrics.py
+#  proj
+#
+
+import json
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from os import path
+
+from proj import fs, metrics
+
+
+class TestMetrics:
+    def setup_method(self):
+        metrics.enable()
+
+    def teardown_method(self):
+        metrics.disable()
+
+    def test_nothing_recorded_when_disabled(self):
+        metrics.disable()
+        metrics.count(syscalls=10)
+        with metrics.phase("walk"):
+            pass
+
+        metrics.enable()
+        assert metrics.snapshot() == {
+            "phases": {},
+            "counters": dict.fromkeys(metrics.COUNTERS, 0),
+        }
+
+    def test_nested_phases(self):
+        with metrics.phase("compress"):
+            with metrics.phase("remove"):
+                pass
+
+        with metrics.phase("index"):
+            pass
+
+        phases = metrics.snapshot()["phases"]
+        assert list(phases) == ["compress", "compress/remove", "index"]
+        assert phases["compress"] >= phases["compress/remove"]
+
+    def test_phases_per_thread(self):
+        def work(i):
+            with metrics.phase("walk"):
+                metrics.count(files_visited=i)
+
+        with metrics.phase("archive"):
+            with ThreadPoolExecutor(4) as pool:
+                list(pool.map(work, range(10)))
+
+        report = metrics.snapshot()
+        assert list(report["phases"]) == ["archive", "walk"]
+        assert report["counters"]["files_visited"] == 45
+
+    def test_walk_and_copy_are_counted(self):
+        base = tempfile.mkdtemp()
+        try:
+            src = path.join(base, "src")
+            fs.mkdir(path.join(src, "sub"))
+            for name in ["a", "sub/b"]:
+                with open(path.join(src, name), "w") as ostream:
+                    ostream.write("hello")
+
+            metrics.enable()
+            fs.copy_tree(src, path.join(base, "dest"))
+
+            counters = metrics.snapshot()["counters"]
+            assert counters["files_visited"] == 2
+            assert counters["bytes_read"] == counters["bytes_written"] == 10
+            assert counters["syscalls"] > 4
+
+        finally:
+            shutil.rmtree(base)
+
+    def test_copy_counts_the_calls_it_makes(self):
+        base = tempfile.mkdtemp()
+        try:
+            src = path.join(base, "empty")
+            open(src, "w").close()
+            os.symlink("empty", path.join(base, "link"))
+
+            metrics.enable()
+            fs._copy_entry(path.join(base, "link"), path.join(base, "link2"))
+            assert metrics.snapshot()["counters"]["syscalls"] == 3
+
+            # and one copy call to find there's nothing to copy
+            metrics.enable()
+            fs._copy_entry(src, path.join(base, "empty2"))
+            assert metrics.snapshot()["counters"]["syscalls"] == 7
+
+        finally:
+            shutil.rmtree(base)
+
+    def test_format_report(self):
+        report = {
+            "phases": {"walk": 0.5, "compress/remove": 1.25},
+            "counters": {
+                "files_visited": 1234,
+                "bytes_read": 2048,
+                "bytes_written": 10,
+                "syscalls": 5,
+            },
+        }
+        assert metrics.format_report(report, 2.0).splitlines() == [
+            "phase              seconds",
+            "walk                 0.500",
+            "compress/remove      1.250",
+            "total                2.000",
+            "",
+            "files visited   1,234",
+            "bytes read      2.0 KB",
+            "bytes written   10 B",
+            "syscalls        5",
+        ]
+
+    def test_write_record_appends(self):
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            metrics.write_record(filename, {"command": "list"})
+            metrics.write_record(filename, {"command": "archive"})
+            with open(filename) as istream:
+                assert [json.loads(line) for line in istream] == [
+                    {"command": "list"},
+                    {"command": "archive"},
+                ]
+
+        finally:
+            os.unlink(filename)
@@ -3,8 +3,11 @@
 
 from os import path
 import contextlib
+import dataclasses
+import json
 import math
 import os
+import pstats
 import random
 import shutil
 import string
@@ -20,7 +23,8 @@ from click.testing import CliRunner
 
 import proj
 from proj.configfile import Config
-from proj import fs
+from proj import fs, trash
+from proj.ui import format_size
 
 
 class TestProj:
@@ -120,6 +124,173 @@ class TestProj:
         expected_loc = path.join(self.archive, "2000", "q1", f"{proj_name}.tar.bz2")
         assert path.exists(expected_loc)
 
+    @patch("proj.configfile.Config.autoload")
+    def test_archive_low_disk(self, autoload):
+        autoload.return_value = self.bz2_compression
+
+        a = arrow.get(2000, 1, 1)
+        proj_name, proj_path = self.make_proj(a=a)
+
+        result = self.runner.invoke(proj.archive, ["--low-disk", proj_name])
+        assert result.exit_code == 0
+        assert not path.exists(proj_path)
+
+        expected_loc = path.join(self.archive, "2000", "q1", f"{proj_name}.tar.bz2")
+        assert path.exists(expected_loc)
+
+    @patch("proj.throttle.lower_priority")
+    @patch("proj.configfile.Config.autoload")
+    def test_archive_throttled(self, autoload, lower_priority):
+        autoload.return_value = self.bz2_compression
+        proj_name, proj_path = self.make_proj(a=arrow.get(2000, 1, 1))
+
+        result = self.runner.invoke(proj.archive, ["--throttle", proj_name])
+        assert result.exit_code == 0
+        lower_priority.assert_called_once()
+
+        expected_loc = path.join(self.archive, "2000", "q1", f"{proj_name}.tar.bz2")
+        assert path.exists(expected_loc)
+
+    @patch("proj.configfile.Config.autoload")
+    def test_archive_many_jobs(self, autoload):
+        autoload.return_value = self.no_compression
+
+        a = arrow.get(2000, 1, 1)
+        names = [self.make_proj(a=a, data="hello")[0] for i in range(3)]
+
+        result = self.runner.invoke(proj.archive, ["--jobs", "2"] + names)
+        assert result.exit_code == 0
+
+        lines = result.output.splitlines()
+        assert lines[:3] == [
+            f"{name} --> {path.join(self.archive, '2000', 'q1', name)}"
+            for name in names
+        ]
+        assert lines[4] == "summary:"
+        assert lines[5].split()[:3] == [names[0], "5", "B"]
+        assert len(lines) == 8
+
+    @patch("proj.configfile.Config.autoload")
+    def test_archive_many_with_failure(self, autoload):
+        autoload.return_value = self.no_compression
+
+        os.mkdir("empty")
+        proj_name, _ = self.make_proj()
+
+        result = self.runner.invoke(proj.archive, ["empty", proj_name])
+        assert result.exit_code == 1
+        assert ["empty", "failed"] in [
+            line.split() for line in result.output.splitlines()
+        ]
+
+    @patch("proj.configfile.Config.autoload")
+    def test_stale(self, autoload):
+        autoload.return_value = self.no_compression
+
+        old_name, _ = self.make_proj(a=arrow.get(2000, 1, 1))
+        self.make_proj(a=arrow.now())
+
+        result = self.runner.invoke(proj.main, ["stale", "--older-than", "1y"])
+        assert result.exit_code == 0
+        assert result.output == f"{old_name}\t2000/q1\n"
+
+    @patch("proj.configfile.Config.autoload")
+    def test_stale_and_archive(self, autoload):
+        autoload.return_value = self.no_compression
+
+        names = sorted(self.make_proj(a=arrow.get(2000, 1, 1))[0] for i in range(2))
+        result = self.runner.invoke(proj.main, ["stale", "--archive", "-j", "2"])
+        assert result.exit_code == 0
+
+        lines = result.output.splitlines()
+        assert lines[:2] == [f"{name}\t2000/q1" for name in names]
+        assert "summary:" in lines
+        assert os.listdir(".") == []
+
+    @patch("proj.trash.empty_later")
+    @patch("proj.configfile.Config.autoload")
+    def test_gc(self, autoload, empty_later):
+        autoload.return_value = dataclasses.replace(
+            self.bz2_compression, background_delete=True
+        )
+        proj_name, proj_path = self.make_proj(a=arrow.get(2000, 1, 1))
+
+        result = self.runner.invoke(proj.archive, [proj_name])
+        assert result.exit_code == 0
+        assert empty_later.called
+        assert not path.exists(proj_path)
+
+        result = self.runner.invoke(proj.main, ["gc"])
+        assert result.exit_code == 0
+        assert result.output == f"removed {proj_path} (1 files)\n"
+        assert os.listdir(".") == []
+
+        # nothing left to do
+        result = self.runner.invoke(proj.main, ["gc"])
+        assert result.exit_code == 0
+        assert result.output == ""
+
+    @patch("proj.trash.empty")
+    def test_gc_reports_entries_it_cant_empty(self, empty):
+        empty.return_value = [
+            trash.Emptied("/trash/1", 0, error="couldn't empty /trash/1: denied"),
+            trash.Emptied("/work/proj", 2),
+        ]
+
+        result = self.runner.invoke(proj.main, ["gc"])
+        assert result.exit_code == 1
+        assert "error: couldn't empty /trash/1: denied" in result.output
+        assert "removed /work/proj (2 files)" in result.output
+        assert "1 trash entries couldn't be emptied" in result.output
+
+    def test_gc_needs_a_thread(self):
+        result = self.runner.invoke(proj.main, ["gc", "-j", "0"])
+        assert result.exit_code == 2
+
+    @patch("proj.configfile.Config.autoload")
+    def test_stale_bad_age(self, autoload):
+        autoload.return_value = self.no_compression
+        result = self.runner.invoke(proj.main, ["stale", "--older-than", "soon"])
+        assert result.exit_code == 1
+
+    @patch("proj.configfile.Config.autoload")
+    def test_archive_with_timings(self, autoload):
+        autoload.return_value = self.bz2_compression
+        proj_name, _ = self.make_proj(data="hello")
+
+        result = self.runner.invoke(proj.main, ["--timings", "archive", proj_name])
+        assert result.exit_code == 0
+
+        lines = result.output.splitlines()
+        phases = [line.split()[0] for line in lines[2:7]]
+        assert phases == ["walk", "mkdir", "compress", "compress/remove", "index"]
+        assert "bytes read      5 B" in result.output
+
+    @patch("proj.configfile.Config.autoload")
+    def test_metrics_file_and_profile(self, autoload):
+        autoload.return_value = self.no_compression
+        proj_name, _ = self.make_proj()
+        metrics_file = path.join(self.base, "metrics.jsonl")
+        profile = path.join(self.base, "archive.prof")
+
+        for command in [["archive", proj_name], ["list"]]:
+            result = self.runner.invoke(
+                proj.main,
+                ["--profile", profile] + command,
+                env={"PROJ_METRICS_FILE": metrics_file},
+            )
+            assert result.exit_code == 0
+
+        with open(metrics_file) as istream:
+            records = [json.loads(line) for line in istream]
+
+        assert [r["command"] for r in records] == ["archive", "list"]
+        assert records[0]["counters"]["files_visited"] == 1
+        assert list(records[0]["phases"]) == ["walk", "mkdir", "move", "index"]
+
+        stats = pstats.Stats(profile)
+        assert stats.total_calls > 0  # type: ignore
+
     @patch("proj.configfile.Config.autoload")
     def test_archive_project_by_full_path_uncompressed(self, autoload):
         autoload.return_value = self.no_compression
@@ -157,6 +328,26 @@ class TestProj:
         assert result3.exit_code == 0
         assert result3.output == expected
 
+    @patch("proj.configfile.Config.autoload")
+    def test_list_ignore_case(self, autoload):
+        autoload.return_value = self.no_compression
+
+        a = arrow.get(2000, 1, 1)
+        proj_name, proj_path = self.make_proj(a=a)
+        self.runner.invoke(proj.archive, [proj_name])
+
+        expected = path.join("2000", "q1", proj_name) + "\n"
+        result = self.runner.invoke(proj.list, ["-i", proj_name.upper()])
+        assert result.exit_code == 0
+        assert result.output == expected
+
+    @patch("proj.configfile.Config.autoload")
+    def test_list_bad_regex(self, autoload):
+        autoload.return_value = self.no_compression
+
+        result = self.runner.invoke(proj.list, ["--regex", "(oops"])
+        assert result.exit_code == 1
+
     @patch("proj.configfile.Config.autoload")
     def test_archive_and_restore(self, autoload):
         autoload.return_value = self.no_compression
@@ -174,6 +365,137 @@ class TestProj:
         assert result2.exit_code == 0
         assert path.isdir(proj_path)
 
+    @patch("proj.configfile.Config.autoload")
+    def test_restore_many(self, autoload):
+        autoload.return_value = self.bz2_compression
+        names = sorted(self.make_proj()[0] for i in range(3))
+        self.runner.invoke(proj.archive, names)
+
+        result = self.runner.invoke(proj.restore, ["--jobs", "2"] + names)
+        assert result.exit_code == 0
+        assert sorted(os.listdir(".")) == names
+        assert "summary:" in result.output.splitlines()
+
+        # restoring something that isn't there fails the batch, after the rest
+        self.runner.invoke(proj.archive, names[:1])
+        for name in names[1:]:
+            shutil.rmtree(name)
+
+        result = self.runner.invoke(proj.restore, [names[0], "my-dignity"])
+        assert result.exit_code == 1
+        assert os.listdir(".") == names[:1]
+        assert f"  my-dignity  {'failed':>10}" in result.output.splitlines()
+
+    @patch("proj.configfile.Config.autoload")
+    def test_tune(self, autoload):
+        autoload.return_value = self.no_compression
+        proj_name, _ = self.make_proj(data="hello world\n" * 10000)
+
+        result = self.runner.invoke(proj.main, ["tune", "--sample", "1", proj_name])
+        assert result.exit_code == 0
+        lines = result.output.splitlines()
+        assert lines[0] == "sampled 117.2 KB from 1 files of 117.2 KB"
+        assert [line.split()[:2] for line in lines[2:-1]] == [
+            ["gztar", "1"],
+            ["gztar", "6"],
+            ["gztar", "9"],
+            ["bztar", "1"],
+            ["bztar", "9"],
+            ["xztar", "0"],
+            ["xztar", "6"],
+        ]
+        assert lines[-1] == "adaptive_compression would store 0% of it uncompressed"
+
+        result = self.runner.invoke(proj.main, ["tune", "nothing"])
+        assert result.exit_code != 0
+
+    @patch("proj.configfile.Config.autoload")
+    def test_ls_and_extract(self, autoload):
+        autoload.return_value = Config(
+            archive_dir=self.archive, compression=True, compression_format="gztar"
+        )
+        proj_name, proj_path = self.make_proj(a=arrow.get(2000, 1, 1), data="hello")
+        fs.mkdir(path.join(proj_path, "sub"))
+        fs.touch(path.join(proj_path, "sub", "empty"))
+        self.runner.invoke(proj.archive, [proj_name])
+
+        result = self.runner.invoke(proj.main, ["ls", proj_name])
+        assert result.exit_code == 0
+        assert sorted(result.output.split()) == ["data", "sub/", "sub/empty"]
+
+        result = self.runner.invoke(proj.main, ["ls", "-l", proj_name])
+        assert ["5", "B", "2000-01-01"] == result.output.split()[:3]
+
+        result = self.runner.invoke(
+            proj.main, ["extract", proj_name, "data", "-C", "out"]
+        )
+        assert result.exit_code == 0
+        assert result.output == path.join("out", proj_name, "data") + "\n"
+        with open(path.join("out", proj_name, "data")) as istream:
+            assert istream.read() == "hello"
+
+        # it stays in the archive
+        assert self.runner.invoke(proj.main, ["ls", proj_name]).exit_code == 0
+
+    @patch("proj.configfile.Config.autoload")
+    def test_extract_missing(self, autoload):
+        autoload.return_value = self.no_compression
+        proj_name, _ = self.make_proj()
+        self.runner.invoke(proj.archive, [proj_name])
+
+        result = self.runner.invoke(proj.main, ["extract", proj_name, "nothing"])
+        assert result.exit_code == 1
+
+        result = self.runner.invoke(proj.main, ["ls", "no-such-project"])
+        assert result.exit_code == 1
+
+    @patch("proj.configfile.Config.autoload")
+    def test_reindex(self, autoload):
+        autoload.return_value = self.no_compression
+
+        proj_name, _ = self.make_proj()
+        self.runner.invoke(proj.archive, [proj_name])
+
+        result = self.runner.invoke(proj.reindex, ["--full"])
+        assert result.exit_code == 0
+        assert result.output == "rescanned 1 quarters, 1 projects indexed\n"
+
+    @patch("proj.configfile.Config.autoload")
+    def test_reindex_missing_archive_dir(self, autoload):
+        autoload.return_value = Config(archive_dir=path.join(self.base, "missing"))
+
+        result = self.runner.invoke(proj.reindex, [])
+        assert result.exit_code == 1
+        assert "archive directory does not exist" in result.output
+
+    @patch("proj.configfile.Config.autoload")
+    def test_migrate(self, autoload):
+        autoload.return_value = self.no_compression
+        proj_name, _ = self.make_proj(a=arrow.get(2000, 1, 1))
+        self.runner.invoke(proj.archive, [proj_name])
+
+        cold = path.join(self.base, "cold")
+        autoload.return_value = Config(
+            archive_dir=self.archive,
+            tiers=[{"archive_dir": cold, "after_quarters": 4}],
+        )
+        result = self.runner.invoke(proj.migrate, ["--dry-run"])
+        assert result.exit_code == 0
+        assert result.output == f"2000/q1: {self.archive} --> {cold} (1 projects)\n"
+        assert not path.exists(cold)
+
+        result = self.runner.invoke(proj.migrate, [])
+        assert result.exit_code == 0
+        assert path.isdir(path.join(cold, "2000", "q1", proj_name))
+
+        result = self.runner.invoke(proj.list, [])
+        assert result.output == f"2000/q1/{proj_name}\n"
+
+        autoload.return_value = Config(archive_dir=self.archive, tiers=["/bulk"])
+        result = self.runner.invoke(proj.migrate, [])
+        assert result.exit_code == 1
+        assert "tier 1 needs" in result.output
+
     @patch("proj.configfile.Config._get_config_file")
     def test_no_config(self, get_config_file):
         get_config_file.return_value = "does-not-exist.yml"
@@ -255,6 +577,14 @@ class TestProj:
         return proj_name, proj_path
 
 
+def test_format_size():
+    assert format_size(0) == "0 B"
+    assert format_size(1023) == "1023 B"
+    assert format_size(1536) == "1.5 KB"
+    assert format_size(3 * 1024**3) == "3.0 GB"
+    assert format_size(2 * 1024**5) == "2048.0 TB"
+
+
 def random_time():
     return arrow.get(math.floor(random.random() * arrow.get(2038, 1, 1).timestamp))
 
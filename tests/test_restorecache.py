@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+#
+#  test_restorecache.py
+#  proj
+#
+
+import os
+import shutil
+import tempfile
+import time
+from os import path
+
+from proj import fs, restorecache
+from proj.ignore import IgnoreRules
+
+
+class TestRestoreCache:
+    def setup_method(self):
+        self.base = tempfile.mkdtemp()
+        self.proj = path.join(self.base, "proj")
+        fs.mkdir(path.join(self.proj, "sub", "deeper"))
+        for name in ["a", "sub/b", "sub/deeper/c"]:
+            with open(path.join(self.proj, name), "w") as ostream:
+                ostream.write(name)
+        os.symlink("sub", path.join(self.proj, "link"))
+
+        self.cache_dir = path.join(self.base, "cache")
+
+    def teardown_method(self):
+        shutil.rmtree(self.base)
+
+    def test_fingerprint(self):
+        fingerprint = restorecache.fingerprint(self.proj)
+        assert len(fingerprint.digest) == 64
+        assert sorted(fingerprint.files) == [
+            path.join(self.proj, name) for name in ["a", "link", "sub/b", "sub/deeper/c"]
+        ]
+        assert len(fingerprint.dirs) == 3
+        assert restorecache.fingerprint(self.proj) == fingerprint
+
+    def test_fingerprint_sees_every_change(self):
+        seen = {restorecache.fingerprint(self.proj).digest}
+        deep_file = path.join(self.proj, "sub", "deeper", "c")
+
+        def changes():
+            # a new mtime, then a new size with the same mtime
+            os.utime(deep_file, (1e9, 1e9))
+            yield
+            with open(deep_file, "a") as ostream:
+                ostream.write("!")
+            os.utime(deep_file, (1e9, 1e9))
+            yield
+            os.chmod(deep_file, 0o600)
+            yield
+            os.rename(deep_file, deep_file + "2")
+            yield
+            fs.mkdir(path.join(self.proj, "sub", "empty"))
+            yield
+            os.unlink(path.join(self.proj, "link"))
+            os.symlink("a", path.join(self.proj, "link"))
+            yield
+
+        for _ in changes():
+            digest = restorecache.fingerprint(self.proj).digest
+            assert digest not in seen
+            seen.add(digest)
+
+    def test_fingerprint_covers_the_name(self):
+        before = restorecache.fingerprint(self.proj).digest
+        os.rename(self.proj, self.proj + "2")
+        assert restorecache.fingerprint(self.proj + "2").digest != before
+
+    def test_fingerprint_without_ignored_files(self):
+        rules = IgnoreRules(self.proj, ["deeper"])
+        before = restorecache.fingerprint(self.proj, scan=rules.scan_dir)
+        fs.touch(path.join(self.proj, "sub", "deeper", "d"))
+
+        after = restorecache.fingerprint(self.proj, scan=rules.scan_dir)
+        assert after.digest == before.digest
+        assert [e.name for e in after.ignored] == ["deeper"]
+
+    def test_fingerprint_single_file(self):
+        filename = path.join(self.proj, "a")
+        fingerprint = restorecache.fingerprint(filename)
+        assert fingerprint.files == [filename]
+        assert fingerprint.digest != restorecache.fingerprint(self.proj).digest
+
+    def test_keep(self):
+        digest = "ab" * 32
+        archive = self.make_archive("proj.tar.gz", 100)
+
+        assert restorecache.keep(archive, digest, self.cache_dir, 1000)
+        assert not path.exists(archive)
+        assert restorecache.candidates(self.cache_dir, "proj") == {
+            digest: path.join(self.cache_dir, f"proj.{digest}.tar.gz")
+        }
+        assert restorecache.candidates(self.cache_dir, "pro") == {}
+
+        # too big to keep
+        archive = self.make_archive("huge.dedup", 2000)
+        assert not restorecache.keep(archive, digest, self.cache_dir, 1000)
+        assert restorecache.candidates(self.cache_dir, "huge") == {}
+
+    def test_evict_the_oldest_first(self):
+        for i in range(4):
+            archive = self.make_archive(f"proj{i}.tar.bz2", 400)
+            restorecache.keep(archive, "cd" * 32, self.cache_dir, 10 ** 6)
+            kept = path.join(self.cache_dir, f"proj{i}.{'cd' * 32}.tar.bz2")
+            t = time.time() - 1000 + i
+            os.utime(kept, (t, t))
+
+        evicted = restorecache.evict(self.cache_dir, 1000)
+        assert [path.basename(p)[:5] for p in evicted] == ["proj0", "proj1"]
+        assert len(os.listdir(self.cache_dir)) == 2
+
+        assert restorecache.evict(path.join(self.base, "nothing"), 0) == []
+
+    def test_candidates_ignores_strangers(self):
+        fs.mkdir(self.cache_dir)
+        for name in ["proj.tar.gz", "proj.xyz.tar.gz", f"proj.2.{'ef' * 32}.zip"]:
+            fs.touch(path.join(self.cache_dir, name))
+
+        assert restorecache.candidates(self.cache_dir, "proj") == {}
+        assert list(restorecache.candidates(self.cache_dir, "proj.2")) == ["ef" * 32]
+
+    def make_archive(self, name, size):
+        filename = path.join(self.base, name)
+        with open(filename, "wb") as ostream:
+            ostream.write(b"x" * size)
+        return filename
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+#
+#  test_seekable.py
+#  proj
+#
+
+import gzip
+import io
+import shutil
+import tempfile
+from os import path
+
+from proj import seekable
+from proj.seekable import Member, SeekableIndex
+
+
+def make_index():
+    members = [
+        Member("proj", "d", 0, 1000, 0),
+        Member("proj/data", "f", 5000, 2000, 512),
+        Member("proj/üñí", "f", 0, 3000, 6144),
+    ]
+    return SeekableIndex(members, blocks=[(0, 0), (100, 4096)], data_end=300)
+
+
+class TestSeekable:
+    def setup_method(self):
+        self.base = tempfile.mkdtemp()
+        self.filename = path.join(self.base, "out.tar.gz")
+
+    def teardown_method(self):
+        shutil.rmtree(self.base)
+
+    def test_round_trip(self):
+        index = make_index()
+        data = gzip.compress(b"a" * 4096) + gzip.compress(b"b" * 100)
+        index.data_end = len(data)
+
+        with open(self.filename, "wb") as ostream:
+            ostream.write(data)
+            seekable.write_index(ostream, index)
+
+        assert seekable.read_index(self.filename) == index
+
+        # the index is invisible to gzip
+        with gzip.open(self.filename) as istream:
+            assert istream.read() == b"a" * 4096 + b"b" * 100
+
+    def test_no_index(self):
+        with open(self.filename, "wb") as ostream:
+            ostream.write(gzip.compress(b"x" * 1000))
+
+        assert seekable.read_index(self.filename) is None
+        assert seekable.read_index(path.join(self.base, "missing")) is None
+
+    def test_corrupt_index(self):
+        buf = io.BytesIO()
+        seekable.write_index(buf, make_index())
+        data = bytearray(buf.getvalue())
+        data[30] ^= 0xFF
+
+        with open(self.filename, "wb") as ostream:
+            ostream.write(data)
+
+        assert seekable.read_index(self.filename) is None
+
+    def test_blocks(self):
+        index = make_index()
+        assert [index.block_at(o) for o in [0, 4095, 4096, 10 ** 6]] == [0, 0, 1, 1]
+        assert index.block_extent(0) == (0, 100)
+        assert index.block_extent(1) == (100, 300)
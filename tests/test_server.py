@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+#
+#  test_server.py
+#  proj
+#
+
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from os import path
+from unittest.mock import patch
+
+import pytest
+from click.testing import CliRunner
+
+import proj
+from proj import daemon, fs, logic, server
+from proj.configfile import Config
+from proj.exceptions import CommandError
+
+
+class TestServer:
+    def setup_method(self):
+        self.base = tempfile.mkdtemp()
+        self.archive = path.join(self.base, "archive")
+        fs.mkdir(path.join(self.archive, "2012", "q3", "old-crusty-project"))
+        fs.mkdir(path.join(self.archive, "2013", "q1"))
+        fs.touch(path.join(self.archive, "2013", "q1", "news-for-llamas.tar.gz"))
+        fs.touch(path.join(self.archive, "2013", "q1", "old-crusty-project.tar.gz"))
+        for quarter in ["2012/q3", "2013/q1"]:
+            os.utime(path.join(self.archive, quarter), (1e9, 1e9))
+
+        self.env = patch.dict(os.environ, {"XDG_RUNTIME_DIR": self.base})
+        self.env.start()
+
+        # so stopping the daemon doesn't keep us waiting
+        self.poll = patch.object(server, "POLL_INTERVAL", 0.05)
+        self.poll.start()
+        self.daemon = None
+
+    def teardown_method(self):
+        if self.daemon:
+            self.daemon.stopped.set()
+            self.thread.join()
+            self.daemon.stop()
+
+        self.poll.stop()
+        self.env.stop()
+        shutil.rmtree(self.base)
+
+    def test_catalog(self):
+        catalog = server.Catalog(self.archive)
+        assert catalog.reload()
+        assert not catalog.reload()
+
+        assert catalog.answer({"op": "list", "patterns": ["crusty"]}) == [
+            "2012/q3/old-crusty-project",
+            "2013/q1/old-crusty-project",
+        ]
+        assert catalog.answer({"op": "list", "patterns": ["^n"], "regex": True}) == [
+            "2013/q1/news-for-llamas"
+        ]
+        assert catalog.answer({"op": "find", "names": ["old-crusty-project", "x"]}) == [
+            ["2012/q3/old-crusty-project", "2013/q1/old-crusty-project.tar.gz"],
+            [],
+        ]
+        assert catalog.answer({"op": "names", "prefix": "ne"}) == ["news-for-llamas"]
+        assert catalog.answer({"op": "names", "prefix": "", "limit": 1}) == [
+            "news-for-llamas"
+        ]
+
+        stat = catalog.answer({"op": "stat"})
+        assert (stat["projects"], stat["quarters"]) == (3, 2)
+
+        with pytest.raises(CommandError):
+            catalog.answer({"op": "list", "patterns": ["("], "regex": True})
+
+        with pytest.raises(CommandError):
+            catalog.answer({"op": "dance"})
+
+        # a quarter that changed a moment ago might change again unseen
+        fs.touch(path.join(self.archive, "2013", "q1", "cocktails"))
+        assert catalog.reload()
+        assert catalog.reload()
+
+    def test_watched_dirs(self):
+        assert sorted(server._watched_dirs(self.archive)) == [
+            self.archive,
+            path.join(self.archive, "2012"),
+            path.join(self.archive, "2012", "q3"),
+            path.join(self.archive, "2013"),
+            path.join(self.archive, "2013", "q1"),
+        ]
+
+    def test_no_daemon(self):
+        assert daemon.query(self.archive, {"op": "stat"}) is None
+
+        # a socket left behind by a daemon that died
+        with socket.socket(socket.AF_UNIX) as sock:
+            sock.bind(daemon.socket_path(self.archive))
+        assert daemon.query(self.archive, {"op": "stat"}) is None
+
+    def test_serve(self):
+        self.serve()
+        assert self.query({"op": "stat"})["projects"] == 3
+        assert self.query({"op": "stat"})["watching"] == "inotify"
+        assert self.query({"op": "names", "prefix": "old"}) == ["old-crusty-project"]
+
+        with pytest.raises(CommandError):
+            self.query({"op": "list", "patterns": ["("], "regex": True})
+
+        with pytest.raises(CommandError):
+            server.Daemon(self.archive).start()
+
+    def test_serve_hears_about_changes(self):
+        self.serve()
+        new_quarter = path.join(self.archive, "2014", "q2")
+        self.wait_for_change(lambda: fs.mkdir(path.join(new_quarter, "a")))
+
+        # in a quarter that didn't exist when we started
+        self.wait_for_change(lambda: fs.mkdir(path.join(new_quarter, "b")))
+
+    def test_serve_by_polling(self):
+        old_project = path.join(self.archive, "2012", "q3", "old-crusty-project")
+        with patch.object(
+            server, "make_watcher", lambda archive_dir: server.PollingWatcher()
+        ):
+            self.serve()
+            assert self.query({"op": "stat"})["watching"] == "polling"
+            self.wait_for_change(lambda: os.rmdir(old_project))
+
+    @patch("proj.configfile.Config.autoload")
+    def test_serve_status(self, autoload):
+        autoload.return_value = Config(archive_dir=self.archive)
+        runner = CliRunner()
+
+        result = runner.invoke(proj.main, ["serve", "--status"])
+        assert result.exit_code == 1
+        assert "not serving" in result.output
+
+        self.serve()
+        result = runner.invoke(proj.main, ["serve", "--status"])
+        assert result.exit_code == 0
+        assert result.output.startswith(
+            f"serving 3 projects in 2 quarters from {self.archive}\n"
+            f"pid {os.getpid()}, watching by inotify, loaded "
+        )
+
+    def test_cli_uses_daemon(self):
+        config = Config(archive_dir=self.archive)
+        self.serve()
+
+        with patch.object(logic.ArchiveIndex, "open", side_effect=AssertionError):
+            assert logic.list_projects(["llamas"], config) == [
+                "2013/q1/news-for-llamas"
+            ]
+            assert logic._find_restore_match("news-for-llamas", [self.archive]) == (
+                path.join(self.archive, "2013", "q1", "news-for-llamas.tar.gz")
+            )
+
+    def test_our_own_changes_are_seen_at_once(self):
+        config = Config(archive_dir=self.archive)
+        self.serve()
+
+        project = path.join(self.base, "current", "cocktails")
+        fs.mkdir(project)
+        fs.touch(path.join(project, "recipes"))
+        os.utime(path.join(project, "recipes"), (1e9, 1e9))
+
+        # no waiting for inotify
+        with patch.object(server.InotifyWatcher, "wait", return_value=False):
+            logic.archive(project, config)
+            assert logic.list_projects(["cocktails"], config) == ["2001/q3/cocktails"]
+
+    def serve(self):
+        d = server.Daemon(self.archive)
+        d.start()
+        self.daemon = d
+        self.thread = threading.Thread(target=self.daemon.run)
+        self.thread.start()
+
+    def query(self, request):
+        result = daemon.query(self.archive, request)
+        assert result is not None
+        return result
+
+    def wait_for_change(self, change):
+        before = self.query({"op": "stat"})
+        change()
+        for _ in range(100):
+            if self.query({"op": "stat"}) != before:
+                return
+            time.sleep(0.02)
+
+        raise AssertionError("the daemon didn't notice")
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+#
+#  test_startup.py
+#  proj
+#
+
+"""
+Guard against slow imports creeping back into the CLI's startup path.
+"""
+
+import subprocess
+import sys
+
+import pytest
+
+
+# modules that are too slow to import for `proj --help` or `proj list`
+HEAVY_MODULES = ["arrow", "yaml", "tarfile", "gzip"]
+
+
+def imported_by(statement):
+    script = f"import sys; {statement}; print('\\n'.join(sys.modules))"
+    output = subprocess.check_output([sys.executable, "-c", script], text=True)
+    return set(output.split())
+
+
+def test_import_proj_is_light():
+    modules = imported_by("import proj")
+    for name in HEAVY_MODULES + ["sqlite3", "proj.logic", "proj.configfile"]:
+        assert name not in modules
+
+
+def test_list_path_is_light():
+    modules = imported_by("import proj.logic, proj.configfile")
+    for name in HEAVY_MODULES:
+        assert name not in modules
+
+
+def test_compression_works_off_unix():
+    # only deleting in the background needs fcntl
+    modules = imported_by("import proj.logic, proj.compress")
+    assert "fcntl" not in modules
+
+
+@pytest.mark.parametrize("name", ["Config", "NoConfigError", "logic"])
+def test_lazy_attributes(name):
+    import proj
+
+    assert getattr(proj, name) is not None
+
+
+def test_missing_attribute():
+    import proj
+
+    with pytest.raises(AttributeError):
+        proj.cheese
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+#
+#  test_throttle.py
+#  proj
+#
+
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+from os import path
+from unittest.mock import patch
+
+import pytest
+
+from proj import fs, throttle
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_token_bucket():
+    clock = FakeClock()
+    with patch("time.monotonic", clock):
+        bucket = throttle.TokenBucket(10)
+
+        # a second's worth in a burst, then we wait
+        assert bucket.take(10) == 0
+        assert bucket.take(5) == 0.5
+        assert bucket.take(5) == 1.0
+
+        clock.now += 1.0
+        assert bucket.take(5) == 0.5
+
+        # no saving up for more than a burst
+        clock.now += 60.0
+        assert bucket.take(10) == 0
+        assert bucket.take(1) == pytest.approx(0.1)
+
+
+def test_budgets():
+    clock = FakeClock()
+    with patch("time.monotonic", clock):
+        t = throttle.Throttle(bytes_per_s=1000, ops_per_s=2)
+        assert t.delay(500, 0.001) == 0
+        assert t.delay(1000, 0.001) == 0.5
+        # then we run out of reads too
+        assert t.delay(0, 0.001) == 0.5
+        assert t.delay(0, 0.001) == 1.0
+
+    assert throttle.Throttle().delay(10 ** 9, 0.001, ops=10 ** 6) == 0
+
+
+def test_back_off_while_reads_are_slow():
+    t = throttle.Throttle()
+    slow = throttle.SLOW_READ * 2
+
+    assert t.delay(throttle.CHUNK, slow) == throttle.MIN_PAUSE
+    assert t.delay(throttle.CHUNK, slow) == 2 * throttle.MIN_PAUSE
+    for _ in range(20):
+        t.delay(throttle.CHUNK, slow)
+    assert t.delay(throttle.CHUNK, slow) == throttle.MAX_PAUSE
+
+    waits = [t.delay(throttle.CHUNK, 0.001) for _ in range(20)]
+    assert waits[0] == throttle.MAX_PAUSE / 2
+    assert waits == sorted(waits, reverse=True)
+    assert waits[-1] == 0
+
+
+@patch.object(throttle, "lower_priority")
+def test_running(lower_priority):
+    assert throttle.active() is None
+
+    with throttle.running(1000) as outer:
+        lower_priority.assert_called_once()
+        with throttle.running(5) as inner:
+            # shared, so that projects archived at once share the budget
+            assert inner is outer
+        assert throttle.active() is outer
+
+    assert throttle.active() is None
+
+
+@pytest.mark.skipif(
+    platform.machine() not in throttle.IOPRIO_SET or sys.platform != "linux",
+    reason="ioprio is only for Linux",
+)
+def test_lower_priority():
+    # in a process of its own, since there's no going back
+    script = (
+        "import ctypes, os, platform\n"
+        "from proj import throttle\n"
+        "before = os.nice(0)\n"
+        "throttle.lower_priority()\n"
+        "throttle.lower_priority()\n"
+        "get = throttle.IOPRIO_SET[platform.machine()] + 1\n"
+        "libc = ctypes.CDLL(None)\n"
+        "print(before, os.nice(0), libc.syscall(get, 1, 0))\n"
+    )
+    package_root = path.dirname(path.dirname(path.abspath(throttle.__file__)))
+    output = subprocess.check_output(
+        [sys.executable, "-c", script],
+        env=dict(os.environ, PYTHONPATH=package_root),
+        text=True,
+    )
+
+    before, after, ioprio = output.split()
+    # but no nicer than can be
+    assert int(after) == min(19, int(before) + throttle.NICENESS)
+    assert int(ioprio) == throttle.IOPRIO_CLASS_BE << 13 | throttle.IOPRIO_LOWEST
+
+
+class TestThrottledIO:
+    def setup_method(self):
+        self.base = tempfile.mkdtemp()
+        self.data = os.urandom(3 * throttle.CHUNK + 123)
+        self.filename = path.join(self.base, "data")
+        with open(self.filename, "wb") as ostream:
+            ostream.write(self.data)
+
+        self.lower = patch.object(throttle, "lower_priority")
+        self.lower.start()
+
+    def teardown_method(self):
+        self.lower.stop()
+        shutil.rmtree(self.base)
+
+    def test_open_file(self):
+        with throttle.open_file(self.filename) as istream:
+            assert not isinstance(istream.raw, throttle.ThrottledReader)
+            assert istream.read() == self.data
+
+    @patch("os.posix_fadvise")
+    def test_open_file_throttled(self, fadvise):
+        with throttle.running() as t, patch.object(
+            t, "done", wraps=t.done
+        ) as done, throttle.open_file(self.filename) as istream:
+            assert istream.read(10 ** 7) == self.data
+
+        # the open, a read per chunk, and the read that found the end
+        assert done.call_count == 1 + 4 + 1
+        assert max(call.args[0] for call in done.call_args_list) == throttle.CHUNK
+
+        assert fadvise.call_count == 4
+        assert {call.args[3] for call in fadvise.call_args_list} == {
+            os.POSIX_FADV_DONTNEED
+        }
+        assert sum(call.args[2] for call in fadvise.call_args_list) == len(self.data)
+
+    @patch("os.posix_fadvise")
+    def test_copy_throttled(self, fadvise):
+        fs.mkdir(path.join(self.base, "src"))
+        os.rename(self.filename, path.join(self.base, "src", "data"))
+        src = path.join(self.base, "src")
+        dest = path.join(self.base, "dest")
+
+        with throttle.running(bytes_per_s=10 ** 9):
+            stats = fs.copy_tree(src, dest)
+
+        assert stats.size == len(self.data)
+        with open(path.join(dest, "data"), "rb") as istream:
+            assert istream.read() == self.data
+
+        # the source and the copy, for each chunk
+        assert fadvise.call_count == 2 * 4
+
+    def test_budget_slows_us_down(self):
+        with throttle.running(bytes_per_s=len(self.data)), patch(
+            "time.sleep"
+        ) as sleep:
+            for _ in range(3):
+                with throttle.open_file(self.filename) as istream:
+                    istream.read()
+
+        # the first second's worth is free, then we wait for the rest; with
+        # no time passing, the last wait is for all of it
+        assert sleep.call_args.args[0] == pytest.approx(2.0, abs=0.1)
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+#
+#  test_tiers.py
+#  proj
+#
+
+import datetime as dt
+
+import pytest
+
+from proj import tiers
+from proj.configfile import Config
+from proj.exceptions import CommandError
+
+
+NOW = dt.datetime(2020, 5, 17, tzinfo=dt.timezone.utc)
+
+
+def make_config(*tier_records):
+    return Config(archive_dir="/ssd", tiers=list(tier_records))
+
+
+def test_tiers_for():
+    config = make_config(
+        {"archive_dir": "/tape", "after_quarters": 40},
+        {"archive_dir": "/bulk", "after_quarters": 8},
+    )
+    assert tiers.tiers_for(config) == [
+        tiers.Tier("/ssd", 0),
+        tiers.Tier("/bulk", 8),
+        tiers.Tier("/tape", 40),
+    ]
+    assert tiers.archive_dirs(config) == ["/ssd", "/bulk", "/tape"]
+    assert tiers.archive_dirs(Config(archive_dir="/ssd")) == ["/ssd"]
+
+
+@pytest.mark.parametrize(
+    "records",
+    [
+        [{"archive_dir": "/bulk"}],
+        [{"archive_dir": "/bulk", "after_quarters": "soon"}],
+        [{"archive_dir": "/bulk", "after_quarters": 0}],
+        [{"archive_dir": "/ssd", "after_quarters": 8}],
+        [
+            {"archive_dir": "/bulk", "after_quarters": 8},
+            {"archive_dir": "/tape", "after_quarters": 8},
+        ],
+        ["/bulk"],
+    ],
+)
+def test_bad_tiers(records):
+    with pytest.raises(CommandError):
+        tiers.tiers_for(make_config(*records))
+
+
+@pytest.mark.parametrize(
+    "year,quarter,age",
+    [("2020", "q2", 0), ("2020", "q1", 1), ("2019", "q3", 3), ("2018", "q2", 8)],
+)
+def test_quarter_age(year, quarter, age):
+    assert tiers.quarter_age(year, quarter, now=NOW) == age
+
+
+def test_tier_for():
+    all_tiers = tiers.tiers_for(make_config({"archive_dir": "/bulk", "after_quarters": 8}))
+    assert tiers.tier_for(all_tiers, "2020", "q2", now=NOW).archive_dir == "/ssd"
+    assert tiers.tier_for(all_tiers, "2018", "q3", now=NOW).archive_dir == "/ssd"
+    assert tiers.tier_for(all_tiers, "2018", "q2", now=NOW).archive_dir == "/bulk"
+    assert tiers.tier_for(all_tiers, "1999", "q1", now=NOW).archive_dir == "/bulk"
+    assert tiers.tier_for(all_tiers, "2031", "q1", now=NOW).archive_dir == "/ssd"
+
+
+def test_tier_of():
+    all_tiers = tiers.tiers_for(make_config({"archive_dir": "/bulk", "after_quarters": 8}))
+    assert tiers.tier_of(all_tiers, "/bulk/2012/q3/x.tar.gz") == all_tiers[1]
+    assert tiers.tier_of(all_tiers, "/ssd/2020/q2") == all_tiers[0]
+    assert tiers.tier_of(all_tiers, "/ssd-old/2020/q2") is None
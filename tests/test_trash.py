@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+#
+#  test_trash.py
+#  proj
+#
+
+import fcntl
+import os
+import shutil
+import tempfile
+import time
+from os import path
+from unittest.mock import patch
+
+from proj import fs, trash
+
+
+class TestTrash:
+    def setup_method(self):
+        self.old_cwd = os.getcwd()
+        self.base = tempfile.mkdtemp()
+        os.chdir(self.base)
+
+        fs.mkdir("proj/sub")
+        fs.mkdir("proj/node_modules/left-pad")
+        fs.touch("proj/a")
+        fs.touch("proj/sub/b")
+        fs.touch("proj/node_modules/left-pad/index.js")
+        os.symlink("sub", "proj/link")
+
+        self.trash_dir = trash.trash_dir_for("proj")
+
+    def teardown_method(self):
+        os.chdir(self.old_cwd)
+        shutil.rmtree(self.base)
+
+    def test_trash_beside_the_project(self):
+        assert self.trash_dir == path.join(self.base, trash.TRASH_DIR)
+
+    def test_discard_then_empty(self):
+        assert trash.discard("proj", self.trash_dir, *self.walk())
+        assert not path.exists("proj")
+        assert len(os.listdir(self.trash_dir)) == 1
+
+        emptied = trash.empty(self.trash_dir)
+        assert emptied == [trash.Emptied(path.abspath("proj"), 3)]
+        assert not path.exists(self.trash_dir)
+        assert not path.exists("proj")
+
+    def test_discard_everything(self):
+        assert trash.discard("proj", self.trash_dir)
+
+        emptied = trash.empty(self.trash_dir)
+        assert emptied == [trash.Emptied(path.abspath("proj"), 4)]
+        assert not path.exists(self.trash_dir)
+
+    def test_discard_single_file(self):
+        assert trash.discard("proj/a", self.trash_dir, ["proj/a"], [])
+        assert trash.empty(self.trash_dir) == [
+            trash.Emptied(path.abspath("proj/a"), 1)
+        ]
+        assert not path.exists("proj/a")
+
+    def test_new_files_are_put_back(self):
+        walked = self.walk()
+        fs.touch("proj/sub/new")
+
+        trash.discard("proj", self.trash_dir, *walked)
+        emptied = trash.empty(self.trash_dir)
+
+        assert emptied[0].kept == path.abspath("proj")
+        assert list(fs.iter_files("proj")) == ["proj/sub/new"]
+        assert not path.exists(self.trash_dir)
+
+    def test_new_files_wait_if_the_project_is_back(self):
+        walked = self.walk()
+        fs.touch("proj/sub/new")
+        trash.discard("proj", self.trash_dir, *walked)
+        fs.mkdir("proj")
+
+        (emptied,) = trash.empty(self.trash_dir)
+        assert emptied.kept and emptied.kept.startswith(self.trash_dir)
+        assert path.exists(path.join(emptied.kept, "sub", "new"))
+
+        # once the way is clear, they go back
+        os.rmdir("proj")
+        (emptied,) = trash.empty(self.trash_dir)
+        assert emptied.kept == path.abspath("proj")
+        assert path.exists("proj/sub/new")
+        assert not path.exists(self.trash_dir)
+
+    def test_fall_back_to_removing_in_place(self):
+        with patch("os.rename", side_effect=OSError("cross-device link")):
+            assert not trash.discard("proj", self.trash_dir, *self.walk())
+
+        assert not path.exists("proj")
+        assert os.listdir(self.trash_dir) == []
+
+    def test_skip_entries_being_emptied(self):
+        trash.discard("proj", self.trash_dir, *self.walk())
+        (entry,) = os.listdir(self.trash_dir)
+
+        with open(path.join(self.trash_dir, entry, trash.MANIFEST)) as istream:
+            fcntl.flock(istream.fileno(), fcntl.LOCK_EX)
+            assert trash.empty(self.trash_dir) == []
+
+        assert len(trash.empty(self.trash_dir)) == 1
+
+    def test_keep_going_past_entries_we_cant_empty(self):
+        fs.mkdir("other")
+        fs.touch("other/c")
+        trash.discard("other", self.trash_dir)
+        trash.discard("proj", self.trash_dir, *self.walk())
+        stuck, _ = sorted(os.listdir(self.trash_dir))
+        stuck = path.join(self.trash_dir, stuck)
+
+        real_unlink = os.unlink
+
+        def unlink(p, **kwargs):
+            if p == path.join(stuck, trash.MANIFEST):
+                raise PermissionError(13, "Permission denied", p)
+            real_unlink(p, **kwargs)
+
+        with patch("os.unlink", side_effect=unlink):
+            failed, emptied = trash.empty(self.trash_dir)
+
+        assert failed.source == stuck
+        assert failed.error and "Permission denied" in failed.error
+        assert emptied.error is None
+        assert os.listdir(self.trash_dir) == [path.basename(stuck)]
+
+    def test_resume_after_interruption(self):
+        walked = self.walk()
+        trash.discard("proj", self.trash_dir, *walked)
+        (entry,) = os.listdir(self.trash_dir)
+        os.unlink(path.join(self.trash_dir, entry, trash.TREE, "a"))
+
+        assert len(trash.empty(self.trash_dir)) == 1
+        assert not path.exists(self.trash_dir)
+
+    def test_abandoned_entries(self):
+        fs.mkdir(path.join(self.trash_dir, "young"))
+        fs.mkdir(path.join(self.trash_dir, "old"))
+        long_ago = time.time() - 2 * trash.ABANDONED_AFTER
+        os.utime(path.join(self.trash_dir, "old"), (long_ago, long_ago))
+
+        assert trash.empty(self.trash_dir) == []
+        assert os.listdir(self.trash_dir) == ["young"]
+
+    def test_empty_later(self):
+        trash.discard("proj", self.trash_dir, *self.walk())
+        trash.empty_later(self.trash_dir)
+
+        for _ in range(100):
+            if not path.exists(self.trash_dir):
+                break
+            time.sleep(0.1)
+
+        assert not path.exists(self.trash_dir)
+
+    def test_nothing_to_empty_later(self):
+        with patch("subprocess.Popen") as popen:
+            assert not trash.empty_later(self.trash_dir)
+
+            # a project on another filesystem is removed in place
+            with patch("os.rename", side_effect=OSError("cross-device link")):
+                trash.discard("proj", self.trash_dir, *self.walk())
+            assert not trash.empty_later(self.trash_dir)
+
+        assert not popen.called
+
+    def walk(self):
+        "What archiving the project would find, ignoring node_modules."
+        files, dirs, ignored = [], [], []
+        for folder in fs.scan_tree("proj"):
+            if "node_modules" in folder.path.split(os.sep):
+                continue
+
+            dirs.append(folder.path)
+            files.extend(e.path for e in folder.files + folder.dir_links)
+            ignored.extend(
+                e for e in os.scandir(folder.path) if e.name == "node_modules"
+            )
+
+        return files, dirs, ignored
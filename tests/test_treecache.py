@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+#
+#  test_treecache.py
+#  proj
+#
+
+import os
+import shutil
+import tempfile
+from os import path
+from unittest.mock import patch
+
+import pytest
+
+from proj import fs, treecache
+from proj.ignore import IgnoreRules
+from proj.treecache import TreeCache
+
+
+@pytest.fixture
+def tree():
+    base = tempfile.mkdtemp()
+    root = path.join(base, "project")
+    for folder in ["a", "a/b", "c"]:
+        fs.mkdir(path.join(root, folder))
+        write(path.join(root, folder, "data"), "hello", 1_000_000_000)
+
+    # tests run well within the grace period of making the tree
+    with patch.object(treecache, "GRACE_NS", -(10 ** 12)):
+        yield base, root
+
+    shutil.rmtree(base)
+
+
+def write(filename, data, mtime):
+    with open(filename, "w") as ostream:
+        ostream.write(data)
+
+    os.utime(filename, (mtime, mtime))
+
+
+def cached_stats(base, root):
+    return TreeCache.for_project(root, path.join(base, "cache")).tree_stats()
+
+
+def count_listings(base, root):
+    with patch.object(fs, "scan_dir", wraps=fs.scan_dir) as scan_dir:
+        stats = cached_stats(base, root)
+
+    return stats, scan_dir.call_count
+
+
+def test_same_stats_as_a_full_walk(tree):
+    base, root = tree
+    assert cached_stats(base, root) == fs.tree_stats(root)
+    assert cached_stats(base, root) == fs.tree_stats(root)
+
+
+def test_unchanged_folders_are_not_listed(tree):
+    base, root = tree
+    _, listed = count_listings(base, root)
+    assert listed == 4
+
+    stats, listed = count_listings(base, root)
+    assert listed == 0
+    assert stats == fs.tree_stats(root)
+
+
+def test_only_changed_folders_are_listed(tree):
+    base, root = tree
+    cached_stats(base, root)
+
+    write(path.join(root, "a", "b", "new"), "newer", 2_000_000_000)
+    stats, listed = count_listings(base, root)
+    assert listed == 1
+    assert stats == fs.TreeStats(latest=2_000_000_000, size=20, files=4)
+
+    shutil.rmtree(path.join(root, "a"))
+    stats, listed = count_listings(base, root)
+    assert listed == 1
+    assert stats == fs.TreeStats(latest=1_000_000_000, size=5, files=1)
+
+
+def test_restored_mtimes_are_noticed(tree):
+    base, root = tree
+    cached_stats(base, root)
+
+    # add a file, then put the folder's mtime back the way tar would
+    c = path.join(root, "c")
+    st = os.stat(c)
+    write(path.join(c, "extracted"), "old", 1_500_000_000)
+    os.utime(c, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+    assert cached_stats(base, root).latest == 1_500_000_000
+
+
+def test_files_edited_in_place_are_missed(tree):
+    # the documented trade-off of the cache
+    base, root = tree
+    cached_stats(base, root)
+
+    write(path.join(root, "c", "data"), "hello", 2_000_000_000)
+    assert cached_stats(base, root).latest == 1_000_000_000
+
+
+def test_forget(tree):
+    base, root = tree
+    cache = TreeCache.for_project(root, path.join(base, "cache"))
+    cache.tree_stats()
+    assert path.exists(cache.cache_file)
+
+    cache.forget()
+    assert not path.exists(cache.cache_file)
+    cache.forget()
+
+
+def test_corrupt_cache_is_ignored(tree):
+    base, root = tree
+    cache = TreeCache.for_project(root, path.join(base, "cache"))
+    fs.mkdir(path.dirname(cache.cache_file))
+    with open(cache.cache_file, "w") as ostream:
+        ostream.write("{not json")
+
+    assert cached_stats(base, root) == fs.tree_stats(root)
+
+
+def test_changed_rules_empty_the_cache(tree):
+    base, root = tree
+    cache_dir = path.join(base, "cache")
+    rules = IgnoreRules(root, ["b"])
+
+    stats = TreeCache.for_project(root, cache_dir, rules=rules).tree_stats()
+    assert stats.files == 2
+
+    stats = TreeCache.for_project(root, cache_dir).tree_stats()
+    assert stats.files == 3
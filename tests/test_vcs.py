@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+#
+#  test_vcs.py
+#  proj
+#
+
+import os
+import shutil
+import subprocess
+import tempfile
+from os import path
+from unittest.mock import patch
+
+import pytest
+
+from proj import fs, vcs
+from proj.vcs import GitRepo
+
+pytestmark = pytest.mark.skipif(shutil.which("git") is None, reason="needs git")
+
+OLD = 978307200  # 2001-01-01
+LATER = 1000000000  # 2001-09-09
+
+
+def git(repo, *args, when=OLD):
+    date = f"@{when} +0000"
+    env = dict(
+        os.environ,
+        GIT_AUTHOR_DATE=date,
+        GIT_COMMITTER_DATE=date,
+        GIT_AUTHOR_NAME="A U Thor",
+        GIT_AUTHOR_EMAIL="author@example.com",
+        GIT_COMMITTER_NAME="A U Thor",
+        GIT_COMMITTER_EMAIL="author@example.com",
+    )
+    subprocess.run(["git", *args], cwd=repo, env=env, check=True, capture_output=True)
+
+
+def write(filename, data, mtime=OLD):
+    fs.mkdir(path.dirname(filename))
+    with open(filename, "w") as ostream:
+        ostream.write(data)
+
+    os.utime(filename, (mtime, mtime))
+
+
+@pytest.fixture
+def repo():
+    base = tempfile.mkdtemp()
+    root = path.join(base, "repo")
+    os.mkdir(root)
+    git(root, "init", "-q")
+
+    write(path.join(root, "README"), "hello")
+    write(path.join(root, "src", "main.py"), "print('hello')")
+    write(path.join(root, ".gitignore"), "build/\n!build/keep\n")
+    git(root, "add", "-A")
+    git(root, "commit", "-q", "-m", "First")
+
+    yield root
+    shutil.rmtree(base)
+
+
+def test_clean_repo(repo):
+    stats = GitRepo.find(repo).tree_stats()  # type: ignore
+    assert stats == fs.TreeStats(latest=OLD, size=38, files=3)
+
+
+def test_new_commits(repo):
+    git(repo, "commit", "-q", "--allow-empty", "-m", "Later", when=LATER)
+    assert GitRepo.find(repo).tree_stats().latest == LATER  # type: ignore
+
+
+def test_stop_after_skips_the_walk(repo):
+    git(repo, "commit", "-q", "--allow-empty", "-m", "Later", when=LATER)
+    stats = GitRepo.find(repo).tree_stats(stop_after=OLD)  # type: ignore
+    assert stats == fs.TreeStats(latest=LATER)
+
+
+def test_changed_files_count(repo):
+    write(path.join(repo, "README"), "hello, world", mtime=LATER)
+    assert GitRepo.find(repo).tree_stats().latest == LATER  # type: ignore
+
+
+def test_untracked_files_count(repo):
+    write(path.join(repo, "src", "new.py"), "", mtime=LATER)
+    assert GitRepo.find(repo).tree_stats().latest == LATER  # type: ignore
+
+
+def test_touched_but_unchanged_files_dont_count(repo):
+    # same size, and only a later mtime within the same second
+    os.utime(path.join(repo, "README"), ns=(OLD * 10 ** 9 + 5, OLD * 10 ** 9 + 5))
+    assert GitRepo.find(repo).tree_stats().latest == OLD  # type: ignore
+
+
+def test_ignored_and_git_files_dont_count(repo):
+    write(path.join(repo, "build", "out.o"), "", mtime=LATER)
+    write(path.join(repo, ".git", "objects", "junk"), "", mtime=LATER)
+    stats = GitRepo.find(repo).tree_stats()  # type: ignore
+    assert stats.latest == OLD
+    assert stats.files == 3
+
+
+def test_staged_changes_count(repo):
+    write(path.join(repo, "README"), "hello, world", mtime=LATER)
+    git(repo, "add", "README")
+    assert GitRepo.find(repo).tree_stats().latest == LATER  # type: ignore
+
+
+@patch("proj.treecache.GRACE_NS", -(10 ** 12))
+def test_cached_walk_skips_unchanged_folders(repo):
+    found = GitRepo.find(repo)
+    assert found is not None
+    cache_file = path.join(path.dirname(repo), "cache.json")
+    scan_changes = GitRepo._scan_changes
+
+    def walk():
+        with patch.object(
+            GitRepo, "_scan_changes", autospec=True, side_effect=scan_changes
+        ) as scan:
+            stats = found.tree_stats(cache_file=cache_file)  # type: ignore
+        listed = {path.relpath(c.args[1], repo) for c in scan.call_args_list}
+        return stats, listed
+
+    assert walk() == (fs.TreeStats(latest=OLD, size=38, files=3), {".", "src"})
+    assert walk() == (fs.TreeStats(latest=OLD, size=38, files=3), set())
+
+    # edited in place, so only the index says the folder changed
+    write(path.join(repo, "src", "main.py"), "print('bye')", mtime=LATER)
+    git(repo, "add", "src/main.py")
+    assert walk()[1] == {"src"}
+
+    # unstaged again, leaving a changed file in an unchanged folder
+    git(repo, "reset", "-q", "--", "src/main.py")
+    stats, listed = walk()
+    assert listed == {"src"}
+    assert stats.latest == LATER
+
+
+@pytest.mark.parametrize("version", ["2", "3", "4"])
+def test_index_versions(repo, version):
+    expected = vcs.read_index(path.join(repo, ".git", "index"))
+    assert set(expected) == {".gitignore", "README", "src/main.py"}
+
+    git(repo, "update-index", "--index-version", version)
+    assert vcs.read_index(path.join(repo, ".git", "index")) == expected
+
+
+def test_corrupt_index(repo):
+    with open(path.join(repo, ".git", "index"), "r+b") as ostream:
+        ostream.truncate(40)
+
+    with pytest.raises(ValueError):
+        GitRepo.find(repo).tree_stats()  # type: ignore
+
+
+def test_worktree(repo):
+    worktree = path.join(path.dirname(repo), "worktree")
+    git(repo, "worktree", "add", "-q", "-b", "topic", worktree)
+    git(worktree, "commit", "-q", "--allow-empty", "-m", "Later", when=LATER)
+
+    found = GitRepo.find(worktree)
+    assert found is not None
+    assert path.samefile(found.common_dir, path.join(repo, ".git"))
+
+    # the commit on the topic branch shows up in both
+    assert found.last_ref_update() == LATER
+    assert GitRepo.find(repo).last_ref_update() == LATER  # type: ignore
+
+
+def test_not_a_repo(repo):
+    assert GitRepo.find(path.join(repo, "src")) is None